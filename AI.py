@@ -1,37 +1,265 @@
 import re
-import requests
 import json
 import html
+import ipaddress
 import streamlit as st
 from datetime import datetime, timedelta
 from database import Database
-import bcrypt
-import pandas as pd
-import io
+from session_tracker import SessionStore
+from auth import LoginThrottle, PasswordHasherBusy
+from write_behind import WriteBehindQueue
+from http_pool import HTTPClientPool
+from stream_render import post_process_latex, StreamRenderer
+import async_engine
+from response_cache import ResponseCache, make_cache_key, replay
+from context_builder import build_context, estimate_text_tokens
+from summarizer import ConversationSummarizer, valid_summary
+from endpoints import EndpointRouter, FailoverStream, HedgePolicy, endpoints_for, load_endpoint_config
+from pdf_extract import iter_pdf_pages, parse_page_range, pdf_page_count
+from ingest import PARSER_VERSION, IngestionService, compress_image, parse_csv, parse_docx, parse_excel
+from doc_index import INDEX_VERSION, DocumentIndex, build_document_index
+from parse_cache import ParseCache, file_digest, make_parse_key
+from memory_index import MemoryIndex, delete_user_files
+import os
+import base64
 
-# 初始化数据库
-db = Database()
+# 初始化数据库（所有用户和每次重新运行共用同一个实例）
+@st.cache_resource
+def get_database():
+    return Database()
 
-# 确保所需的表都已创建
-try:
-    conn = db.get_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS user_sessions (
-            user_id INTEGER,
-            sessions TEXT,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY (user_id),
-            FOREIGN KEY (user_id) REFERENCES users(id)
-        )
-    """)
+db = get_database()
+
+# 会话数据的后台写入队列：FLUSH_INTERVAL 为最长提交间隔（秒），MAX_PENDING 为积压上限，
+# SAVE_TIMEOUT 为积压时保存请求最多等待的秒数
+@st.cache_resource
+def get_persistence_queue():
+    return WriteBehindQueue(
+        db,
+        flush_interval=float(os.environ.get("SESSION_FLUSH_INTERVAL", 0.5)),
+        max_pending=int(os.environ.get("SESSION_MAX_PENDING", 200)),
+        save_timeout=float(os.environ.get("SESSION_SAVE_TIMEOUT", 10))
+    )
+
+persistence = get_persistence_queue()
+
+# 上游API的共享长连接池
+@st.cache_resource
+def get_http_pool():
+    return HTTPClientPool(pool_maxsize=int(os.environ.get("UPSTREAM_POOL_SIZE", 20)))
+
+http_pool = get_http_pool()
+
+# 异步流式请求引擎：需要安装 aiohttp，设置 UPSTREAM_ASYNC=0 或未安装时使用同步连接池
+@st.cache_resource
+def get_stream_engine():
+    if not async_engine.AVAILABLE or os.environ.get("UPSTREAM_ASYNC", "1") == "0":
+        return None
+    return async_engine.AsyncStreamEngine(limit=int(os.environ.get("UPSTREAM_ASYNC_LIMIT", 200)))
+
+stream_engine = get_stream_engine()
+
+# 不缓存回答的模型：联网搜索、图像/音乐生成等每次结果应当不同的模型
+UNCACHED_MODELS = [
+    "gpt-4o-all", "o1-mini-all", "o1-all", "o1-pro-all",
+    "dall-e-3", "ideogram", "midjourney", "suno-v3.5",
+    "gpt-4-gizmo-g-pmuQfob8d-image-generator", "gpt-4-gizmo-g-gFt1ghYJl-logo-creator"
+]
+
+# 上游响应缓存：RESPONSE_CACHE=0 关闭；RESPONSE_CACHE_MODELS 为只缓存的模型列表（逗号分隔，留空表示全部），
+# RESPONSE_CACHE_EXCLUDE_MODELS 追加不缓存的模型
+@st.cache_resource
+def get_response_cache():
+    if os.environ.get("RESPONSE_CACHE", "1") == "0":
+        return None
+    def split_models(value):
+        return [m.strip() for m in value.split(",") if m.strip()]
     
-    # 提交事务并关闭连接
-    conn.commit()
-    conn.close()
-except Exception as e:
-    st.error(f"初始化数据库表时出错: {str(e)}")
+    return ResponseCache(
+        db,
+        ttl=float(os.environ.get("RESPONSE_CACHE_TTL", 86400)),
+        max_entries=int(os.environ.get("RESPONSE_CACHE_MEMORY_ENTRIES", 256)),
+        max_bytes=int(float(os.environ.get("RESPONSE_CACHE_MAX_MB", 64)) * 1024 * 1024),
+        models=split_models(os.environ.get("RESPONSE_CACHE_MODELS", "")),
+        excluded_models=UNCACHED_MODELS + split_models(os.environ.get("RESPONSE_CACHE_EXCLUDE_MODELS", ""))
+    )
+
+response_cache = get_response_cache()
+
+# 上游节点：UPSTREAM_ENDPOINTS 为每个模型的备用节点（JSON，格式见 endpoints.load_endpoint_config），
+# UPSTREAM_MAX_ATTEMPTS 为收到第一个 token 之前最多尝试的次数
+UPSTREAM_MAX_ATTEMPTS = int(os.environ.get("UPSTREAM_MAX_ATTEMPTS", 3))
+
+@st.cache_resource
+def get_endpoint_config():
+    try:
+        return load_endpoint_config(os.environ.get("UPSTREAM_ENDPOINTS", ""))
+    except (ValueError, KeyError, AttributeError, TypeError) as e:
+        print(f"解析 UPSTREAM_ENDPOINTS 时出错: {str(e)}")
+        return {}
+
+endpoint_config = get_endpoint_config()
+
+# 节点熔断和延迟统计（所有用户共用）
+@st.cache_resource
+def get_endpoint_router():
+    return EndpointRouter(
+        failure_threshold=int(os.environ.get("UPSTREAM_FAILURE_THRESHOLD", 3)),
+        reset_timeout=float(os.environ.get("UPSTREAM_RESET_TIMEOUT", 30))
+    )
+
+endpoint_router = get_endpoint_router()
+
+# 对冲请求：UPSTREAM_HEDGE=1 开启。主请求超过节点首 token 延迟的 UPSTREAM_HEDGE_PERCENTILE 分位数
+# 仍没有输出时，向其他节点（没有其他节点时向 UPSTREAM_HEDGE_FALLBACK_MODELS 中的备用模型，JSON 格式
+# {"模型": "备用模型"}）再发一份请求；UPSTREAM_HEDGE_BUDGET 为对冲请求占请求总数的比例上限。
+# 对冲请求在异步引擎的事件循环上竞速，使用同步连接池（UPSTREAM_ASYNC=0）时不启用
+@st.cache_resource
+def get_hedge_policy():
+    if os.environ.get("UPSTREAM_HEDGE", "0") != "1" or stream_engine is None:
+        return None
+    return HedgePolicy(
+        percentile=float(os.environ.get("UPSTREAM_HEDGE_PERCENTILE", 0.95)),
+        min_delay=float(os.environ.get("UPSTREAM_HEDGE_MIN_DELAY", 0.5)),
+        max_delay=float(os.environ.get("UPSTREAM_HEDGE_MAX_DELAY", 10)),
+        budget_ratio=float(os.environ.get("UPSTREAM_HEDGE_BUDGET", 0.1))
+    )
+
+hedge_policy = get_hedge_policy()
+
+@st.cache_resource
+def get_hedge_fallback_models():
+    try:
+        return json.loads(os.environ.get("UPSTREAM_HEDGE_FALLBACK_MODELS", "") or "{}")
+    except ValueError as e:
+        print(f"解析 UPSTREAM_HEDGE_FALLBACK_MODELS 时出错: {str(e)}")
+        return {}
+
+hedge_fallback_models = get_hedge_fallback_models()
+
+# 会话滚动摘要：CONVERSATION_SUMMARY=0 关闭，SUMMARY_MODEL 为生成摘要使用的模型
+@st.cache_resource
+def get_summarizer():
+    if os.environ.get("CONVERSATION_SUMMARY", "1") == "0":
+        return None
+    return ConversationSummarizer(
+        db,
+        http_pool,
+        model=os.environ.get("SUMMARY_MODEL", "gpt-4o-mini"),
+        flush=persistence.flush
+    )
+
+summarizer = get_summarizer()
+
+# 跨会话记忆：MEMORY_RECALL=0 关闭；每轮问答保存后写入 MEMORY_DIR 下该用户的向量文件，
+# 提问时回忆其他会话中最相关的 MEMORY_TOP_K 轮问答（相似度不低于 MEMORY_MIN_SCORE）
+MEMORY_TOP_K = int(os.environ.get("MEMORY_TOP_K", 3))
+MEMORY_DIR = os.environ.get("MEMORY_DIR", "memory_index")
+
+@st.cache_resource
+def get_memory_index():
+    if os.environ.get("MEMORY_RECALL", "1") == "0":
+        return None
+    return MemoryIndex(
+        directory=MEMORY_DIR,
+        min_score=float(os.environ.get("MEMORY_MIN_SCORE", 0.3))
+    )
+
+memory_index = get_memory_index()
+
+# 上传文件的解析服务（所有用户共用）：INGEST_WORKERS 为工作进程数，INGEST_TIMEOUT 为单个任务的超时秒数，
+# INGEST_MEMORY_MB 为每个工作进程的内存上限；INGEST_WORKERS=0 时在脚本线程中解析（不限制超时和内存）
+@st.cache_resource
+def get_ingestion_service():
+    workers = int(os.environ.get("INGEST_WORKERS", min(4, os.cpu_count() or 1)))
+    if workers <= 0:
+        return None
+    return IngestionService(
+        max_workers=workers,
+        timeout=float(os.environ.get("INGEST_TIMEOUT", 60)),
+        memory_limit_mb=int(os.environ.get("INGEST_MEMORY_MB", 1024))
+    )
+
+ingestion = get_ingestion_service()
+
+def run_ingest(kind, fn, *args):
+    """在解析服务的工作进程中执行 fn(*args)，未启用解析服务时直接执行"""
+    if ingestion is None:
+        return fn(*args)
+    return ingestion.run(kind, fn, *args)
+
+# 上传文件的解析结果缓存：PARSE_CACHE=0 关闭，PARSE_CACHE_MAX_MB 为缓存的总大小上限
+@st.cache_resource
+def get_parse_cache():
+    if os.environ.get("PARSE_CACHE", "1") == "0":
+        return None
+    return ParseCache(db, max_bytes=int(float(os.environ.get("PARSE_CACHE_MAX_MB", 256)) * 1024 * 1024))
+
+parse_cache = get_parse_cache()
+
+def cached_parse(data, kind, parse, options=None):
+    """相同内容的文件直接返回缓存的解析结果，否则调用 parse() 解析并缓存"""
+    if parse_cache is None:
+        return parse()
+    cache_key = make_parse_key(file_digest(data), PARSER_VERSION, kind, options)
+    result = parse_cache.get(cache_key)
+    if result is None:
+        result = parse()
+        parse_cache.put(cache_key, result, len(data))
+    return result
+
+# PDF_MAX_TOKENS 为单个 PDF 最多提取的估算 token 数，超出后不再提取后面的页
+PDF_MAX_TOKENS = int(os.environ.get("PDF_MAX_TOKENS", 200000))
+
+# 登录限流（所有用户共用）：LOGIN_MAX_FAILURES 和 LOGIN_MAX_IP_FAILURES 分别为同一用户名和同一IP
+# 在 LOGIN_WINDOW 秒内允许的失败次数
+@st.cache_resource
+def get_login_throttle():
+    return LoginThrottle(
+        max_failures=int(os.environ.get("LOGIN_MAX_FAILURES", 5)),
+        max_failures_per_ip=int(os.environ.get("LOGIN_MAX_IP_FAILURES", 100)),
+        window=float(os.environ.get("LOGIN_WINDOW", 300))
+    )
+
+login_throttle = get_login_throttle()
+
+# 可信的反向代理（逗号分隔的IP或网段，例如 127.0.0.1,10.0.0.0/8）；只有来自这些地址的连接才使用
+# X-Forwarded-For/X-Real-Ip，否则客户端每次伪造不同的请求头即可绕过按IP的限流
+TRUSTED_PROXIES = []
+for proxy in os.environ.get("TRUSTED_PROXIES", "").split(","):
+    if proxy.strip():
+        try:
+            TRUSTED_PROXIES.append(ipaddress.ip_network(proxy.strip(), strict=False))
+        except ValueError as e:
+            print(f"解析 TRUSTED_PROXIES 时出错: {str(e)}")
+
+def is_trusted_proxy(address):
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in TRUSTED_PROXIES)
+
+def get_client_ip():
+    """获取客户端IP；连接来自可信的反向代理时使用代理传递的地址"""
+    try:
+        headers = st.context.headers
+        # 通过 localhost 访问时 Streamlit 返回 None
+        peer = st.context.ip_address or "127.0.0.1"
+    except AttributeError:
+        # st.context.ip_address 需要 Streamlit 1.45 及以上版本；无法获取时登录限流只按用户名计数
+        print("获取客户端IP时出错: 当前 Streamlit 版本不支持 st.context.ip_address，按IP的登录限流未生效")
+        return None
+    if not is_trusted_proxy(peer):
+        return peer
+    forwarded = [address.strip() for address in headers.get("X-Forwarded-For", "").split(",") if address.strip()]
+    # 从右向左跳过可信代理追加的地址，第一个不可信的地址即为客户端
+    for address in reversed(forwarded):
+        if not is_trusted_proxy(address):
+            return address
+    if forwarded:
+        return forwarded[0]
+    return headers.get("X-Real-Ip") or peer
 
 # 设置页面配置，使用机器人emoji作为图标
 st.set_page_config(
@@ -180,20 +408,30 @@ if not st.session_state.user_id:
                                                        )
                 
                 if login_submit:
-                    if login_username and login_password:
-                        success, user_id = db.verify_user(login_username, login_password)
+                    client_ip = get_client_ip()
+                    allowed, retry_after = login_throttle.check(login_username or "", client_ip)
+                    if not allowed:
+                        st.error(f"❌ 登录失败次数过多，请 {retry_after} 秒后再试")
+                    elif login_username and login_password:
+                        try:
+                            success, user_id = db.verify_user(login_username, login_password)
+                        except PasswordHasherBusy as e:
+                            st.warning(f"⚠️ {str(e)}")
+                            st.stop()
                         if success:
+                            login_throttle.record_success(login_username, client_ip)
                             # 设置基本会话状态
                             st.session_state.user_id = user_id
                             st.session_state.username = login_username
                             
-                            # 加载用户的会话数据
-                            saved_sessions = db.load_user_sessions(user_id)
+                            # 加载用户的会话列表（只加载元数据，消息内容在打开会话时再加载）
+                            persistence.flush(user_id)
+                            saved_sessions = db.load_session_index(user_id)
                             if saved_sessions:
-                                st.session_state.sessions = saved_sessions
+                                st.session_state.sessions = SessionStore.from_index(saved_sessions)
                                 # 检查最新会话是否为空会话
                                 latest_session = max(saved_sessions.items(), key=lambda x: x[1]['timestamp'])
-                                if not latest_session[1]['chat_history']:
+                                if not latest_session[1]['message_count']:
                                     # 如果最新会话是空会话，直接使用它
                                     st.session_state.current_session_id = latest_session[0]
                                 else:
@@ -209,14 +447,13 @@ if not st.session_state.user_id:
                                     st.session_state.current_session_id = new_session_id
                             else:
                                 # 初始化默认会话
-                                st.session_state.sessions = {
-                                    'default': {
-                                        'chat_history': [],
-                                        'chat_context': [],
-                                        'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                                        'title': '新会话',
-                                        'is_favorite': False
-                                    }
+                                st.session_state.sessions = SessionStore()
+                                st.session_state.sessions['default'] = {
+                                    'chat_history': [],
+                                    'chat_context': [],
+                                    'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                                    'title': '新会话',
+                                    'is_favorite': False
                                 }
                                 st.session_state.current_session_id = 'default'
                             
@@ -245,6 +482,7 @@ if not st.session_state.user_id:
                             
                             st.rerun()
                         else:
+                            login_throttle.record_failure(login_username, client_ip)
                             st.error("❌ 用户名或密码错误")
                     else:
                         st.warning("⚠️ 请输入用户名和密码")
@@ -319,6 +557,43 @@ if 'model' not in st.session_state:
 if 'show_default' not in st.session_state:
     st.session_state.show_default = {'api_key': True, 'api_base': True, 'model': True}
 
+# 可选模型：(模型名称, 说明, 上下文窗口 token 数, 回答的 max_tokens)
+available_models = [
+    ("gpt-4o-all", "———全能版 | 联网、代码、文件、图像", 128000, 4096),
+    ("gpt-4o", "———基础版 | 日常任务", 128000, 4096),
+    ("gpt-4o-mini", "———轻量版 | 快速响应", 128000, 4096),
+    ("claude-3-5-sonnet-20240620", "———代码突出 | 强大理解", 200000, 4096),
+    ("claude-3-5-sonnet-20240620-fast", "———代码突出 | 快速版", 200000, 4096),
+    ("claude-3-5-sonnet-20241022", "———代码突出 | 最新版", 200000, 4096),
+    ("claude-3-5-sonnet-20241022-fast", "———代码突出 | 快速版", 200000, 4096),
+    ("claude-3-5-haiku-20241022-fast", "———Haiku | 轻量快速", 200000, 4096),
+    ("openai-gpt-4o", "———GPT-4 | 原生接口", 128000, 4096),
+    ("OpenAI-gpt-4o", "———GPT-4 | 备用接口", 128000, 4096),
+    ("Claude-claude-3-5-sonnet-20240620", "———Sonnet 06 | 原生", 200000, 4096),
+    ("Claude-claude-3-5-sonnet-20241022", "———Sonnet 10 | 原生", 200000, 4096),
+    ("gemini-2.0-flash-exp", "———gemini-2.0-flash-exp", 1048576, 8192),
+    ("o1-mini-all", "———深度推理 | o1轻量", 128000, 8000),
+    ("o1-all", "———深度推理 | o1预览版", 128000, 8000),
+    ("o1", "———深度推理 | o1", 200000, 8000),
+    ("o1-mini", "———深度推理 | o1快速版", 128000, 8000),
+    ("o1-pro", "———深度推理 | o1", 200000, 8000),
+    ("o1-pro-all", "———深度推理 | o1", 200000, 8000),
+    ("dall-e-3", "———DALL-E 3 | 图像生成", 4000, 1000),
+    ("ideogram", "———Ideogram | 图像生成", 4000, 1000),
+    ("midjourney", "———Midjourney | 图像生成", 4000, 1000),
+    ("suno-v3.5", "———Suno | 音乐生成", 4000, 1000),
+    ("gpt-4-gizmo-g-bo0FiWLY7", "———Consensus科研文献", 32000, 2000),
+    ("gpt-4-gizmo-g-pmuQfob8d-image-generator", "———图像生成", 32000, 2000),
+    ("gpt-4-gizmo-g-NgAcklHd8-scispace", "———SciSpace科研助手", 32000, 2000),
+    ("gpt-4-gizmo-g-B3hgivKK9-write-for-me", "———WriteForMe写作助手", 32000, 2000),
+    ("gpt-4-gizmo-g-gFt1ghYJl-logo-creator", "———Logo设计", 32000, 2000),
+    ("gpt-4-gizmo-g-Lq7UjNxjV-lun-wen-xie-shou", "———论文写手", 32000, 2000),
+    ("gpt-4-gizmo-g-RfusSJbgM-chao-ji-pptsheng-cheng-super-ppt", "———SuperPPT生成", 32000, 2000)
+]
+model_descriptions = {m[0]: m[1] for m in available_models}
+model_context_windows = {m[0]: m[2] for m in available_models}
+model_max_tokens = {m[0]: m[3] for m in available_models}
+
 # API设置部分保留在侧边栏
 with st.sidebar:
     # 用户信息和登出按钮
@@ -327,8 +602,9 @@ with st.sidebar:
         st.markdown(f"### 👤 当前用户: {st.session_state.username}")
     with col2:
         if st.button("退出登录", use_container_width=True):
-            # 保存用户数据
-            db.save_user_sessions(st.session_state.user_id, st.session_state.sessions)
+            # 保存用户数据，并等待后台写入完成
+            persistence.save(st.session_state.user_id, st.session_state.sessions)
+            persistence.flush(st.session_state.user_id)
             db.save_user_settings(
                 st.session_state.user_id,
                 st.session_state.api_key,
@@ -353,42 +629,10 @@ with st.sidebar:
                                 key="api_base_input")
         
         # 使用下拉选择框替代文本输入框
-        available_models = [
-            ("gpt-4o-all", "———全能版 | 联网、代码、文件、图像"),
-            ("gpt-4o", "———基础版 | 日常任务"),
-            ("gpt-4o-mini", "———轻量版 | 快速响应"),
-            ("claude-3-5-sonnet-20240620", "———代码突出 | 强大理解"),
-            ("claude-3-5-sonnet-20240620-fast", "———代码突出 | 快速版"),
-            ("claude-3-5-sonnet-20241022", "———代码突出 | 最新版"),
-            ("claude-3-5-sonnet-20241022-fast", "———代码突出 | 快速版"),
-            ("claude-3-5-haiku-20241022-fast", "———Haiku | 轻量快速"),
-            ("openai-gpt-4o", "———GPT-4 | 原生接口"),
-            ("OpenAI-gpt-4o", "———GPT-4 | 备用接口"),
-            ("Claude-claude-3-5-sonnet-20240620", "———Sonnet 06 | 原生"),
-            ("Claude-claude-3-5-sonnet-20241022", "———Sonnet 10 | 原生"),
-            ("gemini-2.0-flash-exp", "———gemini-2.0-flash-exp"),
-            ("o1-mini-all", "———深度推理 | o1轻量"),
-            ("o1-all", "———深度推理 | o1预览版"),
-            ("o1", "———深度推理 | o1"),
-            ("o1-mini", "———深度推理 | o1快速版"),
-            ("o1-pro", "———深度推理 | o1"),
-            ("o1-pro-all", "———深度推理 | o1"),
-            ("dall-e-3", "———DALL-E 3 | 图像生成"),
-            ("ideogram", "———Ideogram | 图像生成"),
-            ("midjourney", "———Midjourney | 图像生成"),
-            ("suno-v3.5", "———Suno | 音乐生成"),
-            ("gpt-4-gizmo-g-bo0FiWLY7", "———Consensus科研文献"),
-            ("gpt-4-gizmo-g-pmuQfob8d-image-generator", "———图像生成"),
-            ("gpt-4-gizmo-g-NgAcklHd8-scispace", "———SciSpace科研助手"),
-            ("gpt-4-gizmo-g-B3hgivKK9-write-for-me", "———WriteForMe写作助手"),
-            ("gpt-4-gizmo-g-gFt1ghYJl-logo-creator", "———Logo设计"),
-            ("gpt-4-gizmo-g-Lq7UjNxjV-lun-wen-xie-shou", "———论文写手"),
-            ("gpt-4-gizmo-g-RfusSJbgM-chao-ji-pptsheng-cheng-super-ppt", "———SuperPPT生成")
-        ]
         model = st.selectbox(
             "模型名称",
             options=[m[0] for m in available_models],
-            format_func=lambda x: f"{x} ({dict(available_models)[x]})",
+            format_func=lambda x: f"{x} ({model_descriptions[x]})",
             index=[m[0] for m in available_models].index(st.session_state.model) if st.session_state.model in [m[0] for m in available_models] else 0,
             key="model_input"
         )
@@ -439,6 +683,75 @@ with st.sidebar:
         if st.button("管理用户", use_container_width=True):
             st.session_state.show_admin_panel = True
             st.rerun()
+        st.caption(f"会话保存: 共 {db.write_stats['saves']} 次，上次写入 {db.write_stats['last_bytes']} 字节")
+        commit_stats = persistence.stats
+        avg_commit_ms = commit_stats['total_commit_ms'] / commit_stats['commits'] if commit_stats['commits'] else 0
+        st.caption(
+            f"写入队列: 积压 {persistence.queue_depth}，已提交 {commit_stats['commits']} 批，"
+            f"平均 {avg_commit_ms:.1f}ms / 最长 {commit_stats['max_commit_ms']:.1f}ms，失败 {commit_stats['failures']} 次，"
+            f"放弃 {commit_stats['dropped']} 个用户的修改，推迟 {commit_stats['save_timeouts']} 次保存"
+        )
+        for pool_base, pool_stats in http_pool.stats().items():
+            st.caption(
+                f"连接池 {pool_base}: 请求 {pool_stats['requests']} 次，握手 {pool_stats['handshakes']} 次，"
+                f"复用率 {pool_stats['reuse_ratio']:.0%}"
+            )
+        if stream_engine is not None:
+            engine_stats = stream_engine.stats
+            st.caption(
+                f"异步请求: 进行中 {engine_stats['active']}，完成 {engine_stats['completed']}，"
+                f"失败 {engine_stats['failed']}，取消 {engine_stats['cancelled']}"
+            )
+        if response_cache is not None:
+            cache_stats = response_cache.stats
+            st.caption(
+                f"响应缓存: 命中率 {response_cache.hit_rate:.0%}（内存 {cache_stats['memory_hits']}，"
+                f"数据库 {cache_stats['disk_hits']}，未命中 {cache_stats['misses']}），已缓存 {cache_stats['stores']} 条"
+            )
+        if summarizer is not None:
+            summary_stats = summarizer.stats
+            st.caption(
+                f"会话摘要: 已提交 {summary_stats['scheduled']}，完成 {summary_stats['completed']}，"
+                f"失败 {summary_stats['failed']}"
+            )
+        if parse_cache is not None:
+            parse_stats = parse_cache.stats
+            st.caption(
+                f"解析缓存: 命中率 {parse_cache.hit_rate:.0%}（命中 {parse_stats['hits']}，未命中 {parse_stats['misses']}），"
+                f"免于解析 {parse_stats['bytes_saved'] / 1024 / 1024:.1f}MB"
+            )
+        if memory_index is not None:
+            memory_stats = memory_index.stats
+            st.caption(
+                f"跨会话记忆: 已写入 {memory_stats['added']} 轮，检索 {memory_stats['searches']} 次，"
+                f"回忆 {memory_stats['recalled']} 条，随会话删除 {memory_stats['pruned']} 条"
+            )
+        if ingestion is not None:
+            for kind, ingest_stats in sorted(ingestion.summary().items()):
+                st.caption(
+                    f"文件解析 {kind}: {ingest_stats['jobs']} 个，平均排队 {ingest_stats['avg_queue_wait']:.2f}s，"
+                    f"平均解析 {ingest_stats['avg_parse_time']:.2f}s，超时 {ingest_stats['timeouts']}，失败 {ingest_stats['failed']}"
+                )
+        if hedge_policy is not None:
+            hedge_stats = hedge_policy.stats
+            st.caption(
+                f"对冲请求: 请求 {hedge_stats['requests']} 次，对冲 {hedge_stats['hedged']} 次"
+                f"（对冲胜出 {hedge_stats['hedge_wins']}，主请求胜出 {hedge_stats['primary_wins']}），"
+                f"预算不足 {hedge_stats['budget_denied']} 次，取消 {hedge_stats['losers_cancelled']} 个"
+            )
+        last_stream_info = st.session_state.get('last_stream_info')
+        if last_stream_info:
+            usage = last_stream_info['usage'] or {}
+            st.caption(
+                f"上次响应{'（缓存）' if last_stream_info.get('cached') else ''}: 结束原因 {last_stream_info['finish_reason'] or '未知'}，"
+                f"事件 {last_stream_info['events']} 个，用量 {usage.get('total_tokens', '未返回')} tokens"
+            )
+            if last_stream_info.get('endpoint'):
+                st.caption(
+                    f"上次响应节点: {last_stream_info['endpoint']}，尝试 {last_stream_info['attempts']} 次"
+                    f"{'（已对冲）' if last_stream_info.get('hedged') else ''}"
+                    f"{'，备用模型 ' + last_stream_info['model'] if last_stream_info.get('model') else ''}"
+                )
 
 # 主要内容移到主区域
 st.markdown("""
@@ -450,7 +763,7 @@ st.markdown("""
 
 # 在初始化聊天历史和上下文的部分之前添加
 if 'sessions' not in st.session_state:
-    st.session_state.sessions = {}
+    st.session_state.sessions = SessionStore()
 if 'current_session_id' not in st.session_state:
     st.session_state.current_session_id = 'default'
     st.session_state.sessions['default'] = {
@@ -470,6 +783,178 @@ if st.session_state.current_session_id not in st.session_state.sessions:
         'title': '新会话'
     }
 
+# 聊天历史每页显示的条数，打开会话时只加载最近一页
+CHAT_HISTORY_PAGE_SIZE = 20
+
+def load_session_body(session_id):
+    """从数据库加载会话的消息内容，先等待该用户尚未写入的数据提交"""
+    persistence.flush(st.session_state.user_id)
+    return db.load_session_messages(st.session_state.user_id, session_id, history_limit=CHAT_HISTORY_PAGE_SIZE)
+
+# 按需加载当前会话的消息内容
+try:
+    st.session_state.sessions.ensure_loaded(st.session_state.current_session_id, load_session_body)
+except RuntimeError as e:
+    st.error(f"{str(e)}，请刷新页面重试")
+    st.stop()
+
+# 消息中对文件存储内容的引用：文本中使用 [[blob:<sha256>]]，图片URL使用 blob:<sha256>；
+# 较长的文档使用 [[doc:<索引的sha256>]]，发送时只展开与问题相关的片段
+BLOB_URL_PREFIX = "blob:"
+BLOB_REF_PATTERN = re.compile(r'\[\[blob:([0-9a-f]{64})\]\]')
+DOC_REF_PATTERN = re.compile(r'\[\[doc:([0-9a-f]{64})\]\]')
+
+# 估算 token 数不超过 DOC_INLINE_TOKENS 的文档整篇发送，更长的文档建立索引后每次只发送
+# 与问题最相关的 DOC_TOP_K 个片段
+DOC_INLINE_TOKENS = int(os.environ.get("DOC_INLINE_TOKENS", 4000))
+DOC_TOP_K = int(os.environ.get("DOC_TOP_K", 6))
+
+# 文档提示词中的固定文字，检索时从问题中去掉
+DOC_PROMPT_PHRASES = ("请分析以下文档内容：", "用户的具体问题是：", "请总结文档的主要内容，并提供关键信息分析。")
+
+def blob_ref(digest):
+    """生成插入到提示词中的文件引用"""
+    return f"[[blob:{digest}]]"
+
+def doc_ref(index_digest):
+    """生成插入到提示词中的文档索引引用"""
+    return f"[[doc:{index_digest}]]"
+
+@st.cache_resource(max_entries=32)
+def load_document_index(index_digest):
+    """读取文档索引，最近使用的 32 个索引在各次重新运行和各会话之间共用；不存在时返回 None"""
+    data = db.get_blob(index_digest)
+    return DocumentIndex.from_json(data.decode('utf-8')) if data is not None else None
+
+def retrieval_query(context):
+    """返回用于检索文档片段的问题：最近一条用户消息去掉文件引用和固定提示文字后的文本"""
+    for msg in reversed(context):
+        if msg.get("role") != "user":
+            continue
+        content = msg.get("content")
+        if isinstance(content, list):
+            content = " ".join(part.get("text", "") for part in content if part.get("type") == "text")
+        query = DOC_REF_PATTERN.sub("", BLOB_REF_PATTERN.sub("", content or ""))
+        for phrase in DOC_PROMPT_PHRASES:
+            query = query.replace(phrase, "")
+        return query.strip()
+    return ""
+
+def resolve_blob_refs(messages, query=""):
+    """构建API请求时，将消息中的文件引用替换为实际内容（不修改原消息）
+    
+    文档索引引用展开为与 query 最相关的片段，query 为空时在全文中均匀选取片段。
+    """
+    blobs = {}
+    
+    def load(digest):
+        if digest not in blobs:
+            blobs[digest] = db.get_blob(digest)
+        return blobs[digest]
+    
+    def replace_text(match):
+        data = load(match.group(1))
+        return data.decode('utf-8', errors='replace') if data is not None else "[文件内容已丢失]"
+    
+    def replace_doc(match):
+        index = load_document_index(match.group(1))
+        if index is None:
+            return "[文件内容已丢失]"
+        positions = (index.search(query, DOC_TOP_K) if query else []) or index.overview(DOC_TOP_K)
+        excerpts = [f"[片段 {position + 1}/{len(index.chunks)}]\n{index.chunks[position]}" for position in positions]
+        return "（文档较长，以下为与问题相关的片段）\n\n" + "\n\n".join(excerpts)
+    
+    resolved = []
+    for msg in messages:
+        content = msg.get("content")
+        if isinstance(content, str) and ("[[blob:" in content or "[[doc:" in content):
+            content = BLOB_REF_PATTERN.sub(replace_text, content)
+            msg = dict(msg, content=DOC_REF_PATTERN.sub(replace_doc, content))
+        elif isinstance(content, list):
+            parts = []
+            for part in content:
+                url = part.get("image_url", {}).get("url", "") if part.get("type") == "image_url" else ""
+                if url.startswith(BLOB_URL_PREFIX):
+                    data = load(url[len(BLOB_URL_PREFIX):]) or b""
+                    part = {
+                        "type": "image_url",
+                        "image_url": {"url": f"data:image/jpeg;base64,{base64.b64encode(data).decode('utf-8')}"}
+                    }
+                parts.append(part)
+            msg = dict(msg, content=parts)
+        resolved.append(msg)
+    return resolved
+
+def recall_memories(query):
+    """在用户的其他会话中查找与问题相关的问答，返回放入上下文的文本，没有时返回 None"""
+    if memory_index is None or not query:
+        return None
+    try:
+        results = memory_index.search(
+            st.session_state.user_id, query, k=MEMORY_TOP_K,
+            exclude_session=st.session_state.current_session_id,
+            sessions=set(st.session_state.sessions.keys())
+        )
+    except Exception as e:
+        print(f"检索跨会话记忆时出错: {str(e)}")
+        return None
+    if not results:
+        return None
+    recalled = []
+    for score, record in results:
+        session = st.session_state.sessions.get(record['session_id'])
+        title = session.get('title', '') if session is not None else ''
+        recalled.append(f"[会话「{title}」] 用户: {record['question']}\nAI: {record['answer']}")
+    return "\n\n".join(recalled)
+
+def delete_session(session_id):
+    """删除会话及其跨会话记忆，当前会话被删除时切换到最近的会话"""
+    del st.session_state.sessions[session_id]
+    if memory_index is not None:
+        try:
+            memory_index.delete_session(st.session_state.user_id, session_id)
+        except Exception as e:
+            print(f"删除会话记忆时出错: {str(e)}")
+    if session_id == st.session_state.current_session_id:
+        remaining_sessions = sorted(
+            st.session_state.sessions.items(),
+            key=lambda x: x[1]['timestamp'],
+            reverse=True
+        )
+        st.session_state.current_session_id = remaining_sessions[0][0]
+    persistence.save(st.session_state.user_id, st.session_state.sessions)
+
+def append_ai_response(session_id, ai_response, note=None):
+    """把AI的回答加入会话的聊天历史和上下文并保存；note 为显示在回答末尾的说明"""
+    session = st.session_state.sessions[session_id]
+    question = retrieval_query(session['chat_context'])
+    processed_response = post_process_latex(ai_response)
+    if note:
+        processed_response += f"\n\n*（{note}）*"
+    session['chat_history'].append(f"AI: {processed_response}")
+    # 停止时还没有收到任何内容的回答，上下文中记录说明，避免出现空的助手消息
+    session['chat_context'].append({"role": "assistant", "content": ai_response or (f"（{note}）" if note else "")})
+    persistence.save(st.session_state.user_id, st.session_state.sessions)
+    
+    # 把这一轮问答加入跨会话记忆
+    if memory_index is not None and ai_response:
+        try:
+            memory_index.add(st.session_state.user_id, session_id, question, ai_response)
+        except Exception as e:
+            print(f"保存跨会话记忆时出错: {str(e)}")
+
+def save_interrupted_response():
+    """上一次运行在生成回答时被中断（点击停止按钮或进行了其他操作），保存已经收到的部分回答
+
+    中断时脚本线程在渲染处抛出 Streamlit 的控制异常，FailoverStream 离开 with 语句时已取消上游请求。
+    """
+    generating = st.session_state.pop('generating', None)
+    if generating is None or generating['session_id'] not in st.session_state.sessions:
+        return
+    append_ai_response(generating['session_id'], generating['renderer'].raw_text(), "已停止生成")
+
+save_interrupted_response()
+
 # 替换所有 st.session_state.chat_history 为
 # st.session_state.sessions[st.session_state.current_session_id]['chat_history']
 # 替换所有 st.session_state.chat_context 为
@@ -484,29 +969,6 @@ api_key_to_use = st.session_state.api_key
 api_base_to_use = st.session_state.api_base
 model_to_use = st.session_state.model
 
-def post_process_latex(text):
-    """
-    后处理 AI 输出，确保数学公式被正确包裹在 $$ 符号内
-    """
-    # 移除多余的 $ 符号
-    text = re.sub(r'\${2,}', '$$', text)
-    
-    # 查找可能的公式开始和结束
-    pattern = r'(\\begin\{.*?\}|\\end\{.*?\}|\\\[|\\\]|\\(|\\))'
-    
-    def replace_func(match):
-        formula = match.group(1)
-        if formula in ['\\(', '\\)']:
-            return '$$'
-        if formula in ['\\[', '\\]']:
-            return '$$'
-        return formula
-    
-    # 使用正则表达式查找可能的公式边界并替换
-    processed_text = re.sub(pattern, replace_func, text)
-    
-    return processed_text
-
 def render_message(message):
     """渲染消息，处理LaTeX公式"""
     # 分割文本和公式
@@ -550,12 +1012,54 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+@st.cache_data(max_entries=1000, show_spinner=False)
+def render_ai_text(text):
+    """缓存AI消息的LaTeX后处理结果，避免每次重新运行都重复处理"""
+    return post_process_latex(text)
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def load_blob(digest):
+    """读取文件存储中的内容，按SHA-256缓存（内容不可变）"""
+    return db.get_blob(digest)
+
+# 只显示最近的若干条聊天历史，点击按钮再向前加载
+if 'history_windows' not in st.session_state:
+    st.session_state.history_windows = {}
+chat_history = st.session_state.sessions[st.session_state.current_session_id]['chat_history']
+history_window = st.session_state.history_windows.get(st.session_state.current_session_id, CHAT_HISTORY_PAGE_SIZE)
+
+# 内存中的消息不够显示时，从数据库读取更早的一段
+missing = min(history_window - len(chat_history), chat_history.offset)
+if missing > 0:
+    persistence.flush(st.session_state.user_id)
+    earlier = db.load_message_range(
+        st.session_state.user_id,
+        st.session_state.current_session_id,
+        'history',
+        chat_history.offset - missing,
+        chat_history.offset
+    )
+    if earlier is not None:
+        chat_history.prepend_loaded(earlier)
+
+if len(chat_history) > history_window or chat_history.offset > 0:
+    if st.button("⬆️ 加载更早的消息", key="load_earlier_messages"):
+        st.session_state.history_windows[st.session_state.current_session_id] = history_window + CHAT_HISTORY_PAGE_SIZE
+        st.rerun()
+
 # 显示聊天历史
-for message in st.session_state.sessions[st.session_state.current_session_id]['chat_history']:
+for message in chat_history[-history_window:]:
     if isinstance(message, dict):
         if message['type'] == 'image':
-            # 显示图片
-            st.image(f"data:image/jpeg;base64,{message['data']}")
+            # 显示图片（新消息只保存文件存储中的引用，旧消息直接保存base64数据）
+            if 'blob' in message:
+                image_data = load_blob(message['blob'])
+                if image_data:
+                    st.image(image_data)
+                else:
+                    st.warning(f"图片 {message['filename']} 已丢失")
+            else:
+                st.image(f"data:image/jpeg;base64,{message['data']}")
             if 'user_input' in message and message['user_input']:
                 st.markdown(f'''
                 <div class="chat-message user">
@@ -579,28 +1083,41 @@ for message in st.session_state.sessions[st.session_state.current_session_id]['c
         elif message.startswith("AI:"):
             st.markdown(f'''
             <div class="chat-message bot">
-                <div class="message">🤖 <strong>Cookie:</strong><br>{post_process_latex(message[3:])}</div>
+                <div class="message">🤖 <strong>Cookie:</strong><br>{render_ai_text(message[3:])}</div>
             </div>
             ''', unsafe_allow_html=True)
         else:
             st.text(message)
 
-def simplify_context(context, max_messages=7):
-    """简化上下文，保留最近的消息"""
-    if len(context) <= max_messages:
-        return context
-    
-    # 保留系统消息（如果存在）
-    simplified = [msg for msg in context if msg["role"] == "system"]
-    
-    # 添加最近的消息，确保用户和助手的消息交替出现
-    recent_messages = context[-max_messages:]
-    for i, msg in enumerate(recent_messages):
-        if i == 0 and msg["role"] == "assistant":
-            simplified.append({"role": "user", "content": "继续我们的对话。"})
-        simplified.append(msg)
-    
-    return simplified
+# 上下文预算：模型的上下文窗口扣除回答的 max_tokens，并且不超过 CONTEXT_TOKEN_LIMIT（控制每轮请求的费用）
+CONTEXT_TOKEN_LIMIT = int(os.environ.get("CONTEXT_TOKEN_LIMIT", 32000))
+# 不在 available_models 中的模型使用的上下文窗口
+DEFAULT_CONTEXT_WINDOW = 16000
+# 较早的超长消息（例如文档）的处理方式：truncate 保留开头和结尾，elide 整条省略
+CONTEXT_OVERSIZE_POLICY = os.environ.get("CONTEXT_OVERSIZE_POLICY", "truncate")
+
+# 生成过程中检查停止按钮的间隔（秒）
+STOP_POLL_INTERVAL = 0.2
+
+# 回答的 max_tokens：不在 available_models 中的模型使用 DEFAULT_MAX_TOKENS，
+# MODEL_MAX_TOKENS（JSON，格式 {"模型名称": max_tokens}）可以覆盖单个模型的设置
+DEFAULT_MAX_TOKENS = int(os.environ.get("DEFAULT_MAX_TOKENS", 1000))
+try:
+    model_max_tokens.update({
+        model: int(value) for model, value in json.loads(os.environ.get("MODEL_MAX_TOKENS", "") or "{}").items()
+    })
+except (ValueError, AttributeError, TypeError) as e:
+    print(f"解析 MODEL_MAX_TOKENS 时出错: {str(e)}")
+
+def max_tokens_for(model):
+    """返回模型回答的 max_tokens，不超过上下文窗口的一半"""
+    window = model_context_windows.get(model, DEFAULT_CONTEXT_WINDOW)
+    return min(model_max_tokens.get(model, DEFAULT_MAX_TOKENS), window // 2)
+
+def context_budget(model, max_tokens):
+    """返回发送给模型的上下文的 token 预算"""
+    window = model_context_windows.get(model, DEFAULT_CONTEXT_WINDOW)
+    return max(min(window - max_tokens, CONTEXT_TOKEN_LIMIT), 1024)
 
 # 在文件开头添加特殊模型的提示词映射
 SPECIAL_MODELS_PROMPTS = {
@@ -617,14 +1134,52 @@ SPECIAL_MODELS_PROMPTS = {
     "o1-pro": ""
 }
 
-def stream_api_call(context):
-    """调用API并流式返回响应"""
+def open_upstream_stream(endpoint, data, model=None):
+    """向节点发送流式请求，返回可迭代文本增量的流；model 不为空时改用该模型"""
+    if model is not None:
+        data = dict(data, model=model)
     headers = {
-        "Authorization": f"Bearer {api_key_to_use}",
+        "Authorization": f"Bearer {endpoint.api_key}",
         "Content-Type": "application/json"
     }
+    if stream_engine is not None:
+        # 上游请求在共享事件循环的协程中执行，脚本线程只从队列中取出文本增量
+        return stream_engine.stream(endpoint.api_base, "/v1/chat/completions", headers=headers, json=data)
+    # 使用共享连接池，响应结束后连接归还给连接池复用
+    return http_pool.stream(endpoint.api_base, "/v1/chat/completions", headers=headers, json=data)
+
+def stream_api_call(context):
+    """调用API并流式返回响应
+
+    生成过程中显示停止按钮；点击后（或进行其他操作时）本次运行被中断，已经收到的部分回答
+    由 save_interrupted_response() 在下一次运行开始时保存。
+    """
+    max_tokens = max_tokens_for(model_to_use)
+    # 较长的文档只发送与最近一个问题相关的片段
+    query = retrieval_query(context)
+    session = st.session_state.sessions.get(st.session_state.current_session_id)
+    if session is not None and session.get('chat_context') is not context:
+        session = None
+    summary = valid_summary(session, context)
+    recalled = recall_memories(query)
+    
+    # 按模型的上下文窗口选取消息，文件引用在估算和发送前展开；较早对话的摘要和其他会话中
+    # 相关的问答作为系统消息放入
+    context_window, simplified_context, evicted_until = build_context(
+        context,
+        context_budget(model_to_use, max_tokens),
+        resolve=lambda msg: resolve_blob_refs([msg], query)[0],
+        oversize_policy=CONTEXT_OVERSIZE_POLICY,
+        summary=summary['text'] if summary else None,
+        recalled=recalled
+    )
     
-    simplified_context = simplify_context(context)
+    # 在后台把新移出上下文的消息合并到摘要中，不影响本次请求
+    if summarizer is not None and session is not None:
+        summarizer.schedule(
+            st.session_state.user_id, st.session_state.current_session_id, session,
+            evicted_until, api_base_to_use, api_key_to_use
+        )
     
     # 检查是否是特殊模型，如果不是才添加系统提示词
     # if model_to_use not in SPECIAL_MODELS_PROMPTS and simplified_context[0]["role"] != "system":
@@ -633,84 +1188,125 @@ def stream_api_call(context):
     data = {
         "model": model_to_use,
         "messages": simplified_context,
-        "max_tokens": 1000,
+        "max_tokens": max_tokens,
         "stream": True
     }
     
+    st.session_state.last_stream_info = {}
+    
+    # 缓存键基于实际发送的内容（包括摘要和回忆），文件内容以 SHA-256 引用，不需要展开；
+    # 回忆的内容属于当前用户，这样的回答只缓存给当前用户
+    cache_key = None
+    cache_owner = st.session_state.user_id if recalled else None
+    own_key = not st.session_state.show_default['api_key']
+    if response_cache is not None and response_cache.enabled_for(model_to_use):
+        cache_key = make_cache_key(model_to_use, api_base_to_use, context_window, data["max_tokens"])
+        # 用户自己的密钥在上游接受之前不返回缓存的回答
+        cached = None
+        if not own_key or response_cache.key_verified(api_base_to_use, api_key_to_use):
+            cached = response_cache.get(cache_key, st.session_state.user_id)
+        if cached is not None:
+            cached_response, cached_finish_reason = cached
+            renderer = StreamRenderer(st.empty())
+            st.session_state.generating = {'session_id': st.session_state.current_session_id, 'renderer': renderer}
+            for content in replay(cached_response):
+                renderer.feed(content)
+            st.session_state.last_stream_info = {
+                'finish_reason': cached_finish_reason,
+                'usage': None,
+                'events': 0,
+                'cached': True
+            }
+            return renderer.finish()
+    
     try:
-        url = f"{api_base_to_use}/v1/chat/completions"
-        response = requests.post(url, headers=headers, json=data, stream=True)
-        response.raise_for_status()
+        # 点击停止按钮会中断本次运行，离开 with 语句时取消上游请求并关闭连接
+        stop_placeholder = st.empty()
+        stop_placeholder.button("⏹️ 停止生成", key="stop_generation")
+        # 等待上游输出期间定时更新这个占位元素，停止按钮的中断在 st.* 调用时才会生效
+        heartbeat = st.empty()
         
-        full_response = ""
-        response_container = st.empty()
+        # 增量处理LaTeX并按时间/字符数节流刷新界面
+        renderer = StreamRenderer(st.empty())
+        st.session_state.generating = {'session_id': st.session_state.current_session_id, 'renderer': renderer}
         
-        for line in response.iter_lines():
-            if line:
-                try:
-                    chunk = json.loads(line.decode('utf-8').split('data: ')[1])
-                    if 'choices' in chunk and len(chunk['choices']) > 0:
-                        if 'delta' in chunk['choices'][0] and 'content' in chunk['choices'][0]['delta']:
-                            content = chunk['choices'][0]['delta']['content']
-                            full_response += content
-                            processed_response = post_process_latex(full_response)
-                            response_container.markdown(processed_response)
-                except json.JSONDecodeError:
-                    continue
-                except IndexError:
-                    continue
+        # 使用默认密钥时可以故障转移到配置的其他节点，用户自己的密钥只发送到用户的节点
+        endpoints = endpoints_for(
+            endpoint_config, model_to_use, api_base_to_use, api_key_to_use,
+            include_configured=st.session_state.show_default['api_key']
+        )
+        with FailoverStream(
+            endpoint_router, endpoints, lambda endpoint, model=None: open_upstream_stream(endpoint, data, model),
+            max_attempts=UPSTREAM_MAX_ATTEMPTS,
+            hedge=hedge_policy,
+            hedge_model=hedge_fallback_models.get(model_to_use)
+        ) as stream:
+            # 等待上游时脚本线程每 STOP_POLL_INTERVAL 秒至少调用一次 st.*
+            for content in stream.poll(STOP_POLL_INTERVAL):
+                if content is None:
+                    heartbeat.empty()
+                else:
+                    renderer.feed(content)
+        stop_placeholder.empty()
         
-        return post_process_latex(full_response)
+        st.session_state.last_stream_info = {
+            'finish_reason': stream.finish_reason,
+            'usage': stream.usage,
+            'events': stream.events,
+            'endpoint': stream.endpoint.api_base if stream.endpoint else None,
+            'attempts': stream.attempts,
+            'hedged': stream.hedged,
+            'model': stream.model
+        }
+        if response_cache is not None and own_key:
+            response_cache.verify_key(api_base_to_use, api_key_to_use)
+        # 由备用模型给出的回答不缓存到原模型名下
+        if cache_key is not None and stream.model is None:
+            response_cache.put(cache_key, model_to_use, renderer.raw_text(), stream.finish_reason, owner=cache_owner)
+        return renderer.finish()
     except Exception as e:
         return f"API请求错误: {str(e)}"
 
-# 在process_document函数之前添加新的辅助函数
-def compress_image(image_data, max_size_mb=2):
-    """压缩图片到指定大小以下"""
-    import io
-    from PIL import Image
-    
-    # 将bytes转换为PIL Image对象
-    image = Image.open(io.BytesIO(image_data))
-    
-    # 初始压缩质量
-    quality = 95
-    output = io.BytesIO()
-    
-    # 如果是PNG，转换为JPEG以获得更好的压缩
-    if image.format == 'PNG':
-        # 如果有透明通道，先将背景转为白色
-        if image.mode in ('RGBA', 'LA'):
-            background = Image.new('RGB', image.size, (255, 255, 255))
-            background.paste(image, mask=image.split()[-1])
-            image = background
-        else:
-            image = image.convert('RGB')
-    
-    # 保存图片并检查大小
-    image.save(output, format='JPEG', quality=quality)
+def extract_pdf_text(data, pdf_pages=None):
+    """分页并行提取PDF文本，提取过程中显示进度和已提取的内容"""
+    page_count = run_ingest('pdf', pdf_page_count, data)
+    try:
+        pages = parse_page_range(pdf_pages, page_count)
+    except ValueError as e:
+        st.error(f"页码范围格式错误（{str(e)}），请使用例如 1-20,35 的格式")
+        return None
+    if not pages:
+        st.error(f"页码范围超出文档页数（共 {page_count} 页）")
+        return None
     
-    # 如果大小超过限制，逐步降低质量直到满足要求
-    while output.tell() > max_size_mb * 1024 * 1024 and quality > 10:
-        output = io.BytesIO()
-        quality -= 5
-        image.save(output, format='JPEG', quality=quality)
+    progress = st.progress(0.0, text=f"正在提取PDF文本（共 {len(pages)} 页）...")
+    preview = st.empty()
+    texts = []
+    executor = ingestion.for_kind('pdf') if ingestion is not None else None
+    for page in iter_pdf_pages(data, pages, executor=executor, max_tokens=PDF_MAX_TOKENS):
+        texts.append(page.text)
+        progress.progress(len(texts) / len(pages), text=f"正在提取PDF文本：第 {page.index + 1} 页（{len(texts)}/{len(pages)}）")
+        preview.caption(page.text[-200:])
+    progress.empty()
+    preview.empty()
     
-    return output.getvalue()
+    text_content = "\n".join(texts) + "\n"
+    if len(texts) < len(pages):
+        text_content += f"\n（文档过长，只提取了前 {len(texts)} 页，共选择 {len(pages)} 页）\n"
+    if len(pages) < page_count:
+        text_content = f"（以下为第 {pdf_pages} 页的内容，文档共 {page_count} 页）\n" + text_content
+    return text_content
 
 # 修改process_document函数
-def process_document(file):
-    """处理上传的文档，提取文本内容"""
-    import io
-    import docx
-    import PyPDF2
-    from PIL import Image
-    import base64
-    import pandas as pd
+def process_document(file, pdf_pages=None):
+    """处理上传的文档，提取文本内容；pdf_pages 为PDF的页码范围，例如 "1-20,35"，为空时提取全部页
     
+    解析在解析服务的工作进程中执行，超时或超出内存上限时显示错误并返回 None。
+    """
     # 检查文件大小（50MB限制）
     MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB in bytes
-    if len(file.getvalue()) > MAX_FILE_SIZE:
+    data = file.getvalue()
+    if len(data) > MAX_FILE_SIZE:
         st.error(f"文件大小超过限制（50MB），请上传更小的文件。")
         return None
     
@@ -719,52 +1315,19 @@ def process_document(file):
     try:
         # 处理Excel文件
         if file_extension in ['xlsx', 'xls']:
-            df = pd.read_excel(file)
-            # 获取基本信息
-            info = {
-                'total_rows': len(df),
-                'total_columns': len(df.columns),
-                'column_names': list(df.columns),
-                'data_types': df.dtypes.to_dict(),
-                'preview': df.head().to_string(),
-                'description': df.describe().to_string(),
-                'missing_values': df.isnull().sum().to_dict()
-            }
             return {
                 'type': 'excel',
-                'data': info,
-                'raw_df': df
+                'data': cached_parse(data, 'excel', lambda: run_ingest('excel', parse_excel, data))
             }
             
         # 处理CSV文件
         elif file_extension == 'csv':
             # 尝试不同的编码方式读取CSV
-            encodings = ['utf-8', 'gbk', 'gb2312', 'iso-8859-1']
-            df = None
-            
-            for encoding in encodings:
-                try:
-                    df = pd.read_csv(io.StringIO(file.getvalue().decode(encoding)))
-                    break
-                except UnicodeDecodeError:
-                    continue
-                except Exception as e:
-                    continue
-            
-            if df is not None:
-                info = {
-                    'total_rows': len(df),
-                    'total_columns': len(df.columns),
-                    'column_names': list(df.columns),
-                    'data_types': df.dtypes.to_dict(),
-                    'preview': df.head().to_string(),
-                    'description': df.describe().to_string(),
-                    'missing_values': df.isnull().sum().to_dict()
-                }
+            info = cached_parse(data, 'csv', lambda: run_ingest('csv', parse_csv, data))
+            if info is not None:
                 return {
                     'type': 'csv',
-                    'data': info,
-                    'raw_df': df
+                    'data': info
                 }
             else:
                 st.error("无法读取CSV文件，请检查文件编码格式。")
@@ -772,27 +1335,22 @@ def process_document(file):
                 
         # 处理代码文件 - 添加html相关文件类型
         elif file_extension in ['py', 'c', 'cpp', 'h', 'hpp', 'm', 'swift', 'java', 'js', 'ts','html', 'htm', 'css', 'scss', 'less', 'jsx', 'tsx', 'vue', 'php']:  # 添加web文件类型
-            code_content = file.getvalue().decode('utf-8')
+            code_content = data.decode('utf-8')
             return code_content
             
         elif file_extension == 'pdf':
-            pdf_reader = PyPDF2.PdfReader(io.BytesIO(file.getvalue()))
-            text_content = ""
-            for page in pdf_reader.pages:
-                text_content += page.extract_text() + "\n"
-            return text_content
+            # 页码范围和提取上限不同时提取的文本不同，作为缓存键的一部分
+            return cached_parse(
+                data, 'pdf', lambda: extract_pdf_text(data, pdf_pages),
+                options={'pages': (pdf_pages or '').strip(), 'max_tokens': PDF_MAX_TOKENS}
+            )
             
         elif file_extension in ['doc', 'docx']:
-            doc = docx.Document(io.BytesIO(file.getvalue()))
-            text_content = ""
-            for para in doc.paragraphs:
-                text_content += para.text + "\n"
-            return text_content
+            return cached_parse(data, 'docx', lambda: run_ingest('docx', parse_docx, data))
             
         elif file_extension in ['png', 'jpg', 'jpeg']:
-            # 压缩图片
-            compressed_image = compress_image(file.getvalue())
-            return base64.b64encode(compressed_image).decode('utf-8')
+            # 压缩图片，返回JPEG字节，构建API请求时才转换为base64
+            return cached_parse(data, 'image', lambda: run_ingest('image', compress_image, data))
             
         else:
             return None
@@ -831,6 +1389,12 @@ with st.form(key="chat_form", clear_on_submit=True):
         key="file_uploader",
         help="支持的文件类型：图片(PNG/JPG)、文档(PDF/DOC/DOCX)、代码文件(PY/C/CPP/H/M等)、网页文件(HTML/CSS/JS等)、表格文件（xlsx/xls/csv）"
     )
+    pdf_pages = st.text_input(
+        "PDF页码范围",
+        key="pdf_pages",
+        placeholder="PDF页码范围（可选），例如 1-20,35",
+        label_visibility="collapsed"
+    )
     st.markdown('<style>div[data-testid="stFileUploader"] {margin-bottom: -15px;}</style>', unsafe_allow_html=True)
 
 # 处理聊天表单提交
@@ -897,34 +1461,52 @@ if chat_submit_button:
                         'user_input': user_input if user_input else ''
                     })
                     
+                    # 上传文件的消息固定在上下文中，之后的追问仍能看到文件内容
                     st.session_state.sessions[st.session_state.current_session_id]['chat_context'].append({
                         "role": "user", 
-                        "content": prompt
+                        "content": prompt,
+                        "pinned": True
                     })
                     
                     # 立即保存会话到数据库
-                    db.save_user_sessions(st.session_state.user_id, st.session_state.sessions)
+                    persistence.save(st.session_state.user_id, st.session_state.sessions)
                     
             elif file_extension in ['png', 'jpg', 'jpeg']:
-                image_base64 = process_document(uploaded_file)
-                image_url = f"data:image/jpeg;base64,{image_base64}"
-                # 修改存储方式，保存文件名和base64数据
-                st.session_state.sessions[st.session_state.current_session_id]['chat_history'].append({
-                    'type': 'image',
-                    'filename': uploaded_file.name,
-                    'data': image_base64
-                })
-                st.session_state.sessions[st.session_state.current_session_id]['chat_context'].append({
-                    "role": "user", 
-                    "content": [
-                        {"type": "text", "text": user_input if user_input else "请分析这张图片"},
-                        {"type": "image_url", "image_url": {"url": image_url}}
-                    ]
-                })
+                image_data = process_document(uploaded_file)
+                if image_data:
+                    # 图片保存到文件存储，消息中只保存引用
+                    digest = db.put_blob(image_data, 'image/jpeg')
+                    st.session_state.sessions[st.session_state.current_session_id]['chat_history'].append({
+                        'type': 'image',
+                        'filename': uploaded_file.name,
+                        'blob': digest
+                    })
+                    st.session_state.sessions[st.session_state.current_session_id]['chat_context'].append({
+                        "role": "user", 
+                        "content": [
+                            {"type": "text", "text": user_input if user_input else "请分析这张图片"},
+                            {"type": "image_url", "image_url": {"url": f"{BLOB_URL_PREFIX}{digest}"}}
+                        ]
+                    })
             else:
-                document_content = process_document(uploaded_file)
+                document_content = process_document(uploaded_file, pdf_pages)
                 if document_content:
-                    prompt = f"""请分析以下文档内容：\n\n{document_content}\n\n"""
+                    # 文档内容保存到文件存储，提示词中只保存引用
+                    digest = db.put_blob(document_content, 'text/plain')
+                    content_ref = blob_ref(digest)
+                    if estimate_text_tokens(document_content) > DOC_INLINE_TOKENS:
+                        # 较长的文档分块建立 BM25 索引，之后每次提问只发送相关的片段
+                        try:
+                            # 缓存的是索引在文件存储中的 SHA-256，相同的文档不再重建索引
+                            index_digest = cached_parse(
+                                document_content.encode('utf-8'), 'index',
+                                lambda: db.put_blob(run_ingest('index', build_document_index, document_content), 'application/json'),
+                                options={'index_version': INDEX_VERSION}
+                            )
+                            content_ref = doc_ref(index_digest)
+                        except Exception as e:
+                            print(f"建立文档索引时出错: {str(e)}")
+                    prompt = f"""请分析以下文档内容：\n\n{content_ref}\n\n"""
                     if user_input:
                         prompt += f"用户的具体问题是：{user_input}"
                     else:
@@ -934,25 +1516,27 @@ if chat_submit_button:
                     st.session_state.sessions[st.session_state.current_session_id]['chat_history'].append({
                         'type': 'document',
                         'filename': uploaded_file.name,
-                        'content': document_content,
+                        'blob': digest,
                         'user_input': user_input if user_input else ''
                     })
+                    # 上传文件的消息固定在上下文中，之后的追问仍能看到文件内容
                     st.session_state.sessions[st.session_state.current_session_id]['chat_context'].append({
                         "role": "user", 
-                        "content": prompt
+                        "content": prompt,
+                        "pinned": True
                     })
         
         # 调用API
         with st.spinner('🤖 Cookie正在思考中...'):
             ai_response = stream_api_call(st.session_state.sessions[st.session_state.current_session_id]['chat_context'])
         
-        # 更新聊天历史和上下文
-        processed_response = post_process_latex(ai_response)
-        st.session_state.sessions[st.session_state.current_session_id]['chat_history'].append(f"AI: {processed_response}")
-        st.session_state.sessions[st.session_state.current_session_id]['chat_context'].append({"role": "assistant", "content": ai_response})
-        
-        # 保存会话数据
-        db.save_user_sessions(st.session_state.user_id, st.session_state.sessions)
+        # 更新聊天历史和上下文并保存
+        append_ai_response(
+            st.session_state.current_session_id,
+            ai_response,
+            "回答达到长度上限，已被截断" if st.session_state.last_stream_info.get('finish_reason') == 'length' else None
+        )
+        st.session_state.pop('generating', None)
         
         # 重新加载页面以显示新消息
         st.rerun()
@@ -979,7 +1563,7 @@ if clear_button:
     st.write(f"添加新会话后数量: {len(st.session_state.sessions)}")
     
     st.session_state.current_session_id = new_session_id
-    db.save_user_sessions(st.session_state.user_id, st.session_state.sessions)
+    persistence.save(st.session_state.user_id, st.session_state.sessions)
     st.rerun()
 
 # 添加声明
@@ -995,6 +1579,25 @@ st.markdown(
 with st.sidebar:
     st.markdown("## 会话管理")
     
+    # 搜索全部会话中的聊天记录
+    chat_search_query = st.text_input("🔍 搜索聊天记录", key="chat_search", placeholder="输入关键词搜索所有会话...")
+    if chat_search_query:
+        persistence.flush(st.session_state.user_id)
+        search_results = db.search_messages(st.session_state.user_id, chat_search_query)
+        if not search_results:
+            st.info("没有找到相关的聊天记录")
+        for i, hit in enumerate(search_results):
+            if st.button(f"📄 {hit['title']}", key=f"search_hit_{i}", use_container_width=True):
+                st.session_state.current_session_id = hit['session_id']
+                # 展开聊天历史窗口，确保命中的消息可见
+                if hit['seq'] is not None:
+                    total = db.count_messages(st.session_state.user_id, hit['session_id'])
+                    st.session_state.history_windows[hit['session_id']] = max(
+                        total - hit['seq'], CHAT_HISTORY_PAGE_SIZE
+                    )
+                st.rerun()
+            st.caption(hit['snippet'].replace('\n', ' '))
+    
     # 添加分类标签
     tab1, tab2 = st.tabs(["📑 全部会话", "⭐ 收藏夹"])
     
@@ -1059,7 +1662,7 @@ with st.sidebar:
                         ):
                             st.session_state.sessions[session_id]['is_favorite'] = not is_favorite
                             # 保存会话数据
-                            db.save_user_sessions(st.session_state.user_id, st.session_state.sessions)
+                            persistence.save(st.session_state.user_id, st.session_state.sessions)
                             st.rerun()
                     
                     with col3:
@@ -1070,15 +1673,7 @@ with st.sidebar:
                                 key=f"delete_btn_{session_id}",
                                 help="删除此会话"
                             ):
-                                del st.session_state.sessions[session_id]
-                                if session_id == st.session_state.current_session_id:
-                                    remaining_sessions = sorted(
-                                        st.session_state.sessions.items(),
-                                        key=lambda x: x[1]['timestamp'],
-                                        reverse=True
-                                    )
-                                    st.session_state.current_session_id = remaining_sessions[0][0]
-                                db.save_user_sessions(st.session_state.user_id, st.session_state.sessions)
+                                delete_session(session_id)
                                 st.rerun()               
     
     with tab2:
@@ -1121,7 +1716,7 @@ with st.sidebar:
                         help="取消收藏"
                     ):
                         st.session_state.sessions[session_id]['is_favorite'] = False
-                        db.save_user_sessions(st.session_state.user_id, st.session_state.sessions)
+                        persistence.save(st.session_state.user_id, st.session_state.sessions)
                         st.rerun()
                 
                 with col3:
@@ -1132,15 +1727,7 @@ with st.sidebar:
                             key=f"fav_delete_btn_{session_id}",
                             help="删除此会话"
                         ):
-                            del st.session_state.sessions[session_id]
-                            if session_id == st.session_state.current_session_id:
-                                remaining_sessions = sorted(
-                                    st.session_state.sessions.items(),
-                                    key=lambda x: x[1]['timestamp'],
-                                    reverse=True
-                                )
-                                st.session_state.current_session_id = remaining_sessions[0][0]
-                            db.save_user_sessions(st.session_state.user_id, st.session_state.sessions)
+                            delete_session(session_id)
                             st.rerun()
 
 # 在主要内容区域添加管理员面板
@@ -1148,18 +1735,22 @@ if hasattr(st.session_state, 'show_admin_panel') and st.session_state.show_admin
     st.markdown("# 👥 用户管理")
     
     # 添加搜索框
-    search_query = st.text_input("🔍 搜索用户", placeholder="输入用户名进行搜索...")
+    search_query = st.text_input("🔍 搜索用户", placeholder="输入用户名进行搜索（少于3个字符时匹配开头）...")
     
-    # 获取所有用户
-    users = db.get_all_users()
+    # 搜索条件变化时回到第一页
+    USERS_PAGE_SIZE = 50
+    if st.session_state.get('admin_search_query') != search_query:
+        st.session_state.admin_search_query = search_query
+        st.session_state.admin_user_page = 1
+    page = st.session_state.get('admin_user_page', 1)
     
-    # 如果有搜索查询，过滤用户列表
-    if search_query:
-        users = [user for user in users if search_query.lower() in user[1].lower()]
+    # 在数据库中搜索并分页获取用户
+    users, total_users = db.search_users(search_query, page=page, page_size=USERS_PAGE_SIZE)
+    total_pages = max((total_users + USERS_PAGE_SIZE - 1) // USERS_PAGE_SIZE, 1)
     
     # 显示搜索结果数量
     if search_query:
-        st.markdown(f"找到 **{len(users)}** 个匹配的用户")
+        st.markdown(f"找到 **{total_users}** 个匹配的用户")
     
     # 创建用户表格样式
     st.markdown("""
@@ -1222,13 +1813,57 @@ if hasattr(st.session_state, 'show_admin_panel') and st.session_state.show_admin
         # 删除按钮
         if username != "admin" and user_id != st.session_state.user_id:  # 防止删除默认管理员和当前用户
             if cols[5].button("删除", key=f"delete_{user_id}", type="secondary"):
+                # 先丢弃该用户排队中的会话保存；之后才到达的保存会因用户不存在而被跳过
+                persistence.discard(user_id)
                 success, message = db.delete_user(user_id)
                 if success:
+                    # 同时删除该用户的记忆文件（关闭回忆功能后留下的文件也一并删除）
+                    if memory_index is not None:
+                        memory_index.delete_user(user_id)
+                    else:
+                        delete_user_files(MEMORY_DIR, user_id)
+                    if response_cache is not None:
+                        response_cache.forget_owner(user_id)
                     st.success(f"用户 {username} 已删除")
                     st.rerun()
                 else:
                     st.error(message)
     
+    # 分页控件
+    page_cols = st.columns([1, 2, 1])
+    with page_cols[0]:
+        if st.button("⬅️ 上一页", disabled=page <= 1, use_container_width=True):
+            st.session_state.admin_user_page = page - 1
+            st.rerun()
+    with page_cols[1]:
+        st.markdown(f"<div style='text-align: center;'>共 {total_users} 个用户，第 {page}/{total_pages} 页</div>",
+                    unsafe_allow_html=True)
+    with page_cols[2]:
+        if st.button("下一页 ➡️", disabled=page >= total_pages, use_container_width=True):
+            st.session_state.admin_user_page = page + 1
+            st.rerun()
+    
+    # 上游节点健康状况
+    st.markdown("### 上游节点状态")
+    endpoint_health = endpoint_router.snapshot()
+    if endpoint_health:
+        state_labels = {'closed': '🟢 正常', 'half_open': '🟡 试探中', 'open': '🔴 已熔断'}
+        st.table([
+            {
+                "节点": api_base,
+                "状态": state_labels.get(health['state'], health['state']),
+                "首token延迟": f"{health['ttft_ms']:.0f}ms" if health['ttft_ms'] is not None else "-",
+                "P95首token": f"{health['ttft_p95_ms']:.0f}ms" if health['ttft_p95_ms'] is not None else "-",
+                "成功": health['successes'],
+                "失败": health['failures'],
+                "恢复倒计时": f"{health['reopen_in']:.0f}s" if health['reopen_in'] else "-",
+                "最近错误": health['last_error'] or "-"
+            }
+            for api_base, health in sorted(endpoint_health.items())
+        ])
+    else:
+        st.info("暂无上游请求记录")
+    
     # 添加返回按钮
     if st.button("返回主界面", type="primary"):
         st.session_state.show_admin_panel = False
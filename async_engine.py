@@ -0,0 +1,214 @@
+"""基于 asyncio 的上游流式请求引擎
+
+所有上游流式请求都在一个后台线程的共享事件循环中以协程方式执行，模型输出期间
+不占用额外的操作系统线程。Streamlit 脚本线程提交请求后，只从线程安全的队列中
+取出解析好的文本增量并渲染。
+
+依赖 aiohttp；未安装时 AVAILABLE 为 False，调用方应退回到同步的 HTTPClientPool。
+"""
+import asyncio
+import atexit
+import queue
+import threading
+
+from http_pool import CONNECT_TIMEOUT, READ_TIMEOUT, UpstreamError
+from sse import ChatCompletionStream
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+AVAILABLE = aiohttp is not None
+
+# 队列中表示流结束的标记
+_END = object()
+
+
+class StreamHandle:
+    """一次流式请求的同步视图
+
+    迭代时产出文本增量，上游出错时在迭代中抛出异常（连接失败和错误状态为 UpstreamError）；结束后 finish_reason、usage、
+    events 与 ChatCompletionStream 相同。离开 with 语句时若流尚未结束则取消请求。
+    """
+
+    def __init__(self, wait_timeout):
+        self._queue = queue.SimpleQueue()
+        self._future = None
+        self._lock = threading.Lock()
+        self._arrived = False
+        self._watchers = []
+        # 两次收到内容之间的最长等待时间（秒）
+        self.wait_timeout = wait_timeout
+        self.parser = ChatCompletionStream()
+
+    @property
+    def finish_reason(self):
+        return self.parser.finish_reason
+
+    @property
+    def usage(self):
+        return self.parser.usage
+
+    @property
+    def events(self):
+        return self.parser.events
+
+    def _put(self, item):
+        # 在事件循环线程中调用；第一个结果（增量、错误或结束）到达时通知 watch() 登记的队列
+        self._queue.put(item)
+        if not self._arrived:
+            with self._lock:
+                self._arrived = True
+                watchers, self._watchers = self._watchers, []
+            for results, token in watchers:
+                results.put(token)
+
+    def watch(self, results, token):
+        """第一个结果到达时把 token 放入 results；多个请求共用一个 results 即可等待最先有结果的一个"""
+        with self._lock:
+            if not self._arrived:
+                self._watchers.append((results, token))
+                return
+        results.put(token)
+
+    def poll(self, interval=None):
+        """产出文本增量；interval 不为 None 时，超过 interval 秒没有新的增量产出 None
+
+        调用方在两次等待之间可以做其他事情（例如让 Streamlit 处理停止按钮），不需要额外的线程。
+        """
+        idle = 0.0
+        while True:
+            timeout = self.wait_timeout - idle
+            if interval is not None:
+                timeout = min(timeout, interval)
+            try:
+                item = self._queue.get(timeout=max(timeout, 0))
+            except queue.Empty:
+                idle += timeout
+                if idle >= self.wait_timeout:
+                    self.cancel()
+                    raise UpstreamError("等待上游响应超时", retryable=True)
+                yield None
+                continue
+            idle = 0.0
+            if item is _END:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    def __iter__(self):
+        return self.poll()
+
+    def cancel(self):
+        """取消尚未结束的请求，并释放连接；可以在其他线程中调用，正在等待的迭代随即结束"""
+        if self._future is not None and not self._future.done():
+            self._future.cancel()
+            # 协程尚未开始时被取消不会放入结束标记
+            self._put(_END)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cancel()
+        return False
+
+
+class AsyncStreamEngine:
+    """在共享事件循环中执行上游流式请求
+
+    limit: 同时打开的上游连接总数上限，limit_per_host 为每个 api_base 的上限；
+    超出时新的请求在事件循环中排队等待空闲连接，而不占用线程。
+    """
+
+    def __init__(self, limit=200, limit_per_host=100, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT):
+        if not AVAILABLE:
+            raise RuntimeError("未安装 aiohttp，无法使用异步请求引擎")
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._lock = threading.Lock()
+        self._session = None
+        self._closed = False
+        self.stats = {'started': 0, 'active': 0, 'completed': 0, 'failed': 0, 'cancelled': 0}
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='stream-engine', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _get_session(self):
+        # 只在事件循环线程中调用
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host)
+            timeout = aiohttp.ClientTimeout(
+                total=None, sock_connect=self.connect_timeout, sock_read=self.read_timeout
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    def stream(self, api_base, path, **kwargs):
+        """提交一个流式 POST 请求，立即返回 StreamHandle
+
+        kwargs 直接传给 aiohttp 的 post()，例如 headers、json。
+        """
+        if self._closed:
+            raise RuntimeError("异步请求引擎已关闭")
+        handle = StreamHandle(wait_timeout=self.connect_timeout + self.read_timeout)
+        url = f"{api_base.rstrip('/')}{path}"
+        handle._future = asyncio.run_coroutine_threadsafe(self._run(handle, url, kwargs), self._loop)
+        return handle
+
+    async def _run(self, handle, url, kwargs):
+        put = handle._put
+        parser = handle.parser
+        with self._lock:
+            self.stats['started'] += 1
+            self.stats['active'] += 1
+        outcome = 'failed'
+        try:
+            async with self._get_session().post(url, **kwargs) as response:
+                if response.status >= 400:
+                    raise UpstreamError.from_status(
+                        response.status, response.reason, await response.text(), response.headers
+                    )
+                # 收到 [DONE] 后仍读完响应，连接才能归还给连接池复用
+                async for chunk in response.content.iter_any():
+                    contents = parser.feed(chunk)
+                    if contents:
+                        # 同一次读取中的多个增量合并后放入队列，减少跨线程唤醒
+                        put(contents[0] if len(contents) == 1 else ''.join(contents))
+            outcome = 'completed'
+        except asyncio.CancelledError:
+            outcome = 'cancelled'
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            put(UpstreamError(f"连接或读取失败: {str(e) or type(e).__name__}", retryable=True))
+        except Exception as e:
+            put(e)
+        finally:
+            with self._lock:
+                self.stats['active'] -= 1
+                self.stats[outcome] += 1
+            put(_END)
+
+    def close(self):
+        """关闭连接并停止事件循环（进程退出时自动调用）"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+
+        async def shutdown():
+            if self._session is not None:
+                await self._session.close()
+
+        try:
+            asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result(timeout=5)
+        except Exception:
+            pass
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
@@ -0,0 +1,129 @@
+"""密码哈希与登录限流
+
+bcrypt 计算在有界的线程池中执行（bcrypt 计算时会释放 GIL），同一时刻最多占用
+max_workers 个 CPU 核心，大量用户同时登录时不会拖慢其他用户的页面刷新。
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+import bcrypt
+
+# bcrypt 工作因子，可通过环境变量 BCRYPT_ROUNDS 调整；修改后用户下次登录时自动重新哈希
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+
+
+class PasswordHasherBusy(Exception):
+    """等待密码校验的请求过多"""
+
+
+class PasswordHasher:
+    """在有界线程池中执行 bcrypt 哈希和校验"""
+
+    def __init__(self, rounds=BCRYPT_ROUNDS, max_workers=2, max_pending=32, timeout=10.0):
+        self.rounds = rounds
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='bcrypt')
+        # 限制排队中的任务数量，超出时直接拒绝而不是无限排队
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PasswordHasherBusy("登录人数较多，请稍后重试")
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            raise PasswordHasherBusy("登录人数较多，请稍后重试")
+
+    def hash(self, password):
+        """返回密码的 bcrypt 哈希字符串"""
+        hashed = self._run(
+            lambda: bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=self.rounds))
+        )
+        return hashed.decode('utf-8')
+
+    def verify(self, password, hashed):
+        """校验密码是否与哈希匹配"""
+        return self._run(lambda: bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8')))
+
+    def needs_rehash(self, hashed):
+        """哈希使用的工作因子与当前配置不同时需要重新哈希"""
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+
+class LoginThrottle:
+    """按用户名和IP限制登录失败的次数
+
+    - 同一用户名在 window 秒内失败 max_failures 次后锁定，锁定时间随失败次数翻倍；
+    - 同一IP在 window 秒内失败 max_failures_per_ip 次后锁定。只计算失败的登录：
+      一个班的学生可能共用同一个出口IP，同时正常登录不应该被限制。
+    """
+
+    def __init__(self, max_failures=5, max_failures_per_ip=100, window=300, base_lockout=30, max_lockout=900):
+        self.max_failures = max_failures
+        self.max_failures_per_ip = max_failures_per_ip
+        self.window = window
+        self.base_lockout = base_lockout
+        self.max_lockout = max_lockout
+        self._lock = threading.Lock()
+        self._failures = {}
+        self._locked_until = {}
+
+    def _keys(self, username, ip):
+        """返回 [(键, 失败次数上限), ...]"""
+        keys = [(f"user:{username.lower()}", self.max_failures)]
+        if ip:
+            keys.append((f"ip:{ip}", self.max_failures_per_ip))
+        return keys
+
+    def _prune(self, events, now):
+        while events and events[0] <= now - self.window:
+            events.popleft()
+
+    def _cleanup(self, now):
+        """清理已过期的记录，避免长时间运行后占用过多内存"""
+        for key in [key for key, value in self._failures.items() if not value or value[-1] <= now - self.window]:
+            del self._failures[key]
+        for key in [key for key, until in self._locked_until.items() if until <= now]:
+            del self._locked_until[key]
+
+    def check(self, username, ip=None):
+        """返回 (是否允许登录, 需要等待的秒数)"""
+        now = time.monotonic()
+        with self._lock:
+            if len(self._failures) > 10000:
+                self._cleanup(now)
+            for key, _ in self._keys(username, ip):
+                locked_until = self._locked_until.get(key, 0)
+                if locked_until > now:
+                    return False, int(locked_until - now) + 1
+        return True, 0
+
+    def record_failure(self, username, ip=None):
+        now = time.monotonic()
+        with self._lock:
+            for key, max_failures in self._keys(username, ip):
+                failures = self._failures.setdefault(key, deque())
+                self._prune(failures, now)
+                failures.append(now)
+                if len(failures) >= max_failures:
+                    excess = len(failures) - max_failures
+                    lockout = min(self.base_lockout * (2 ** excess), self.max_lockout)
+                    self._locked_until[key] = now + lockout
+
+    def record_success(self, username, ip=None):
+        with self._lock:
+            key = f"user:{username.lower()}"
+            self._failures.pop(key, None)
+            self._locked_until.pop(key, None)
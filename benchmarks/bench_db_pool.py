@@ -0,0 +1,88 @@
+"""对比连接池（WAL）与每次调用新建连接（默认回滚日志）的数据库性能
+
+模拟多个用户同时登录并聊天：每次登录执行 load_user_sessions、load_user_settings、
+verify_admin，每轮对话追加两条消息并保存。
+
+用法: python benchmarks/bench_db_pool.py [--users 16] [--turns 20]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from database import Database  # noqa: E402
+from session_tracker import SessionStore  # noqa: E402
+
+
+class PerCallDatabase(Database):
+    """改动前的行为：每次方法调用都新建一个默认配置的连接"""
+
+    def get_connection(self):
+        return sqlite3.connect(self.db_file, timeout=5)
+
+
+def run(db_class, db_file, users, turns):
+    db = db_class(db_file)
+    errors = []
+    latencies = []
+    lock = threading.Lock()
+
+    def user_worker(user_id):
+        try:
+            start = time.perf_counter()
+            db.load_user_sessions(user_id)
+            db.load_user_settings(user_id)
+            db.verify_admin(user_id)
+            login_time = time.perf_counter() - start
+
+            sessions = SessionStore()
+            sessions['default'] = {'chat_history': [], 'chat_context': [],
+                                   'timestamp': '2024-01-01 00:00:00', 'title': '新会话'}
+            for turn in range(turns):
+                session = sessions['default']
+                session['chat_history'].append(f"你: 问题 {turn}")
+                session['chat_history'].append(f"AI: {'回答' * 200}")
+                session['chat_context'].append({"role": "user", "content": f"问题 {turn}"})
+                session['chat_context'].append({"role": "assistant", "content": '回答' * 200})
+                if not db.save_user_sessions(user_id, sessions):
+                    raise RuntimeError("保存失败")
+                db.load_user_settings(user_id)
+            with lock:
+                latencies.append(login_time)
+        except Exception as e:
+            with lock:
+                errors.append(str(e))
+
+    threads = [threading.Thread(target=user_worker, args=(i + 100,)) for i in range(users)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000 if latencies else float('nan')
+    print(f"{db_class.__name__:16s} 总耗时 {elapsed:7.3f}s  登录查询 p50 {p50:6.2f}ms  错误 {len(errors)}")
+    if errors:
+        print(f"  示例错误: {errors[0]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=16)
+    parser.add_argument('--turns', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        run(PerCallDatabase, os.path.join(tmp, 'per_call.db'), args.users, args.turns)
+        run(Database, os.path.join(tmp, 'pooled.db'), args.users, args.turns)
+
+
+if __name__ == '__main__':
+    main()
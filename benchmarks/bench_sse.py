@@ -0,0 +1,96 @@
+"""对比两种流式响应解析方式的CPU开销
+
+- 改动前：response.iter_lines() 后对每一行 split('data: ') 并 json.loads
+- ChatCompletionStream：按SSE规则直接解析原始字节块
+
+两种方式都从同一个 requests.Response（底层为内存中的字节流）读取，
+模拟一段 4096 个 token 的流式响应，夹带心跳注释、usage 帧和 [DONE]。
+
+用法: python benchmarks/bench_sse.py [--tokens 4096] [--repeat 20] [--read-size 512]
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sse import ChatCompletionStream  # noqa: E402
+
+def build_stream(tokens):
+    parts = []
+    for i in range(tokens):
+        if i % 200 == 0:
+            parts.append(b': keep-alive\n\n')
+        chunk = {
+            "id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": 0, "model": "bench",
+            "choices": [{"index": 0, "delta": {"content": f"词{i % 97} "}, "finish_reason": None}]
+        }
+        parts.append(b'data: ' + json.dumps(chunk, ensure_ascii=False).encode('utf-8') + b'\n\n')
+    final = {"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+             "usage": {"prompt_tokens": 10, "completion_tokens": tokens, "total_tokens": tokens + 10}}
+    parts.append(b'data: ' + json.dumps(final).encode('utf-8') + b'\n\n')
+    parts.append(b'data: [DONE]\n\n')
+    return b''.join(parts)
+
+
+def make_response(body):
+    response = requests.Response()
+    response.raw = io.BytesIO(body)
+    response.status_code = 200
+    return response
+
+
+def legacy(body, read_size):
+    full_response = ""
+    for line in make_response(body).iter_lines(chunk_size=read_size):
+        if line:
+            try:
+                chunk = json.loads(line.decode('utf-8').split('data: ')[1])
+                if 'choices' in chunk and len(chunk['choices']) > 0:
+                    if 'delta' in chunk['choices'][0] and 'content' in chunk['choices'][0]['delta']:
+                        full_response += chunk['choices'][0]['delta']['content']
+            except json.JSONDecodeError:
+                continue
+            except IndexError:
+                continue
+    return full_response
+
+
+def decoder(body, read_size):
+    stream = ChatCompletionStream(make_response(body).iter_content(chunk_size=read_size))
+    text = "".join(stream)
+    assert stream.finish_reason == 'stop' and stream.done and stream.usage
+    return text
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tokens', type=int, default=4096)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--read-size', type=int, default=512, help="每次读取的字节数，与 http_pool.STREAM_READ_SIZE 相同")
+    args = parser.parse_args()
+
+    body = build_stream(args.tokens)
+    methods = (("改动前", legacy), ("ChatCompletionStream", decoder))
+    results = {}
+    best = {name: float('inf') for name, _ in methods}
+    # 两种方式交替运行并取最短耗时，减少机器负载波动的影响
+    for _ in range(args.repeat):
+        for name, fn in methods:
+            start = time.process_time()
+            results[name] = fn(body, args.read_size)
+            best[name] = min(best[name], time.process_time() - start)
+    for name, _ in methods:
+        elapsed = best[name]
+        print(f"{name:22s} 每次 {elapsed * 1000:7.2f}ms  每个token {elapsed / args.tokens * 1e6:6.2f}µs")
+    assert results["改动前"] == results["ChatCompletionStream"], "两种方式的输出不一致"
+    print(f"输出一致，共 {len(results['改动前'])} 个字符，{len(body) / 1024:.0f} KB")
+
+
+if __name__ == '__main__':
+    main()
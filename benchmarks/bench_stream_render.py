@@ -0,0 +1,97 @@
+"""对比流式输出的两种渲染方式
+
+- 改动前：每个 delta 都把文本拼接到 full_response，重新对全文执行 post_process_latex 并刷新界面
+- StreamRenderer：已完成的行只处理一次，按时间/字符数节流刷新
+
+使用一段固定随机种子生成的 4096 个 token 的流（含 Markdown 段落、列表和 LaTeX 公式），
+按真实流式速度的节奏（每个 token 间隔 --token-interval 秒，默认不等待）回放。
+
+用法: python benchmarks/bench_stream_render.py [--tokens 4096] [--token-interval 0.01]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from stream_render import StreamRenderer, post_process_latex  # noqa: E402
+
+WORDS = ["梯度", "下降", "是", "一种", "优化", "算法", "，", "。", "我们", "可以", "通过", "the", "model",
+         "loss", "function", "计算", "参数", "更新", " "]
+FORMULAS = ["\\[ \\theta_{t+1} = \\theta_t - \\eta \\nabla L(\\theta_t) \\]", "\\(x^2\\)", "$$E=mc^2$$",
+            "\\begin{aligned} a &= b \\\\ c &= d \\end{aligned}"]
+
+
+def recorded_stream(tokens, seed=42):
+    """生成固定的 token 序列，模拟一次较长的模型回答"""
+    rng = random.Random(seed)
+    chunks = []
+    while len(chunks) < tokens:
+        r = rng.random()
+        if r < 0.03:
+            chunks.append("\n\n")
+        elif r < 0.05:
+            chunks.append("\n- ")
+        elif r < 0.07:
+            # 公式被拆成多个 token 到达
+            formula = rng.choice(FORMULAS)
+            step = rng.randint(2, 5)
+            chunks.extend(formula[i:i + step] for i in range(0, len(formula), step))
+        else:
+            chunks.append(rng.choice(WORDS))
+    return chunks[:tokens]
+
+
+class CountingContainer:
+    """记录刷新次数和发送到前端的字符数"""
+
+    def __init__(self):
+        self.calls = 0
+        self.chars = 0
+
+    def markdown(self, text):
+        self.calls += 1
+        self.chars += len(text)
+
+
+def legacy(chunks, container, interval):
+    full_response = ""
+    for content in chunks:
+        full_response += content
+        container.markdown(post_process_latex(full_response))
+        if interval:
+            time.sleep(interval)
+    return post_process_latex(full_response)
+
+
+def incremental(chunks, container, interval):
+    renderer = StreamRenderer(container)
+    for content in chunks:
+        renderer.feed(content)
+        if interval:
+            time.sleep(interval)
+    return renderer.finish()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tokens', type=int, default=4096)
+    parser.add_argument('--token-interval', type=float, default=0.0)
+    args = parser.parse_args()
+
+    chunks = recorded_stream(args.tokens)
+    results = {}
+    for name, fn in (("改动前", legacy), ("StreamRenderer", incremental)):
+        container = CountingContainer()
+        start = time.process_time()
+        results[name] = fn(chunks, container, args.token_interval)
+        cpu = time.process_time() - start
+        print(f"{name:15s} CPU {cpu * 1000:8.1f}ms  刷新 {container.calls:5d} 次  发送 {container.chars / 1024:9.1f} KB")
+    assert results["改动前"] == results["StreamRenderer"], "两种方式的输出不一致"
+    print(f"输出一致，共 {len(results['改动前'])} 个字符")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+"""按 token 预算组装发送给模型的上下文
+
+每条消息的 token 数按字符粗略估算（ASCII 约 4 个字符 1 个 token，中文等其他字符约
+1 个字符 1 个 token，图片按固定值计算），估算结果按消息内容缓存在模块内的 LRU 中，
+不写入消息本身，因此不会被保存到数据库，消息被修改后也不会读到过期的结果。
+组装时依次放入系统消息、固定的消息（例如上传的文档）和最近的消息，直到用完预算；
+单条消息超出上限时按策略截断或省略。
+"""
+import threading
+from collections import OrderedDict
+
+# 缓存多少条消息内容的估算结果（所有用户共用）
+TOKEN_CACHE_SIZE = 4096
+# 发送给API的消息字段
+API_MESSAGE_KEYS = ('role', 'content', 'name')
+# 每条消息的格式开销
+MESSAGE_OVERHEAD_TOKENS = 4
+# 每张图片按高清模式下一张 512x512 切片的数量估算
+IMAGE_TOKENS = 765
+# 单条消息最多占用预算的比例，超出时按策略截断或省略
+MAX_MESSAGE_SHARE = 0.6
+# 固定的消息最多占用预算的比例
+MAX_PINNED_SHARE = 0.5
+
+TRUNCATED_MARKER = "\n\n……（内容过长，已省略中间约 {} 个字符）……\n\n"
+ELIDED_MARKER = "（较早的文档内容过长，已省略）"
+SUMMARY_PREFIX = "以下是本次对话较早内容的摘要，供参考：\n"
+RECALLED_PREFIX = "以下是用户在之前的其他对话中讨论过的相关内容，仅在与当前问题有关时参考：\n"
+
+
+def estimate_text_tokens(text):
+    """粗略估算一段文本的 token 数"""
+    ascii_count = len(text.encode('ascii', errors='ignore'))
+    return (ascii_count + 3) // 4 + len(text) - ascii_count
+
+
+_token_cache = OrderedDict()
+_token_cache_lock = threading.Lock()
+
+
+def _content_key(content):
+    """消息内容的缓存键：文本本身（字符串的哈希值由 Python 缓存），图片只记录位置
+
+    内容无法作为键时返回 None，不使用缓存。
+    """
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return tuple(
+            None if part.get('type') == 'image_url' else part.get('text', '')
+            for part in content if isinstance(part, dict)
+        )
+    return None
+
+
+def estimate_message_tokens(message, resolve=None):
+    """估算一条消息的 token 数，相同内容的估算结果被缓存
+
+    resolve(message) 返回展开文件引用后的消息，估算基于展开后的内容。
+    """
+    key = _content_key(message.get('content'))
+    if key is not None:
+        with _token_cache_lock:
+            tokens = _token_cache.get(key)
+            if tokens is not None:
+                _token_cache.move_to_end(key)
+                return tokens
+
+    resolved = resolve(message) if resolve else message
+    tokens = MESSAGE_OVERHEAD_TOKENS + _count_content_tokens(resolved.get('content'))
+    if key is not None:
+        with _token_cache_lock:
+            _token_cache[key] = tokens
+            if len(_token_cache) > TOKEN_CACHE_SIZE:
+                _token_cache.popitem(last=False)
+    return tokens
+
+
+def _count_content_tokens(content):
+    if isinstance(content, str):
+        return estimate_text_tokens(content)
+    tokens = 0
+    for part in content or ():
+        if part.get('type') == 'image_url':
+            tokens += IMAGE_TOKENS
+        else:
+            tokens += estimate_text_tokens(part.get('text', ''))
+    return tokens
+
+
+def api_message(message):
+    """只保留发送给API的字段"""
+    return {key: message[key] for key in API_MESSAGE_KEYS if key in message}
+
+
+def truncate_message(message, max_tokens, policy='truncate'):
+    """把超出 max_tokens 的消息截断（保留开头和结尾）或省略，返回新的消息"""
+    if policy == 'elide':
+        return dict(message, content=ELIDED_MARKER)
+
+    content = message.get('content')
+    if isinstance(content, list):
+        parts = []
+        for part in content:
+            if part.get('type') == 'text':
+                part = dict(part, text=_truncate_text(part.get('text', ''), max_tokens))
+            parts.append(part)
+        return dict(message, content=parts)
+    return dict(message, content=_truncate_text(content or '', max_tokens))
+
+
+def _truncate_text(text, max_tokens):
+    tokens = estimate_text_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    # 按估算的 token 密度换算保留的字符数，开头保留 2/3，结尾保留 1/3
+    keep = max(int(len(text) * max_tokens / tokens) - len(TRUNCATED_MARKER), 0)
+    head = keep * 2 // 3
+    tail = keep - head
+    omitted = len(text) - head - tail
+    return text[:head] + TRUNCATED_MARKER.format(omitted) + (text[-tail:] if tail else '')
+
+
+def build_context(context, budget_tokens, resolve=None, oversize_policy='truncate', summary=None, recalled=None):
+    """从完整的对话上下文中选出在预算内发送给模型的消息
+
+    返回 (window, messages, evicted_until)：window 与 messages 一一对应，是未展开文件引用的发送内容
+    （包括摘要和回忆，被截断的消息带有截断方式的标记），可用于计算缓存键；messages 为展开文件引用、
+    按需截断并去掉内部字段后可直接发送的消息，
+    evicted_until 为最近消息中最早被放入的一条的下标，之前的普通消息都没有被发送。
+
+    - 系统消息总是保留；summary 为较早对话的摘要文本，recalled 为从其他会话中找到的相关内容，
+      依次作为系统消息放在其后；
+    - 带有 pinned 标记的消息（例如上传的文档）从新到旧放入，最多占用 MAX_PINNED_SHARE 的预算；
+    - 其余预算从最新的消息开始向前放入，最新的一条消息总是保留；
+    - 单条消息超过 MAX_MESSAGE_SHARE 的预算时，最新的消息和固定的消息被截断，
+      更早的消息按 oversize_policy 截断（truncate）或省略（elide）。
+    """
+    resolved = {}
+
+    def resolve_once(message):
+        # 同一条消息的文件引用只展开一次
+        key = id(message)
+        if key not in resolved:
+            resolved[key] = resolve(message) if resolve else message
+        return resolved[key]
+
+    max_message_tokens = int(budget_tokens * MAX_MESSAGE_SHARE)
+    remaining = budget_tokens
+    # 下标 -> (未展开引用的发送内容, 发送的消息)
+    selected = {}
+
+    def take(index, message, policy, limit, force=False):
+        """放入一条消息；放不下时返回 False
+
+        超过 limit 的消息按 policy 处理；force 为 True 时，预算不足也截断后放入。
+        """
+        nonlocal remaining
+        tokens = estimate_message_tokens(message, resolve_once)
+        allowed = min(limit, remaining)
+        if tokens <= allowed:
+            selected[index] = (api_message(message), api_message(resolve_once(message)))
+            remaining -= tokens
+            return True
+        if tokens <= limit and not force or allowed <= MESSAGE_OVERHEAD_TOKENS:
+            return False
+        sent = truncate_message(api_message(resolve_once(message)), allowed - MESSAGE_OVERHEAD_TOKENS, policy)
+        remaining -= MESSAGE_OVERHEAD_TOKENS + _count_content_tokens(sent['content'])
+        # 截断结果由原始内容、方式和长度决定，缓存键中记录后两者即可
+        selected[index] = (dict(api_message(message), truncated=[policy, allowed - MESSAGE_OVERHEAD_TOKENS]), sent)
+        return True
+
+    for index, message in enumerate(context):
+        if message.get('role') == 'system':
+            take(index, message, 'truncate', max_message_tokens, force=True)
+
+    # 摘要和回忆的内容放在原有系统消息之后、其他消息之前
+    first_index = next((i for i, m in enumerate(context) if m.get('role') != 'system'), len(context))
+    if summary:
+        take(first_index - 0.5, {"role": "system", "content": SUMMARY_PREFIX + summary}, 'truncate',
+             max_message_tokens, force=True)
+    if recalled:
+        take(first_index - 0.25, {"role": "system", "content": RECALLED_PREFIX + recalled}, 'truncate',
+             max_message_tokens, force=True)
+
+    last_index = len(context) - 1
+    if last_index >= 0 and last_index not in selected:
+        take(last_index, context[last_index], 'truncate', max_message_tokens, force=True)
+
+    pinned_budget = int(budget_tokens * MAX_PINNED_SHARE)
+    for index in range(last_index - 1, -1, -1):
+        message = context[index]
+        if index in selected or not message.get('pinned'):
+            continue
+        before = remaining
+        if not take(index, message, 'truncate', min(max_message_tokens, pinned_budget), force=True):
+            break
+        pinned_budget -= before - remaining
+
+    evicted_until = max(last_index, 0)
+    for index in range(last_index - 1, -1, -1):
+        if index in selected:
+            continue
+        if not take(index, context[index], oversize_policy, max_message_tokens):
+            break
+        evicted_until = index
+    else:
+        evicted_until = 0
+
+    window = []
+    messages = []
+    for index in sorted(selected):
+        unexpanded, sent = selected[index]
+        # 对话不能以助手的回复开头
+        if not messages or messages[-1]['role'] == 'system':
+            if sent.get('role') == 'assistant':
+                window.append({"role": "user", "content": "继续我们的对话。"})
+                messages.append({"role": "user", "content": "继续我们的对话。"})
+        window.append(unexpanded)
+        messages.append(sent)
+    return window, messages, evicted_until
@@ -1,15 +1,133 @@
 import sqlite3
-import bcrypt
 from datetime import datetime
 import json
+import hashlib
+import queue
+import threading
+from auth import PasswordHasher
+from session_tracker import MESSAGE_KINDS, SessionStore
+
+
+class PooledConnection:
+    """连接池中的连接，close() 时归还给连接池而不是真正关闭"""
+    
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+    
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+    
+    def __enter__(self):
+        self._conn.__enter__()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        return self._conn.__exit__(exc_type, exc_value, traceback)
+    
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.release(conn)
+
+
+class ConnectionPool:
+    """线程安全的 SQLite 连接池
+
+    连接使用 WAL 日志模式，读操作不会被写操作阻塞；写事务以 BEGIN IMMEDIATE 开始，
+    遇到锁时在 busy_timeout 内等待，而不是立即报 database is locked。
+    """
+    
+    def __init__(self, db_file, max_size=8, acquire_timeout=10.0, busy_timeout_ms=5000,
+                 cache_size_kb=16384, mmap_size=256 * 1024 * 1024):
+        self.db_file = db_file
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+    
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.db_file,
+            timeout=self.busy_timeout_ms / 1000,
+            isolation_level='IMMEDIATE',
+            check_same_thread=False
+        )
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute(f'PRAGMA cache_size = -{int(self.cache_size_kb)}')
+        conn.execute(f'PRAGMA mmap_size = {int(self.mmap_size)}')
+        conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout_ms)}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        return conn
+    
+    def acquire(self):
+        """取出一个空闲连接，没有空闲连接时新建，达到上限则等待其他线程归还"""
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                can_create = self._created < self.max_size
+                if can_create:
+                    self._created += 1
+            if can_create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                try:
+                    conn = self._idle.get(timeout=self.acquire_timeout)
+                except queue.Empty:
+                    raise sqlite3.OperationalError("数据库连接池繁忙，请稍后重试")
+        return PooledConnection(self, conn)
+    
+    def release(self, conn):
+        """归还连接，未提交的事务会被回滚"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # 连接已损坏，丢弃它
+            with self._lock:
+                self._created -= 1
+            conn.close()
+            return
+        self._idle.put(conn)
+    
+    def close_all(self):
+        """关闭所有空闲连接"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._created -= 1
+            conn.close()
+
 
 class Database:
-    def __init__(self, db_file="chat_app.db"):
+    def __init__(self, db_file="chat_app.db", pool_size=8, hasher=None):
         self.db_file = db_file
+        self.pool = ConnectionPool(db_file, max_size=pool_size)
+        self.hasher = hasher or PasswordHasher()
+        # 是否支持用户名子串搜索和聊天记录全文搜索的 trigram 索引，在 init_db 中检测
+        self.user_search_fts = False
+        self.message_search_fts = False
+        # 会话保存的写入统计，用于确认每次只写入了变化的数据
+        self.write_stats = {'saves': 0, 'last_bytes': 0, 'total_bytes': 0}
         self.init_db()
     
     def get_connection(self):
-        return sqlite3.connect(self.db_file)
+        """从连接池取出连接，使用完毕后调用 close() 归还"""
+        return self.pool.acquire()
     
     def init_db(self):
         """初始化数据库表"""
@@ -26,6 +144,9 @@ class Database:
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
         ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_users_username_nocase ON users (username COLLATE NOCASE)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at)')
+        self._init_user_search_index(c)
         
         # 创建会话表
         c.execute('''
@@ -42,6 +163,44 @@ class Database:
         )
         ''')
         
+        # 会话表早期版本没有收藏字段，补齐缺失的列
+        c.execute('PRAGMA table_info(sessions)')
+        session_columns = {row[1] for row in c.fetchall()}
+        if 'is_favorite' not in session_columns:
+            c.execute('ALTER TABLE sessions ADD COLUMN is_favorite BOOLEAN DEFAULT 0')
+        # 较早对话内容的滚动摘要，JSON: {"text": 摘要, "upto": 摘要覆盖的上下文消息数}
+        if 'summary' not in session_columns:
+            c.execute('ALTER TABLE sessions ADD COLUMN summary TEXT')
+        
+        c.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_sessions_user_session
+        ON sessions (user_id, session_id)
+        ''')
+        c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_sessions_user_timestamp
+        ON sessions (user_id, timestamp)
+        ''')
+        
+        # 创建消息表，每条聊天记录/上下文消息单独一行
+        # kind 为 'history'（界面显示的聊天历史）或 'context'（发送给模型的上下文）
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            session_id TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TIMESTAMP,
+            UNIQUE (user_id, session_id, kind, seq),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''')
+        c.execute('''
+        CREATE INDEX IF NOT EXISTS idx_messages_user_timestamp
+        ON messages (user_id, timestamp)
+        ''')
+        
         # 创建用户设置表
         c.execute('''
         CREATE TABLE IF NOT EXISTS user_settings (
@@ -53,23 +212,241 @@ class Database:
         )
         ''')
         
+        # 创建内容寻址的文件存储表，上传的图片和文档按 SHA-256 去重保存
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS blobs (
+            sha256 TEXT PRIMARY KEY,
+            data BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            mime_type TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        
+        # 上游响应缓存：相同模型、接口和上下文的请求直接返回之前的回答
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS response_cache (
+            cache_key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            response TEXT NOT NULL,
+            finish_reason TEXT,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            last_used REAL NOT NULL,
+            owner INTEGER
+        )
+        ''')
+        # 上下文中带有某个用户私有内容（例如回忆的其他会话）的缓存只返回给该用户
+        c.execute('PRAGMA table_info(response_cache)')
+        if 'owner' not in {row[1] for row in c.fetchall()}:
+            c.execute('ALTER TABLE response_cache ADD COLUMN owner INTEGER')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_response_cache_last_used ON response_cache(last_used)')
+        
+        # 上传文件的解析结果缓存：相同内容的文件再次上传时不再解析
+        c.execute('''
+        CREATE TABLE IF NOT EXISTS parse_cache (
+            cache_key TEXT PRIMARY KEY,
+            encoding TEXT NOT NULL,
+            data BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            source_size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            last_used REAL NOT NULL
+        )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_parse_cache_last_used ON parse_cache(last_used)')
+        
         # 检查是否存在默认管理员账户
         c.execute('SELECT 1 FROM users WHERE username = "admin"')
         if not c.fetchone():
             # 创建默认管理员账户，密码为 "admin123"
-            hashed = bcrypt.hashpw("admin123".encode('utf-8'), bcrypt.gensalt())
+            hashed = self.hasher.hash("admin123")
             c.execute('''
             INSERT INTO users (username, password, is_admin)
             VALUES (?, ?, 1)
-            ''', ("admin", hashed.decode('utf-8')))
+            ''', ("admin", hashed))
+        
+        self._init_message_search_index(c)
+        
+        c.execute('PRAGMA user_version')
+        user_version = c.fetchone()[0]
+        # 一次性迁移旧版 user_sessions 表中的 JSON 数据
+        if user_version < 1:
+            self._migrate_user_sessions_blobs(c)
+            c.execute('PRAGMA user_version = 1')
+        # 为已有的聊天记录建立全文索引；SQLite 不支持 FTS5 时不更新版本，支持后再建立
+        if user_version < 2 and self.message_search_fts:
+            self._rebuild_message_search_index(c)
+            c.execute('PRAGMA user_version = 2')
         
         conn.commit()
         conn.close()
     
+    def _init_user_search_index(self, c):
+        """创建用户名子串搜索使用的 FTS5 trigram 索引，SQLite 不支持时退回 LIKE 扫描"""
+        c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users_fts'")
+        exists = c.fetchone() is not None
+        try:
+            c.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS users_fts
+            USING fts5(username, content='users', content_rowid='id', tokenize='trigram')
+            ''')
+        except sqlite3.OperationalError:
+            self.user_search_fts = False
+            return
+        self.user_search_fts = True
+        
+        # 通过触发器保持索引与 users 表同步
+        c.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN
+            INSERT INTO users_fts (rowid, username) VALUES (new.id, new.username);
+        END
+        ''')
+        c.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN
+            INSERT INTO users_fts (users_fts, rowid, username) VALUES ('delete', old.id, old.username);
+        END
+        ''')
+        c.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF username ON users BEGIN
+            INSERT INTO users_fts (users_fts, rowid, username) VALUES ('delete', old.id, old.username);
+            INSERT INTO users_fts (rowid, username) VALUES (new.id, new.username);
+        END
+        ''')
+        if not exists:
+            c.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+    
+    def _init_message_search_index(self, c):
+        """创建聊天记录和会话标题的全文索引
+
+        索引的 rowid 分别对应 messages.id 和 sessions.id；owner 列保存 "#用户ID#"，
+        搜索时与查询词一起 MATCH，只在当前用户的记录中查找。
+        """
+        try:
+            c.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+            USING fts5(text, owner, tokenize='trigram')
+            ''')
+            c.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS session_titles_fts
+            USING fts5(title, owner, tokenize='trigram')
+            ''')
+        except sqlite3.OperationalError:
+            self.message_search_fts = False
+            return
+        self.message_search_fts = True
+    
+    def _rebuild_message_search_index(self, c):
+        """根据 messages/sessions 表重建全文索引"""
+        if not self.message_search_fts:
+            return
+        c.execute('DELETE FROM messages_fts')
+        c.execute('DELETE FROM session_titles_fts')
+        c.execute('SELECT user_id, session_id, title FROM sessions')
+        for user_id, session_id, title in c.fetchall():
+            self._index_session_title(c, user_id, session_id, title)
+        c.execute("SELECT id, user_id, content FROM messages WHERE kind = 'history'")
+        rows = c.fetchall()
+        c.executemany(
+            'INSERT INTO messages_fts (rowid, text, owner) VALUES (?, ?, ?)',
+            [(msg_id, self._message_search_text(c, json.loads(content)), f"#{user_id}#")
+             for msg_id, user_id, content in rows]
+        )
+    
+    @staticmethod
+    def _message_search_text(c, msg):
+        """提取聊天历史中需要被搜索的文本，文档消息包括文档提取出的全文"""
+        if isinstance(msg, str):
+            return msg[3:] if msg.startswith(("你:", "AI:")) else msg
+        if not isinstance(msg, dict):
+            return ""
+        parts = [msg.get('filename', ''), msg.get('user_input', '')]
+        if msg.get('type') == 'document':
+            if 'blob' in msg:
+                c.execute('SELECT data FROM blobs WHERE sha256 = ?', (msg['blob'],))
+                result = c.fetchone()
+                if result:
+                    parts.append(bytes(result[0]).decode('utf-8', errors='replace'))
+            else:
+                parts.append(msg.get('content', ''))
+        elif msg.get('type') == 'data_analysis':
+            parts.append(' '.join(str(name) for name in msg.get('data_info', {}).get('column_names', [])))
+        return '\n'.join(part for part in parts if part)
+    
+    def _index_history(self, c, user_id, session_id, messages):
+        """为新写入或修改的聊天历史更新全文索引，messages 为 [(seq, msg), ...]"""
+        if not self.message_search_fts or not messages:
+            return
+        seqs = [seq for seq, _ in messages]
+        c.execute('''
+        SELECT seq, id FROM messages
+        WHERE user_id = ? AND session_id = ? AND kind = 'history' AND seq >= ? AND seq <= ?
+        ''', (user_id, session_id, min(seqs), max(seqs)))
+        ids = dict(c.fetchall())
+        rows = [(ids[seq], self._message_search_text(c, msg), f"#{user_id}#")
+                for seq, msg in messages if seq in ids]
+        c.executemany('DELETE FROM messages_fts WHERE rowid = ?', [(row[0],) for row in rows])
+        c.executemany('INSERT INTO messages_fts (rowid, text, owner) VALUES (?, ?, ?)', rows)
+    
+    def _unindex_history(self, c, user_id, session_id, from_seq=0):
+        """删除 seq >= from_seq 的聊天历史的全文索引，需要在删除消息之前调用"""
+        if not self.message_search_fts:
+            return
+        c.execute('''
+        DELETE FROM messages_fts WHERE rowid IN (
+            SELECT id FROM messages
+            WHERE user_id = ? AND session_id = ? AND kind = 'history' AND seq >= ?
+        )
+        ''', (user_id, session_id, from_seq))
+    
+    def _index_session_title(self, c, user_id, session_id, title):
+        """更新会话标题的全文索引"""
+        if not self.message_search_fts:
+            return
+        c.execute('SELECT id FROM sessions WHERE user_id = ? AND session_id = ?', (user_id, session_id))
+        result = c.fetchone()
+        if result:
+            c.execute('DELETE FROM session_titles_fts WHERE rowid = ?', (result[0],))
+            c.execute('INSERT INTO session_titles_fts (rowid, title, owner) VALUES (?, ?, ?)',
+                     (result[0], title or '', f"#{user_id}#"))
+    
+    def _unindex_session(self, c, user_id, session_id):
+        """删除整个会话的全文索引，需要在删除会话之前调用"""
+        if not self.message_search_fts:
+            return
+        self._unindex_history(c, user_id, session_id)
+        c.execute('''
+        DELETE FROM session_titles_fts WHERE rowid IN (
+            SELECT id FROM sessions WHERE user_id = ? AND session_id = ?
+        )
+        ''', (user_id, session_id))
+    
+    def _migrate_user_sessions_blobs(self, c):
+        """将旧版 user_sessions 表中每个用户的会话 JSON 拆分写入 sessions/messages 表"""
+        c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_sessions'")
+        if not c.fetchone():
+            return
+        
+        c.execute('SELECT user_id, sessions FROM user_sessions')
+        for user_id, sessions_json in c.fetchall():
+            if not sessions_json:
+                continue
+            # 已经有新格式数据的用户不再重复迁移
+            c.execute('SELECT 1 FROM sessions WHERE user_id = ? LIMIT 1', (user_id,))
+            if c.fetchone():
+                continue
+            try:
+                sessions = json.loads(sessions_json)
+            except json.JSONDecodeError as e:
+                print(f"迁移用户 {user_id} 的会话数据时出错: {str(e)}")
+                continue
+            prepared = self.prepare_session_changes(self._full_session_changes(c, user_id, sessions))
+            self._write_session_changes(c, user_id, prepared)
+    
     def register_user(self, username, password):
         """注册新用户"""
+        conn = self.get_connection()
         try:
-            conn = self.get_connection()
             c = conn.cursor()
             
             # 检查用户名是否已存在
@@ -77,12 +454,12 @@ class Database:
             if c.fetchone():
                 return False, "用户名已存在"
             
-            # 对密码进行加密
-            hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+            # 对密码进行加密（在密码哈希线程池中执行）
+            hashed = self.hasher.hash(password)
             
             # 插入新用户
             c.execute('INSERT INTO users (username, password) VALUES (?, ?)',
-                     (username, hashed.decode('utf-8')))
+                     (username, hashed))
             
             conn.commit()
             return True, "注册成功"
@@ -92,98 +469,589 @@ class Database:
             conn.close()
     
     def verify_user(self, username, password):
-        """验证用户登录"""
+        """验证用户登录
+
+        工作因子与当前配置不同的旧密码哈希会在登录成功后自动重新哈希。
+        密码校验请求过多时抛出 PasswordHasherBusy。
+        """
+        conn = self.get_connection()
         try:
-            conn = self.get_connection()
             c = conn.cursor()
-            
             c.execute('SELECT id, password FROM users WHERE username = ?', (username,))
             result = c.fetchone()
-            
-            if result and bcrypt.checkpw(password.encode('utf-8'), result[1].encode('utf-8')):
-                return True, result[0]  # 返回用户ID
+        finally:
+            # 校验密码耗时较长，先归还连接
+            conn.close()
+        
+        if not result or not self.hasher.verify(password, result[1]):
             return False, None
+        
+        if self.hasher.needs_rehash(result[1]):
+            hashed = self.hasher.hash(password)
+            conn = self.get_connection()
+            try:
+                c = conn.cursor()
+                c.execute('UPDATE users SET password = ? WHERE id = ? AND password = ?',
+                         (hashed, result[0], result[1]))
+                conn.commit()
+            except Exception as e:
+                print(f"更新密码哈希时出错: {str(e)}")
+            finally:
+                conn.close()
+        return True, result[0]  # 返回用户ID
+    
+    @staticmethod
+    def _process_history_message(msg):
+        """预处理单条聊天历史，确保可以序列化且大小合理"""
+        # 对于数据分析类型的消息，确保数据大小合理
+        if isinstance(msg, dict) and msg.get('type') == 'data_analysis':
+            return {
+                'type': 'data_analysis',
+                'filename': msg.get('filename', ''),
+                'file_type': msg.get('file_type', ''),
+                'data_info': {
+                    'total_rows': msg.get('data_info', {}).get('total_rows', 0),
+                    'total_columns': msg.get('data_info', {}).get('total_columns', 0),
+                    'column_names': msg.get('data_info', {}).get('column_names', []),
+                    'preview': msg.get('data_info', {}).get('preview', '')[:1000],  # 限制预览数据大小
+                    'description': msg.get('data_info', {}).get('description', '')[:1000]  # 限制描述数据大小
+                },
+                'user_input': msg.get('user_input', '')
+            }
+        # 其他类型的消息保持不变
+        return msg
+    
+    @staticmethod
+    def _full_session_changes(c, user_id, sessions):
+        """把普通字典形式的全部会话转换为 SessionStore.collect_changes() 的格式
+
+        字典被视为用户会话的完整快照：数据库中有而字典中没有的会话被删除，
+        其余会话的消息从头整体重写，原地修改和删除的消息都能正确保存。
+        """
+        c.execute('SELECT session_id FROM sessions WHERE user_id = ?', (user_id,))
+        deleted = [row[0] for row in c.fetchall() if row[0] not in sessions]
+        changes = {}
+        for session_id, session_data in sessions.items():
+            changes[session_id] = {
+                'meta': (
+                    session_data.get('title', '新会话'),
+                    session_data.get('timestamp'),
+                    bool(session_data.get('is_favorite', False))
+                )
+            }
+            for kind, key in MESSAGE_KINDS:
+                changes[session_id][kind] = (0, list(enumerate(session_data.get(key, []))))
+        return {'deleted': deleted, 'sessions': changes}
+    
+    def prepare_session_changes(self, changes):
+        """将 SessionStore.collect_changes() 收集到的变化序列化为可以稍后写入的快照
+
+        返回 {'deleted': set, 'sessions': {session_id: {'meta': ..., 'history': ..., 'context': ...}},
+        'bytes': 写入的字节数}，其中每类消息为 {'truncate_from': int 或 None, 'rows': {seq: JSON}}。
+        快照不再引用会话中的可变对象，之后会话继续修改也不会影响它。
+        """
+        prepared = {'deleted': set(changes['deleted']), 'sessions': {}, 'bytes': 0}
+        for session_id, session_changes in changes['sessions'].items():
+            meta = session_changes['meta']
+            entry = {'meta': meta}
+            if meta:
+                title, timestamp, _ = meta
+                prepared['bytes'] += len(session_id.encode('utf-8')) + len((title or '').encode('utf-8')) + len(timestamp or '')
+            for kind in ('history', 'context'):
+                entry[kind] = None
+                if not session_changes[kind]:
+                    continue
+                truncate_from, messages = session_changes[kind]
+                rows = {}
+                for seq, msg in messages:
+                    if kind == 'history':
+                        msg = self._process_history_message(msg)
+                    rows[seq] = json.dumps(msg, ensure_ascii=False)
+                    prepared['bytes'] += len(rows[seq].encode('utf-8'))
+                entry[kind] = {'truncate_from': truncate_from, 'rows': rows}
+            prepared['sessions'][session_id] = entry
+        return prepared
+    
+    def _write_session_changes(self, c, user_id, prepared):
+        """将 prepare_session_changes() 生成的快照写入数据库"""
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        
+        for session_id in prepared['deleted']:
+            self._unindex_session(c, user_id, session_id)
+            c.execute('DELETE FROM messages WHERE user_id = ? AND session_id = ?', (user_id, session_id))
+            c.execute('DELETE FROM sessions WHERE user_id = ? AND session_id = ?', (user_id, session_id))
+        
+        for session_id, session_changes in prepared['sessions'].items():
+            meta = session_changes['meta']
+            if meta:
+                title, timestamp, is_favorite = meta
+                c.execute('''
+                INSERT INTO sessions (user_id, session_id, title, timestamp, is_favorite)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (user_id, session_id) DO UPDATE SET
+                    title = excluded.title,
+                    timestamp = excluded.timestamp,
+                    is_favorite = excluded.is_favorite
+                ''', (user_id, session_id, title, timestamp or now, is_favorite))
+                self._index_session_title(c, user_id, session_id, title)
+            
+            for kind in ('history', 'context'):
+                kind_changes = session_changes[kind]
+                if not kind_changes:
+                    continue
+                truncate_from = kind_changes['truncate_from']
+                if truncate_from is not None:
+                    if kind == 'history':
+                        self._unindex_history(c, user_id, session_id, truncate_from)
+                    c.execute('''
+                    DELETE FROM messages
+                    WHERE user_id = ? AND session_id = ? AND kind = ? AND seq >= ?
+                    ''', (user_id, session_id, kind, truncate_from))
+                
+                rows = [(user_id, session_id, kind, seq, content, now)
+                        for seq, content in sorted(kind_changes['rows'].items())]
+                if rows:
+                    c.executemany('''
+                    INSERT INTO messages (user_id, session_id, kind, seq, content, timestamp)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (user_id, session_id, kind, seq) DO UPDATE SET
+                        content = excluded.content,
+                        timestamp = excluded.timestamp
+                    ''', rows)
+                    if kind == 'history':
+                        self._index_history(c, user_id, session_id,
+                                            [(row[3], json.loads(row[4])) for row in rows])
+    
+    @staticmethod
+    def _user_exists(c, user_id):
+        c.execute('SELECT 1 FROM users WHERE id = ?', (user_id,))
+        return c.fetchone() is not None
+    
+    def write_session_batch(self, batch):
+        """在一个事务中写入多个用户的会话变化，batch 为 {user_id: prepare_session_changes() 的结果}
+
+        已被删除的用户的变化被跳过，排队中的保存不会在 delete_user() 之后重新创建其会话。
+        """
+        conn = self.get_connection()
+        try:
+            c = conn.cursor()
+            for user_id, prepared in batch.items():
+                if not self._user_exists(c, user_id):
+                    continue
+                self._write_session_changes(c, user_id, prepared)
+            conn.commit()
         finally:
             conn.close()
     
     def save_user_sessions(self, user_id, sessions):
-        """保存用户的会话数据"""
+        """保存用户的会话数据
+
+        传入 SessionStore 时只写入自上次保存以来变化的会话和消息，
+        普通字典则作为完整快照整体重写。
+        """
+        conn = self.get_connection()
         try:
-            # 预处理会话数据，确保可以序列化
-            processed_sessions = {}
-            for session_id, session_data in sessions.items():
-                processed_session = {
-                    'title': session_data.get('title', '新会话'),
-                    'timestamp': session_data.get('timestamp', datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
-                    'is_favorite': session_data.get('is_favorite', False),
-                    'chat_history': [],
-                    'chat_context': session_data.get('chat_context', [])
-                }
-                
-                # 处理聊天历史
-                for msg in session_data.get('chat_history', []):
-                    if isinstance(msg, dict):
-                        # 对于数据分析类型的消息，确保数据大小合理
-                        if msg.get('type') == 'data_analysis':
-                            processed_msg = {
-                                'type': 'data_analysis',
-                                'filename': msg.get('filename', ''),
-                                'file_type': msg.get('file_type', ''),
-                                'data_info': {
-                                    'total_rows': msg.get('data_info', {}).get('total_rows', 0),
-                                    'total_columns': msg.get('data_info', {}).get('total_columns', 0),
-                                    'column_names': msg.get('data_info', {}).get('column_names', []),
-                                    'preview': msg.get('data_info', {}).get('preview', '')[:1000],  # 限制预览数据大小
-                                    'description': msg.get('data_info', {}).get('description', '')[:1000]  # 限制描述数据大小
-                                },
-                                'user_input': msg.get('user_input', '')
-                            }
-                            processed_session['chat_history'].append(processed_msg)
-                        else:
-                            # 其他类型的消息保持不变
-                            processed_session['chat_history'].append(msg)
-                    else:
-                        processed_session['chat_history'].append(msg)
-                
-                processed_sessions[session_id] = processed_session
-            
-            # 将处理后的会话数据转换为JSON字符串
-            sessions_json = json.dumps(processed_sessions, ensure_ascii=False)
-            
-            # 更新数据库中的会话数据
-            with self.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    INSERT OR REPLACE INTO user_sessions (user_id, sessions)
-                    VALUES (?, ?)
-                """, (user_id, sessions_json))
+            c = conn.cursor()
+            if not self._user_exists(c, user_id):
+                return False
+            if isinstance(sessions, SessionStore):
+                prepared = self.prepare_session_changes(sessions.collect_changes())
+                self._write_session_changes(c, user_id, prepared)
                 conn.commit()
+                sessions.mark_clean()
+                self.record_write(prepared['bytes'])
+            else:
+                prepared = self.prepare_session_changes(self._full_session_changes(c, user_id, sessions))
+                self._write_session_changes(c, user_id, prepared)
+                conn.commit()
+                self.record_write(prepared['bytes'])
             return True
         except Exception as e:
             print(f"保存会话数据时出错: {str(e)}")
             return False
+        finally:
+            conn.close()
+    
+    def record_write(self, written):
+        """记录一次会话保存写入的字节数"""
+        self.write_stats['saves'] += 1
+        self.write_stats['last_bytes'] = written
+        self.write_stats['total_bytes'] += written
     
     def load_user_sessions(self, user_id):
         """加载用户的会话数据"""
+        conn = self.get_connection()
         try:
-            with self.get_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    SELECT sessions FROM user_sessions WHERE user_id = ?
-                """, (user_id,))
-                result = cursor.fetchone()
-                
-                if result and result[0]:
-                    return json.loads(result[0])
+            c = conn.cursor()
+            
+            c.execute('''
+            SELECT session_id, title, timestamp, is_favorite, summary FROM sessions
+            WHERE user_id = ?
+            ORDER BY timestamp
+            ''', (user_id,))
+            sessions = {}
+            for session_id, title, timestamp, is_favorite, summary in c.fetchall():
+                sessions[session_id] = {
+                    'title': title,
+                    'timestamp': timestamp,
+                    'is_favorite': bool(is_favorite),
+                    'chat_history': [],
+                    'chat_context': []
+                }
+                if summary:
+                    sessions[session_id]['summary'] = json.loads(summary)
+            if not sessions:
                 return None
+            
+            c.execute('''
+            SELECT session_id, kind, content FROM messages
+            WHERE user_id = ?
+            ORDER BY session_id, kind, seq
+            ''', (user_id,))
+            for session_id, kind, content in c.fetchall():
+                if session_id in sessions:
+                    key = 'chat_history' if kind == 'history' else 'chat_context'
+                    sessions[session_id][key].append(json.loads(content))
+            
+            return sessions
         except Exception as e:
             print(f"加载会话数据时出错: {str(e)}")
             return None
+        finally:
+            conn.close()
+    
+    def load_session_index(self, user_id):
+        """加载用户会话列表的元数据（标题、时间、收藏、消息数），不加载消息内容"""
+        conn = self.get_connection()
+        try:
+            c = conn.cursor()
+            
+            c.execute('''
+            SELECT s.session_id, s.title, s.timestamp, s.is_favorite,
+                   (SELECT COUNT(*) FROM messages m
+                    WHERE m.user_id = s.user_id AND m.session_id = s.session_id AND m.kind = 'history')
+            FROM sessions s
+            WHERE s.user_id = ?
+            ORDER BY s.timestamp
+            ''', (user_id,))
+            
+            return {
+                session_id: {
+                    'title': title,
+                    'timestamp': timestamp,
+                    'is_favorite': bool(is_favorite),
+                    'message_count': message_count
+                }
+                for session_id, title, timestamp, is_favorite, message_count in c.fetchall()
+            }
+        except Exception as e:
+            print(f"加载会话列表时出错: {str(e)}")
+            return {}
+        finally:
+            conn.close()
+    
+    def load_session_messages(self, user_id, session_id, history_limit=None):
+        """加载单个会话的聊天历史和上下文
+
+        指定 history_limit 时聊天历史只加载最近的 history_limit 条，
+        返回值中的 history_offset 为之前未加载的条数。
+        """
+        conn = self.get_connection()
+        try:
+            c = conn.cursor()
+            
+            history_offset = 0
+            if history_limit is not None:
+                history_offset = max(self.count_messages(user_id, session_id, 'history', c) - history_limit, 0)
+            
+            c.execute('''
+            SELECT kind, content FROM messages
+            WHERE user_id = ? AND session_id = ?
+              AND (kind = 'context' OR seq >= ?)
+            ORDER BY kind, seq
+            ''', (user_id, session_id, history_offset))
+            
+            body = {'chat_history': [], 'chat_context': [], 'history_offset': history_offset}
+            for kind, content in c.fetchall():
+                key = 'chat_history' if kind == 'history' else 'chat_context'
+                body[key].append(json.loads(content))
+            
+            c.execute('SELECT summary FROM sessions WHERE user_id = ? AND session_id = ?', (user_id, session_id))
+            result = c.fetchone()
+            if result and result[0]:
+                body['summary'] = json.loads(result[0])
+            return body
+        except Exception as e:
+            print(f"加载会话消息时出错: {str(e)}")
+            return None
+        finally:
+            conn.close()
+    
+    def save_session_summary(self, user_id, session_id, summary):
+        """保存会话的滚动摘要，会话不存在时返回 False"""
+        conn = self.get_connection()
+        try:
+            c = conn.cursor()
+            c.execute('''
+            UPDATE sessions SET summary = ? WHERE user_id = ? AND session_id = ?
+            ''', (json.dumps(summary, ensure_ascii=False), user_id, session_id))
+            conn.commit()
+            return c.rowcount > 0
+        finally:
+            conn.close()
+    
+    def count_messages(self, user_id, session_id, kind='history', cursor=None):
+        """统计会话中某一类消息的数量"""
+        conn = None
+        try:
+            if cursor is None:
+                conn = self.get_connection()
+                cursor = conn.cursor()
+            cursor.execute('''
+            SELECT COUNT(*) FROM messages
+            WHERE user_id = ? AND session_id = ? AND kind = ?
+            ''', (user_id, session_id, kind))
+            return cursor.fetchone()[0]
+        finally:
+            if conn:
+                conn.close()
+    
+    def load_message_range(self, user_id, session_id, kind, start, end):
+        """按序号加载 [start, end) 范围内的消息，只反序列化这一段"""
+        conn = self.get_connection()
+        try:
+            c = conn.cursor()
+            c.execute('''
+            SELECT content FROM messages
+            WHERE user_id = ? AND session_id = ? AND kind = ? AND seq >= ? AND seq < ?
+            ORDER BY seq
+            ''', (user_id, session_id, kind, start, end))
+            return [json.loads(row[0]) for row in c.fetchall()]
+        except Exception as e:
+            print(f"加载消息时出错: {str(e)}")
+            return None
+        finally:
+            conn.close()
+    
+    def search_messages(self, user_id, query, limit=20):
+        """在用户的全部会话中搜索聊天记录和会话标题
+
+        返回按相关度排序的 [{'session_id', 'title', 'seq', 'snippet'}, ...]，
+        seq 为 None 表示匹配的是会话标题。少于3个字符的查询退回 LIKE 扫描。
+        """
+        query = (query or "").strip()
+        if not query:
+            return []
+        conn = self.get_connection()
+        try:
+            c = conn.cursor()
+            
+            if len(query) >= 3 and self.message_search_fts:
+                # 查询词只匹配正文/标题列，否则 "#5#" 之类的查询会匹配 owner 列，返回该用户的全部记录
+                phrase = '"' + query.replace('"', '""') + '"'
+                owner = f'owner : "#{user_id}#"'
+                c.execute('''
+                SELECT session_id, seq, snippet, rank FROM (
+                    SELECT m.session_id, m.seq,
+                           snippet(messages_fts, 0, '**', '**', '…', 16) AS snippet,
+                           bm25(messages_fts) AS rank
+                    FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+                    WHERE messages_fts MATCH ?
+                    UNION ALL
+                    SELECT s.session_id, NULL,
+                           snippet(session_titles_fts, 0, '**', '**', '…', 16),
+                           bm25(session_titles_fts)
+                    FROM session_titles_fts JOIN sessions s ON s.id = session_titles_fts.rowid
+                    WHERE session_titles_fts MATCH ?
+                )
+                ORDER BY rank
+                LIMIT ?
+                ''', (f'{owner} AND text : {phrase}', f'{owner} AND title : {phrase}', limit))
+                hits = [(session_id, seq, snippet) for session_id, seq, snippet, _ in c.fetchall()]
+            else:
+                # LIKE 只匹配提取出的文本，不匹配 JSON 的键名和其他字段
+                escaped = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                if self.message_search_fts:
+                    c.execute('''
+                    SELECT m.session_id, m.seq, messages_fts.text
+                    FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+                    WHERE m.user_id = ? AND messages_fts.text LIKE ? ESCAPE '\\'
+                    ORDER BY m.timestamp DESC
+                    LIMIT ?
+                    ''', (user_id, f"%{escaped}%", limit))
+                    texts = c.fetchall()
+                else:
+                    # 没有全文索引时用 LIKE 粗筛 JSON，再在提取出的文本中确认
+                    c.execute('''
+                    SELECT session_id, seq, content FROM messages
+                    WHERE user_id = ? AND kind = 'history' AND content LIKE ? ESCAPE '\\'
+                    ORDER BY timestamp DESC
+                    ''', (user_id, f"%{escaped}%"))
+                    texts = []
+                    for session_id, seq, content in c.fetchall():
+                        text = self._message_search_text(c, json.loads(content))
+                        if query.lower() in text.lower():
+                            texts.append((session_id, seq, text))
+                            if len(texts) >= limit:
+                                break
+                hits = []
+                for session_id, seq, text in texts:
+                    pos = text.lower().find(query.lower())
+                    snippet = text[max(pos - 20, 0):pos + len(query) + 40] if pos >= 0 else text[:60]
+                    hits.append((session_id, seq, snippet.replace(query, f"**{query}**")))
+            
+            # 补充会话标题
+            session_ids = list({hit[0] for hit in hits})
+            titles = {}
+            if session_ids:
+                placeholders = ','.join('?' * len(session_ids))
+                c.execute(f'''
+                SELECT session_id, title FROM sessions
+                WHERE user_id = ? AND session_id IN ({placeholders})
+                ''', [user_id] + session_ids)
+                titles = dict(c.fetchall())
+            
+            return [
+                {'session_id': session_id, 'title': titles.get(session_id, '新会话'), 'seq': seq, 'snippet': snippet}
+                for session_id, seq, snippet in hits
+            ]
+        finally:
+            conn.close()
+    
+    def put_blob(self, data, mime_type=None):
+        """保存上传文件的内容，返回其 SHA-256；相同内容只保存一份"""
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        conn = self.get_connection()
+        try:
+            c = conn.cursor()
+            c.execute('SELECT 1 FROM blobs WHERE sha256 = ?', (digest,))
+            if not c.fetchone():
+                c.execute('''
+                INSERT OR IGNORE INTO blobs (sha256, data, size, mime_type)
+                VALUES (?, ?, ?, ?)
+                ''', (digest, sqlite3.Binary(data), len(data), mime_type))
+                conn.commit()
+            return digest
+        finally:
+            conn.close()
+    
+    def get_blob(self, digest):
+        """按 SHA-256 读取文件内容，不存在时返回 None"""
+        conn = self.get_connection()
+        try:
+            c = conn.cursor()
+            c.execute('SELECT data FROM blobs WHERE sha256 = ?', (digest,))
+            result = c.fetchone()
+            return bytes(result[0]) if result else None
+        finally:
+            conn.close()
+    
+    def get_cached_response(self, cache_key, min_created_at):
+        """读取未过期的缓存响应，返回 (response, finish_reason, created_at, owner)，不存在时返回 None"""
+        conn = self.get_connection()
+        try:
+            c = conn.cursor()
+            c.execute('''
+            SELECT response, finish_reason, created_at, owner FROM response_cache
+            WHERE cache_key = ? AND created_at >= ?
+            ''', (cache_key, min_created_at))
+            result = c.fetchone()
+            if result:
+                c.execute('UPDATE response_cache SET last_used = ? WHERE cache_key = ?',
+                          (datetime.now().timestamp(), cache_key))
+                conn.commit()
+            return result
+        finally:
+            conn.close()
+    
+    def put_cached_response(self, cache_key, model, response, finish_reason, created_at, max_bytes, owner=None):
+        """保存缓存响应；总大小超过 max_bytes 时按最久未使用的顺序淘汰，owner 不为空时只返回给该用户"""
+        size = len(response.encode('utf-8'))
+        conn = self.get_connection()
+        try:
+            c = conn.cursor()
+            c.execute('''
+            INSERT OR REPLACE INTO response_cache
+            (cache_key, model, response, finish_reason, size, created_at, last_used, owner)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (cache_key, model, response, finish_reason, size, created_at, created_at, owner))
+            c.execute('SELECT COALESCE(SUM(size), 0) FROM response_cache')
+            excess = c.fetchone()[0] - max_bytes
+            if excess > 0:
+                # 按 last_used 从旧到新累加大小，删除到累计大小达到超出部分为止
+                c.execute('''
+                DELETE FROM response_cache WHERE cache_key IN (
+                    SELECT cache_key FROM (
+                        SELECT cache_key, size,
+                               SUM(size) OVER (ORDER BY last_used, cache_key) AS running
+                        FROM response_cache
+                    ) WHERE running - size < ?
+                )
+                ''', (excess,))
+            conn.commit()
+        finally:
+            conn.close()
+    
+    def prune_response_cache(self, min_created_at):
+        """删除过期的缓存响应，返回删除的数量"""
+        conn = self.get_connection()
+        try:
+            c = conn.cursor()
+            c.execute('DELETE FROM response_cache WHERE created_at < ?', (min_created_at,))
+            conn.commit()
+            return c.rowcount
+        finally:
+            conn.close()
+    
+    def get_parsed_file(self, cache_key):
+        """读取文件的解析结果，返回 (encoding, data, source_size)，不存在时返回 None"""
+        conn = self.get_connection()
+        try:
+            c = conn.cursor()
+            c.execute('SELECT encoding, data, source_size FROM parse_cache WHERE cache_key = ?', (cache_key,))
+            result = c.fetchone()
+            if result:
+                c.execute('UPDATE parse_cache SET last_used = ? WHERE cache_key = ?',
+                          (datetime.now().timestamp(), cache_key))
+                conn.commit()
+                return result[0], bytes(result[1]), result[2]
+            return None
+        finally:
+            conn.close()
+    
+    def put_parsed_file(self, cache_key, encoding, data, source_size, created_at, max_bytes):
+        """保存文件的解析结果；总大小超过 max_bytes 时按最久未使用的顺序淘汰"""
+        conn = self.get_connection()
+        try:
+            c = conn.cursor()
+            c.execute('''
+            INSERT OR REPLACE INTO parse_cache
+            (cache_key, encoding, data, size, source_size, created_at, last_used)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (cache_key, encoding, data, len(data), source_size, created_at, created_at))
+            c.execute('SELECT COALESCE(SUM(size), 0) FROM parse_cache')
+            excess = c.fetchone()[0] - max_bytes
+            if excess > 0:
+                # 按 last_used 从旧到新累加大小，删除到累计大小达到超出部分为止
+                c.execute('''
+                DELETE FROM parse_cache WHERE cache_key IN (
+                    SELECT cache_key FROM (
+                        SELECT cache_key, size,
+                               SUM(size) OVER (ORDER BY last_used, cache_key) AS running
+                        FROM parse_cache
+                    ) WHERE running - size < ?
+                )
+                ''', (excess,))
+            conn.commit()
+        finally:
+            conn.close()
     
     def save_user_settings(self, user_id, api_key, api_base, model):
         """保存用户的API设置"""
+        conn = self.get_connection()
         try:
-            conn = self.get_connection()
             c = conn.cursor()
             
             c.execute('''
@@ -200,8 +1068,8 @@ class Database:
     
     def load_user_settings(self, user_id):
         """加载用户的API设置"""
+        conn = self.get_connection()
         try:
-            conn = self.get_connection()
             c = conn.cursor()
             
             c.execute('SELECT api_key, api_base, model FROM user_settings WHERE user_id = ?',
@@ -220,8 +1088,8 @@ class Database:
     
     def verify_admin(self, user_id):
         """验证用户是否为管理员"""
+        conn = self.get_connection()
         try:
-            conn = self.get_connection()
             c = conn.cursor()
             
             c.execute('SELECT is_admin FROM users WHERE id = ?', (user_id,))
@@ -233,8 +1101,8 @@ class Database:
     
     def get_all_users(self):
         """获取所有用户信息"""
+        conn = self.get_connection()
         try:
-            conn = self.get_connection()
             c = conn.cursor()
             
             c.execute('''
@@ -247,16 +1115,70 @@ class Database:
         finally:
             conn.close()
     
+    def search_users(self, query="", page=1, page_size=50):
+        """分页搜索用户，返回 (当前页的用户列表, 匹配的用户总数)
+
+        用户名以查询开头的排在前面；查询长度不少于3个字符时使用 trigram 索引做子串匹配，
+        更短的查询只匹配用户名的开头（不区分大小写），可以使用 username 的 NOCASE 索引。
+        不支持 trigram 的 SQLite 上较长的查询退回 LIKE 子串扫描。
+        """
+        query = (query or "").strip()
+        offset = (max(page, 1) - 1) * page_size
+        conn = self.get_connection()
+        try:
+            c = conn.cursor()
+            
+            # LIKE 的通配符需要转义
+            escaped = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            if not query:
+                where, params = "", ()
+            elif len(query) >= 3 and self.user_search_fts:
+                where = "WHERE id IN (SELECT rowid FROM users_fts WHERE users_fts MATCH ?)"
+                params = ('"' + query.replace('"', '""') + '"',)
+            elif len(query) < 3:
+                # 前缀匹配的 LIKE 可以使用 idx_users_username_nocase，不需要扫描整个表
+                where = "WHERE username LIKE ? ESCAPE '\\'"
+                params = (f"{escaped}%",)
+            else:
+                where = "WHERE username LIKE ? ESCAPE '\\'"
+                params = (f"%{escaped}%",)
+            
+            c.execute(f'SELECT COUNT(*) FROM users {where}', params)
+            total = c.fetchone()[0]
+            
+            if query:
+                order, order_params = "(username LIKE ? ESCAPE '\\') DESC, created_at DESC", (f"{escaped}%",)
+            else:
+                order, order_params = "created_at DESC", ()
+            c.execute(f'''
+            SELECT id, username, is_admin, created_at
+            FROM users
+            {where}
+            ORDER BY {order}
+            LIMIT ? OFFSET ?
+            ''', params + order_params + (page_size, offset))
+            
+            return c.fetchall(), total
+        finally:
+            conn.close()
+    
     def delete_user(self, user_id):
         """删除用户"""
+        conn = self.get_connection()
         try:
-            conn = self.get_connection()
             c = conn.cursor()
             
-            # 删除用户的所有会话
+            # 删除用户的所有会话、消息和全文索引
+            if self.message_search_fts:
+                owner = f'"#{user_id}#"'
+                c.execute('DELETE FROM messages_fts WHERE messages_fts MATCH ?', (f'owner : {owner}',))
+                c.execute('DELETE FROM session_titles_fts WHERE session_titles_fts MATCH ?', (f'owner : {owner}',))
+            c.execute('DELETE FROM messages WHERE user_id = ?', (user_id,))
             c.execute('DELETE FROM sessions WHERE user_id = ?', (user_id,))
             # 删除用户的设置
             c.execute('DELETE FROM user_settings WHERE user_id = ?', (user_id,))
+            # 删除只属于该用户的响应缓存（上下文中含有其私有内容）
+            c.execute('DELETE FROM response_cache WHERE owner = ?', (user_id,))
             # 删除用户
             c.execute('DELETE FROM users WHERE id = ?', (user_id,))
             
@@ -269,8 +1191,8 @@ class Database:
     
     def toggle_admin_status(self, user_id):
         """切换用户的管理员状态"""
+        conn = self.get_connection()
         try:
-            conn = self.get_connection()
             c = conn.cursor()
             
             # 获取当前管理员状态
@@ -0,0 +1,129 @@
+"""上传文档的分块和 BM25 检索
+
+较长的文档在上传时被切分成若干片段并建立 BM25 倒排索引，索引以 JSON 保存在文件存储中。
+之后每次提问只把与问题最相关的几个片段发送给模型，而不是整篇文档。
+
+分词不依赖第三方库：英文和数字按单词切分并转为小写，中文等其他文字按相邻两个字切分（二元组），
+单独的一个字按单字处理。
+"""
+import json
+import math
+import re
+from collections import Counter
+
+# 索引格式的版本，格式变化后旧索引需要重建
+INDEX_VERSION = 1
+# 每个片段的目标字符数和相邻片段重叠的字符数
+CHUNK_CHARS = 800
+CHUNK_OVERLAP = 100
+# BM25 参数
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# 连续的英文字母和数字，或连续的其他文字
+_WORD_PATTERN = re.compile(r'[a-z0-9]+|[^\W_a-z0-9]+')
+
+
+def tokenize(text):
+    """把文本切分为检索使用的词项"""
+    terms = []
+    for word in _WORD_PATTERN.findall(text.lower()):
+        if word.isascii():
+            terms.append(word)
+        elif len(word) == 1:
+            terms.append(word)
+        else:
+            terms.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return terms
+
+
+def chunk_text(text, chunk_chars=CHUNK_CHARS, overlap=CHUNK_OVERLAP):
+    """按段落把文本切分为约 chunk_chars 个字符的片段，相邻片段重叠 overlap 个字符
+
+    超长的段落按字符切开；片段尽量在段落边界处结束。
+    """
+    pieces = []
+    for paragraph in text.split('\n'):
+        paragraph = paragraph.strip()
+        while len(paragraph) > chunk_chars:
+            pieces.append(paragraph[:chunk_chars])
+            paragraph = paragraph[chunk_chars - overlap:]
+        if paragraph:
+            pieces.append(paragraph)
+
+    chunks = []
+    current = ''
+    for piece in pieces:
+        if current and len(current) + len(piece) + 1 > chunk_chars:
+            chunks.append(current)
+            # 新片段以上一片段的结尾开头，避免答案恰好落在两个片段的边界上
+            current = current[-overlap:] if overlap else ''
+        current = f"{current}\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class DocumentIndex:
+    """一篇文档的片段及其 BM25 倒排索引"""
+
+    def __init__(self, chunks, postings, lengths):
+        self.chunks = chunks
+        # 词项 -> [[片段序号, 词频], ...]
+        self.postings = postings
+        self.lengths = lengths
+        self.avg_length = sum(lengths) / len(lengths) if lengths else 0.0
+
+    @classmethod
+    def build(cls, text, chunk_chars=CHUNK_CHARS, overlap=CHUNK_OVERLAP):
+        chunks = chunk_text(text, chunk_chars, overlap)
+        postings = {}
+        lengths = []
+        for position, chunk in enumerate(chunks):
+            terms = tokenize(chunk)
+            lengths.append(len(terms))
+            for term, count in Counter(terms).items():
+                postings.setdefault(term, []).append([position, count])
+        return cls(chunks, postings, lengths)
+
+    def to_json(self):
+        return json.dumps({
+            'version': INDEX_VERSION,
+            'chunks': self.chunks,
+            'postings': self.postings,
+            'lengths': self.lengths
+        }, ensure_ascii=False, separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+        if data.get('version') != INDEX_VERSION:
+            raise ValueError(f"不支持的索引版本: {data.get('version')}")
+        return cls(data['chunks'], data['postings'], data['lengths'])
+
+    def search(self, query, k=6):
+        """返回与 query 最相关的至多 k 个片段序号，按在文档中的顺序排列；没有匹配时返回空列表"""
+        count = len(self.chunks)
+        scores = {}
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for position, tf in postings:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[position] / self.avg_length)
+                scores[position] = scores.get(position, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+        best = sorted(scores, key=scores.get, reverse=True)[:k]
+        return sorted(best)
+
+    def overview(self, k=6):
+        """没有具体问题时使用：在全文中均匀选取 k 个片段（包括开头）"""
+        count = len(self.chunks)
+        if count <= k:
+            return list(range(count))
+        return sorted({round(i * (count - 1) / (k - 1)) for i in range(k)}) if k > 1 else [0]
+
+
+def build_document_index(text):
+    """建立文档索引并返回 JSON；在文件解析服务的工作进程中执行"""
+    return DocumentIndex.build(text).to_json()
@@ -0,0 +1,558 @@
+"""上游节点的故障转移、熔断和按延迟路由
+
+同一个模型可以配置多个 OpenAI 兼容的节点。EndpointRouter 记录每个节点最近的首 token
+延迟（指数加权平均）和连续失败次数：连续失败达到阈值的节点被熔断一段时间，之后只放行
+一个试探请求，成功后恢复；可用节点按首 token 延迟从低到高排序。
+
+FailoverStream 依次尝试这些节点：连接失败、429 和 5xx 等错误在收到第一个 token 之前
+会等待带随机抖动的退避时间后换下一个节点重试。启用 HedgePolicy 时，首 token 迟迟不到的
+请求会在另一个节点（或备用模型）上再发一份，先开始输出的一方胜出，另一方立即取消。
+"""
+import json
+import queue
+import random
+import threading
+import time
+from collections import deque, namedtuple
+
+from http_pool import UpstreamError
+
+# api_key 为 None 时使用请求方自己的密钥
+Endpoint = namedtuple('Endpoint', ['api_base', 'api_key'])
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+# 每个节点保留最近多少个首 token 延迟样本，用于计算分位数
+TTFT_SAMPLE_WINDOW = 200
+
+# 对冲竞速中表示流没有任何输出就结束的标记
+_END = object()
+
+
+def load_endpoint_config(text):
+    """解析节点配置
+
+    格式为 JSON：{"模型名称": [{"api_base": "...", "api_key": "..."}, ...], "*": [...]}，
+    "*" 为所有模型共用的节点，api_key 可省略。返回 {模型名称: [Endpoint, ...]}。
+    """
+    if not text:
+        return {}
+    config = {}
+    for model, entries in json.loads(text).items():
+        config[model] = [
+            Endpoint(entry['api_base'].rstrip('/'), entry.get('api_key'))
+            for entry in entries
+        ]
+    return config
+
+
+def endpoints_for(config, model, api_base, api_key, include_configured=True):
+    """返回模型可用的节点列表，请求方自己的节点排在最前，重复的 api_base 只保留一个"""
+    endpoints = [Endpoint(api_base.rstrip('/'), api_key)]
+    if include_configured:
+        for endpoint in config.get(model, []) + config.get('*', []):
+            if all(endpoint.api_base != existing.api_base for existing in endpoints):
+                endpoints.append(Endpoint(endpoint.api_base, endpoint.api_key or api_key))
+    return endpoints
+
+
+def _quantile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class _Health:
+    __slots__ = ('state', 'consecutive_failures', 'opened_until', 'trial_in_flight',
+                 'ttft', 'samples', 'successes', 'failures', 'last_error')
+
+    def __init__(self):
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_until = 0.0
+        self.trial_in_flight = False
+        # 首 token 延迟的指数加权平均（秒），None 表示还没有样本
+        self.ttft = None
+        self.samples = deque(maxlen=TTFT_SAMPLE_WINDOW)
+        self.successes = 0
+        self.failures = 0
+        self.last_error = ''
+
+
+class EndpointRouter:
+    """按 api_base 记录节点健康状况，选择尝试的顺序
+
+    failure_threshold: 连续失败多少次后熔断
+    reset_timeout: 熔断持续的秒数，之后放行一个试探请求
+    ewma_alpha: 首 token 延迟加权平均中新样本的权重
+    """
+
+    def __init__(self, failure_threshold=3, reset_timeout=30.0, ewma_alpha=0.3, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.ewma_alpha = ewma_alpha
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._health = {}
+
+    def _get(self, api_base):
+        # 调用方持有 self._lock
+        health = self._health.get(api_base)
+        if health is None:
+            health = self._health[api_base] = _Health()
+        return health
+
+    def order(self, endpoints):
+        """返回本次请求尝试节点的顺序
+
+        未熔断的节点按首 token 延迟排序（没有样本的节点排在前面以便获得样本），
+        熔断到期的节点作为试探放在最后；所有节点都在熔断中时，按熔断到期时间排序全部返回，
+        避免请求直接失败。
+        """
+        now = self._clock()
+        available = []
+        trials = []
+        blocked = []
+        with self._lock:
+            for position, endpoint in enumerate(endpoints):
+                health = self._get(endpoint.api_base)
+                if health.state == CLOSED:
+                    ttft = -1.0 if health.ttft is None else health.ttft
+                    available.append((ttft, position, endpoint))
+                elif health.opened_until <= now and not health.trial_in_flight:
+                    trials.append((position, endpoint))
+                else:
+                    blocked.append((health.opened_until, position, endpoint))
+        ordered = [endpoint for _, _, endpoint in sorted(available)]
+        ordered += [endpoint for _, endpoint in trials]
+        if not ordered:
+            ordered = [endpoint for _, _, endpoint in sorted(blocked)]
+        return ordered
+
+    def allow(self, api_base):
+        """熔断器当前是否允许向节点发送请求：未熔断，或熔断已到期且没有正在进行的试探"""
+        with self._lock:
+            health = self._get(api_base)
+            if health.state == CLOSED:
+                return True
+            return health.opened_until <= self._clock() and not health.trial_in_flight
+
+    def on_attempt(self, api_base):
+        """开始向节点发送请求；熔断到期的节点进入半开状态"""
+        with self._lock:
+            health = self._get(api_base)
+            if health.state != CLOSED:
+                health.state = HALF_OPEN
+                health.trial_in_flight = True
+
+    def record_success(self, api_base, ttft):
+        """收到第一个 token，记录首 token 延迟并关闭熔断"""
+        with self._lock:
+            health = self._get(api_base)
+            health.state = CLOSED
+            health.consecutive_failures = 0
+            health.trial_in_flight = False
+            health.successes += 1
+            health.samples.append(ttft)
+            if health.ttft is None:
+                health.ttft = ttft
+            else:
+                health.ttft += self.ewma_alpha * (ttft - health.ttft)
+
+    def record_failure(self, api_base, error=''):
+        with self._lock:
+            health = self._get(api_base)
+            health.failures += 1
+            health.consecutive_failures += 1
+            health.last_error = str(error)[:200]
+            health.trial_in_flight = False
+            if health.state == HALF_OPEN or health.consecutive_failures >= self.failure_threshold:
+                health.state = OPEN
+                health.opened_until = self._clock() + self.reset_timeout
+
+    def ttft_quantile(self, api_base, q, min_samples=1):
+        """返回节点最近首 token 延迟的 q 分位数（秒），样本少于 min_samples 时返回 None"""
+        with self._lock:
+            health = self._health.get(api_base)
+            samples = list(health.samples) if health is not None else []
+        if not samples or len(samples) < min_samples:
+            return None
+        return _quantile(samples, q)
+
+    def release(self, api_base):
+        """请求在得出结果前被取消，释放试探名额"""
+        with self._lock:
+            health = self._get(api_base)
+            health.trial_in_flight = False
+
+    def snapshot(self):
+        """返回各节点的状态，供管理员面板显示"""
+        now = self._clock()
+        with self._lock:
+            return {
+                api_base: {
+                    'state': health.state,
+                    'ttft_ms': None if health.ttft is None else health.ttft * 1000,
+                    'ttft_p95_ms': None if not health.samples else _quantile(health.samples, 0.95) * 1000,
+                    'successes': health.successes,
+                    'failures': health.failures,
+                    'consecutive_failures': health.consecutive_failures,
+                    'reopen_in': max(health.opened_until - now, 0) if health.state != CLOSED else 0,
+                    'last_error': health.last_error
+                }
+                for api_base, health in self._health.items()
+            }
+
+
+class HedgePolicy:
+    """对冲请求的触发时机和预算（所有用户共用）
+
+    主请求等待超过节点近期首 token 延迟的 percentile 分位数（限制在 min_delay 和 max_delay
+    之间，样本少于 min_samples 时为 default_delay）仍没有输出时，再发一个对冲请求。
+    每个请求为预算增加 budget_ratio 次对冲额度，最多累积 burst 次，因此长期来看对冲请求
+    不超过请求总数的 budget_ratio。
+    """
+
+    def __init__(self, percentile=0.95, min_delay=0.5, max_delay=10.0, default_delay=3.0,
+                 min_samples=20, budget_ratio=0.1, burst=5):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.default_delay = default_delay
+        self.min_samples = min_samples
+        self.budget_ratio = budget_ratio
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._budget = float(burst)
+        self.stats = {'requests': 0, 'hedged': 0, 'hedge_wins': 0, 'primary_wins': 0,
+                      'budget_denied': 0, 'losers_cancelled': 0}
+
+    def delay(self, router, api_base):
+        """主请求发出多少秒后仍没有输出时发送对冲请求"""
+        ttft = router.ttft_quantile(api_base, self.percentile, self.min_samples)
+        if ttft is None:
+            return self.default_delay
+        return min(max(ttft, self.min_delay), self.max_delay)
+
+    def on_request(self):
+        with self._lock:
+            self.stats['requests'] += 1
+            self._budget = min(self._budget + self.budget_ratio, self.burst)
+
+    def try_acquire(self):
+        """占用一次对冲额度，预算不足时返回 False"""
+        with self._lock:
+            if self._budget < 1:
+                self.stats['budget_denied'] += 1
+                return False
+            self._budget -= 1
+            self.stats['hedged'] += 1
+            return True
+
+    def record(self, key, count=1):
+        with self._lock:
+            self.stats[key] += count
+
+
+class _Attempt:
+    """对冲竞速中的一个请求
+
+    请求由 async_engine 的事件循环执行，第一个结果到达时 StreamHandle 把本对象放入竞速的
+    结果队列（StreamHandle.watch），等待期间不占用线程。
+    """
+
+    def __init__(self, endpoint, model, started):
+        self.endpoint = endpoint
+        self.model = model
+        self.started = started
+        self.handle = None
+        self.iterator = None
+        # 建立请求时的异常
+        self.error = None
+        self.finished = False
+
+    def cancel(self):
+        if self.handle is not None:
+            self.handle.cancel()
+
+
+class FailoverStream:
+    """依次尝试多个节点的流式请求
+
+    open_stream(endpoint, model=None) 返回 StreamHandle/SyncStreamHandle，model 不为 None 时
+    改用该模型。在收到第一个 token 之前，可重试的错误（UpstreamError.retryable）会在退避后
+    换下一个节点；已经输出内容后出错则直接抛出，避免重复输出。
+
+    hedge 为 HedgePolicy 时启用对冲（需要 async_engine 的 StreamHandle）：对冲请求发往下一个
+    可用节点，没有其他节点时改用 hedge_model 发往同一节点。迭代结束后 endpoint 和 model 为
+    实际提供回答的节点和模型（model 为 None 表示请求的模型），hedged 表示本次请求是否发送过
+    对冲请求。
+
+    所有等待都在迭代的线程中进行，不启动额外的线程；离开 with 语句时正在进行的请求被取消，
+    被取消的请求不计为节点的失败。
+    """
+
+    def __init__(self, router, endpoints, open_stream, max_attempts=3, backoff_base=0.5,
+                 backoff_cap=8.0, hedge=None, hedge_model=None, clock=time.monotonic):
+        self.router = router
+        self.endpoints = endpoints
+        self.open_stream = open_stream
+        # 至少尝试一次
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.hedge = hedge
+        self.hedge_model = hedge_model
+        self._clock = clock
+        self._handle = None
+        # 对冲竞速中的请求
+        self._attempts = []
+        self._iterator = None
+        self.endpoint = None
+        self.model = None
+        self.hedged = False
+        self.attempts = 0
+        self.finish_reason = None
+        self.usage = None
+        self.events = 0
+
+    def _backoff(self, retry, error):
+        """带完全随机抖动的指数退避；上游给出 Retry-After 时至少等待该时间（不超过上限）"""
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** retry)))
+        if getattr(error, 'retry_after', None):
+            delay = max(delay, min(error.retry_after, self.backoff_cap))
+        return delay
+
+    def _sleep(self, delay, interval):
+        """退避等待；interval 不为 None 时每 interval 秒产出一次 None"""
+        deadline = self._clock() + delay
+        while True:
+            remaining = deadline - self._clock()
+            if remaining <= 0:
+                return
+            if interval is None:
+                time.sleep(remaining)
+                return
+            time.sleep(min(remaining, interval))
+            yield None
+
+    def _next_endpoint(self, order, retry):
+        """从 order 的第 retry 个位置起选出熔断器仍允许请求的节点，都不允许时返回 None
+
+        本次请求中途被熔断的节点（例如被其他请求的失败触发）不再重试。
+        """
+        for offset in range(len(order)):
+            endpoint = order[(retry + offset) % len(order)]
+            if self.router.allow(endpoint.api_base):
+                return endpoint
+        return None
+
+    def poll(self, interval=0.2):
+        """产出文本增量；超过 interval 秒没有新的增量（等待首 token、重试退避）时产出 None
+
+        Streamlit 只在脚本线程调用 st.* 时处理停止按钮等中断请求，调用方收到 None 时更新一个
+        占位元素，中断即可及时生效。使用同步连接池时读取会阻塞，不会产出 None。
+        """
+        self._iterator = self._run(interval)
+        return self._iterator
+
+    def __iter__(self):
+        return self.poll(None)
+
+    def _run(self, interval):
+        order = self.router.order(self.endpoints)
+        if not order:
+            raise UpstreamError("没有可用的上游节点")
+        if self.hedge is not None:
+            self.hedge.on_request()
+        last_error = None
+        for retry in range(self.max_attempts):
+            if retry:
+                yield from self._sleep(self._backoff(retry - 1, last_error), interval)
+            endpoint = self._next_endpoint(order, retry)
+            if endpoint is None:
+                if retry:
+                    break
+                # 所有节点都在熔断中时，第一次仍按 order() 的顺序尝试，避免请求直接失败
+                endpoint = order[0]
+            if self.hedge is not None:
+                try:
+                    attempt, first_item = yield from self._race(endpoint, order, interval)
+                except UpstreamError as e:
+                    if not e.retryable:
+                        raise
+                    last_error = e
+                    continue
+                yield from self._stream_winner(attempt, first_item)
+                return
+            self.attempts += 1
+            self.router.on_attempt(endpoint.api_base)
+            started = self._clock()
+            first = True
+            try:
+                self._handle = self.open_stream(endpoint)
+                with self._handle as handle:
+                    for content in handle.poll(interval):
+                        if content is None:
+                            yield None
+                            continue
+                        if first:
+                            first = False
+                            self.endpoint = endpoint
+                            self.router.record_success(endpoint.api_base, self._clock() - started)
+                        yield content
+                    self.finish_reason = handle.finish_reason
+                    self.usage = handle.usage
+                    self.events = handle.events
+                if first:
+                    # 没有任何输出也算作一次成功的响应
+                    self.endpoint = endpoint
+                    self.router.record_success(endpoint.api_base, self._clock() - started)
+                return
+            except UpstreamError as e:
+                self.router.record_failure(endpoint.api_base, e)
+                if not first or not e.retryable:
+                    raise
+                last_error = e
+            except GeneratorExit:
+                # 被取消的请求不计为节点的失败
+                self.router.release(endpoint.api_base)
+                raise
+            except Exception as e:
+                self.router.record_failure(endpoint.api_base, e)
+                raise
+            finally:
+                self._handle = None
+        raise last_error
+
+    def _hedge_target(self, endpoint, order):
+        """返回对冲请求的 (节点, 模型)，没有可用的目标时返回 None"""
+        for candidate in order:
+            if candidate.api_base != endpoint.api_base and self.router.allow(candidate.api_base):
+                return candidate, None
+        if self.hedge_model:
+            return endpoint, self.hedge_model
+        return None
+
+    def _start(self, endpoint, model, results):
+        self.attempts += 1
+        self.router.on_attempt(endpoint.api_base)
+        attempt = _Attempt(endpoint, model, self._clock())
+        try:
+            attempt.handle = self.open_stream(endpoint) if model is None else self.open_stream(endpoint, model)
+        except Exception as e:
+            attempt.error = e
+            results.put(attempt)
+            return attempt
+        attempt.handle.watch(results, attempt)
+        return attempt
+
+    def _race(self, endpoint, order, interval):
+        """发出主请求，超过对冲延迟仍没有输出时再发对冲请求，返回最先输出的 (attempt, 第一个增量)
+
+        各请求第一个结果到达时由事件循环放入共用的 results 队列，这里只需带超时地等待这个队列。
+        落败的请求被取消；所有请求都在输出前失败时抛出最后一个错误。
+        """
+        results = queue.SimpleQueue()
+        attempts = self._attempts = [self._start(endpoint, None, results)]
+        target = self._hedge_target(endpoint, order)
+        hedge_at = attempts[0].started + self.hedge.delay(self.router, endpoint.api_base) if target else None
+        winner = None
+        last_error = None
+        try:
+            while any(not attempt.finished for attempt in attempts):
+                now = self._clock()
+                pending = [attempt for attempt in attempts if not attempt.finished]
+                # 超过 wait_timeout 仍没有结果的请求视为超时
+                deadlines = [attempt.started + attempt.handle.wait_timeout for attempt in pending
+                             if attempt.handle is not None]
+                waits = [t - now for t in [hedge_at] + deadlines if t is not None]
+                if interval is not None:
+                    waits.append(interval)
+                try:
+                    attempt = results.get(timeout=max(min(waits), 0) if waits else None)
+                except queue.Empty:
+                    now = self._clock()
+                    if hedge_at is not None and now >= hedge_at:
+                        hedge_at = None
+                        if self.hedge.try_acquire():
+                            self.hedged = True
+                            attempts.append(self._start(target[0], target[1], results))
+                    for attempt in pending:
+                        if attempt.handle is not None and now >= attempt.started + attempt.handle.wait_timeout:
+                            attempt.finished = True
+                            attempt.cancel()
+                            last_error = UpstreamError("等待上游响应超时", retryable=True)
+                            self.router.record_failure(attempt.endpoint.api_base, last_error)
+                    yield None
+                    continue
+                if attempt.finished:
+                    continue
+                attempt.finished = True
+                if attempt.error is None:
+                    attempt.iterator = attempt.handle.poll(interval)
+                    try:
+                        # 结果已经在队列中，不会等待
+                        item = next(attempt.iterator, _END)
+                    except Exception as e:
+                        item = e
+                else:
+                    item = attempt.error
+                if isinstance(item, BaseException):
+                    self.router.record_failure(attempt.endpoint.api_base, item)
+                    last_error = item
+                    continue
+                winner = attempt
+                self.router.record_success(attempt.endpoint.api_base, self._clock() - attempt.started)
+                if self.hedged:
+                    self.hedge.record('primary_wins' if attempt is attempts[0] else 'hedge_wins')
+                return attempt, item
+        finally:
+            self._attempts = []
+            for attempt in attempts:
+                if attempt is not winner and not attempt.finished:
+                    attempt.cancel()
+                    self.router.release(attempt.endpoint.api_base)
+                    if winner is not None:
+                        self.hedge.record('losers_cancelled')
+        raise last_error
+
+    def _stream_winner(self, attempt, first_item):
+        """输出胜出请求的剩余内容"""
+        self.endpoint = attempt.endpoint
+        self.model = attempt.model
+        self._handle = attempt.handle
+        try:
+            with attempt.handle as handle:
+                if first_item is not _END:
+                    yield first_item
+                    yield from attempt.iterator
+                self.finish_reason = handle.finish_reason
+                self.usage = handle.usage
+                self.events = handle.events
+        except GeneratorExit:
+            raise
+        except Exception as e:
+            self.router.record_failure(attempt.endpoint.api_base, e)
+            raise
+        finally:
+            self._handle = None
+
+    def cancel(self):
+        """取消请求并关闭连接"""
+        if self._handle is not None:
+            self._handle.cancel()
+        for attempt in self._attempts:
+            attempt.cancel()
+        if self._iterator is not None:
+            # 结束生成器，归还节点的试探名额
+            self._iterator.close()
+            self._iterator = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cancel()
+        return False
@@ -0,0 +1,218 @@
+"""上游API的共享HTTP连接池
+
+每个 api_base 使用一个进程内共享的 requests.Session，保持长连接，避免每轮对话都重新进行
+TCP+TLS 握手；连接数量有上限，并分别设置连接超时和读取超时。
+"""
+import os
+import socket
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import EmptyPoolError
+
+from sse import ChatCompletionStream
+
+# 建立连接的超时时间（秒）
+CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 10))
+# 两次收到数据之间的最长等待时间（秒），推理模型首个token可能较慢
+READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', 300))
+# 连接数达到上限时等待空闲连接的最长时间（秒）
+POOL_TIMEOUT = float(os.environ.get('UPSTREAM_POOL_TIMEOUT', 30))
+# 流式响应每次读取的最大字节数
+STREAM_READ_SIZE = 512
+# 可以换一个节点或稍后重试的HTTP状态码
+RETRYABLE_STATUS = frozenset({408, 429, 500, 502, 503, 504})
+
+
+class UpstreamError(Exception):
+    """上游请求失败
+
+    status 为HTTP状态码（连接失败、超时等为 None），retry_after 为上游要求的等待秒数，
+    retryable 表示换一个节点或稍后重试可能成功。
+    """
+
+    def __init__(self, message, status=None, retry_after=None, retryable=False):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+        self.retryable = retryable
+
+    @classmethod
+    def from_status(cls, status, reason, body, headers):
+        """根据错误响应创建异常，响应内容只保留开头部分"""
+        retry_after = None
+        try:
+            retry_after = float(headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            pass
+        message = f"{status} {reason or ''}".strip()
+        body = (body or '').strip()
+        if body:
+            message += f": {body[:200]}"
+        return cls(message, status=status, retry_after=retry_after, retryable=status in RETRYABLE_STATUS)
+
+
+class SyncStreamHandle:
+    """同步连接池上的一次流式请求，接口与 async_engine.StreamHandle 相同"""
+
+    def __init__(self, response):
+        self._response = response
+        self.parser = ChatCompletionStream()
+
+    @property
+    def finish_reason(self):
+        return self.parser.finish_reason
+
+    @property
+    def usage(self):
+        return self.parser.usage
+
+    @property
+    def events(self):
+        return self.parser.events
+
+    def __iter__(self):
+        feed = self.parser.feed
+        try:
+            # 收到 [DONE] 后仍读完响应，连接才能归还给连接池复用
+            for chunk in self._response.iter_content(chunk_size=STREAM_READ_SIZE):
+                yield from feed(chunk)
+        except requests.RequestException as e:
+            raise UpstreamError(f"读取响应失败: {str(e)}", retryable=True) from e
+
+    def poll(self, interval=None):
+        """与 StreamHandle.poll() 接口相同；同步读取会阻塞到收到数据为止，不会产出 None"""
+        return iter(self)
+
+    def cancel(self):
+        """关闭响应；未读完的连接不会被复用
+
+        另一个线程可能正阻塞在读取上，只关闭响应并不会唤醒它，连接要等到上游发完才断开，
+        因此先对底层套接字调用 shutdown。
+        """
+        sock = getattr(getattr(self._response.raw, '_connection', None), 'sock', None)
+        if sock is not None and not self._response.raw.closed:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cancel()
+        return False
+
+
+def _timed_pool_class(base, pool_timeout):
+    """返回等待空闲连接最多 pool_timeout 秒的 urllib3 连接池类"""
+
+    class TimedConnectionPool(base):
+        def _get_conn(self, timeout=None):
+            return super()._get_conn(timeout=pool_timeout if timeout is None else timeout)
+
+    return TimedConnectionPool
+
+
+class PoolTimeoutAdapter(HTTPAdapter):
+    """连接数达到上限时最多等待 pool_timeout 秒，超时后抛出 urllib3 的 EmptyPoolError
+
+    requests 调用 urlopen() 时不传 pool_timeout，pool_block=True 的连接池默认无限等待空闲连接。
+    """
+
+    __attrs__ = HTTPAdapter.__attrs__ + ['pool_timeout']
+
+    def __init__(self, pool_timeout=POOL_TIMEOUT, **kwargs):
+        self.pool_timeout = pool_timeout
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: _timed_pool_class(base, self.pool_timeout)
+            for scheme, base in self.poolmanager.pool_classes_by_scheme.items()
+        }
+
+
+class HTTPClientPool:
+    """按 api_base 划分的长连接池"""
+
+    def __init__(self, pool_maxsize=20, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 pool_timeout=POOL_TIMEOUT):
+        self.pool_maxsize = pool_maxsize
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_timeout = pool_timeout
+        self._lock = threading.Lock()
+        # api_base -> (session, adapter)
+        self._clients = {}
+
+    def session(self, api_base):
+        """返回 api_base 对应的共享 Session"""
+        api_base = api_base.rstrip('/')
+        with self._lock:
+            client = self._clients.get(api_base)
+            if client is None:
+                session = requests.Session()
+                # pool_block=True：连接数达到上限时等待空闲连接（最多 pool_timeout 秒），
+                # 而不是额外新建不复用的连接
+                adapter = PoolTimeoutAdapter(
+                    pool_timeout=self.pool_timeout,
+                    pool_connections=4, pool_maxsize=self.pool_maxsize, pool_block=True
+                )
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                client = (session, adapter)
+                self._clients[api_base] = client
+            return client[0]
+
+    def post(self, api_base, path, **kwargs):
+        """向 api_base + path 发送 POST 请求，默认使用连接池的超时设置"""
+        kwargs.setdefault('timeout', (self.connect_timeout, self.read_timeout))
+        return self.session(api_base).post(f"{api_base.rstrip('/')}{path}", **kwargs)
+
+    def stream(self, api_base, path, **kwargs):
+        """发送流式 POST 请求，返回 SyncStreamHandle；连接失败或返回错误状态时抛出 UpstreamError"""
+        try:
+            response = self.post(api_base, path, stream=True, **kwargs)
+        except requests.RequestException as e:
+            raise UpstreamError(f"连接失败: {str(e)}", retryable=True) from e
+        except EmptyPoolError as e:
+            raise UpstreamError(f"等待空闲连接超过 {self.pool_timeout:g} 秒", retryable=True) from e
+        if response.status_code >= 400:
+            with response:
+                raise UpstreamError.from_status(
+                    response.status_code, response.reason, response.text, response.headers
+                )
+        return SyncStreamHandle(response)
+
+    def stats(self):
+        """返回每个 api_base 的请求数、新建连接数（握手次数）和连接复用率"""
+        result = {}
+        with self._lock:
+            clients = list(self._clients.items())
+        for api_base, (_, adapter) in clients:
+            requests_count = 0
+            connections = 0
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                requests_count += pool.num_requests
+                connections += pool.num_connections
+            result[api_base] = {
+                'requests': requests_count,
+                'handshakes': connections,
+                'reuse_ratio': 1 - connections / requests_count if requests_count else 0.0
+            }
+        return result
+
+    def close(self):
+        with self._lock:
+            for session, _ in self._clients.values():
+                session.close()
+            self._clients = {}
@@ -0,0 +1,287 @@
+"""上传文件的解析服务
+
+Excel/CSV、Word、PDF 和图片的解析都在独立的工作进程中执行，不占用 Streamlit 的脚本线程，
+也不会因为某个异常文件（例如超大的表格或解压炸弹图片）拖垮整个服务进程：
+
+- 每个工作进程设置了内存上限（RLIMIT_AS），超出时解析失败而不影响其他用户；
+- 每个任务有墙钟超时，超时的工作进程被直接终止并替换；
+- 工作进程只把提取出的结果（文本、表格概要、压缩后的图片）传回，不传回 DataFrame 等对象。
+
+IngestionService.submit() 的接口与 concurrent.futures 的 Executor 相同，for_kind() 返回的视图
+可以直接交给 pdf_extract.iter_pdf_pages() 使用。
+"""
+import atexit
+import io
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError:
+    # Windows 上没有 resource 模块，不限制内存
+    resource = None
+
+# 解析器的版本，解析逻辑（包括 pdf_extract）变化后递增，旧的解析缓存随之失效
+PARSER_VERSION = 1
+# 图片的最大像素数，超出时视为解压炸弹
+MAX_IMAGE_PIXELS = 50_000_000
+# CSV 依次尝试的编码
+CSV_ENCODINGS = ('utf-8', 'gbk', 'gb2312', 'iso-8859-1')
+
+
+class IngestionError(Exception):
+    """文件解析失败"""
+
+
+class IngestionTimeout(IngestionError):
+    """文件解析超时"""
+
+
+def table_info(df):
+    """表格的概要信息，发送给模型的只有这些内容"""
+    return {
+        'total_rows': len(df),
+        'total_columns': len(df.columns),
+        'column_names': [str(column) for column in df.columns],
+        'data_types': {str(column): str(dtype) for column, dtype in df.dtypes.items()},
+        'preview': df.head().to_string(),
+        'description': df.describe().to_string(),
+        'missing_values': {str(column): int(count) for column, count in df.isnull().sum().items()}
+    }
+
+
+def parse_excel(data):
+    import pandas as pd
+    return table_info(pd.read_excel(io.BytesIO(data)))
+
+
+def parse_csv(data):
+    """尝试不同的编码读取CSV，都失败时返回 None"""
+    import pandas as pd
+    for encoding in CSV_ENCODINGS:
+        try:
+            df = pd.read_csv(io.StringIO(data.decode(encoding)))
+        except Exception:
+            continue
+        return table_info(df)
+    return None
+
+
+def parse_docx(data):
+    import docx
+    doc = docx.Document(io.BytesIO(data))
+    return "".join(para.text + "\n" for para in doc.paragraphs)
+
+
+def compress_image(image_data, max_size_mb=2):
+    """压缩图片到指定大小以下"""
+    import warnings
+    from PIL import Image
+
+    # 像素数超出上限的图片直接拒绝，而不是只给出警告
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+    warnings.simplefilter('error', Image.DecompressionBombWarning)
+
+    # 将bytes转换为PIL Image对象
+    image = Image.open(io.BytesIO(image_data))
+
+    # 初始压缩质量
+    quality = 95
+    output = io.BytesIO()
+
+    # 如果是PNG，转换为JPEG以获得更好的压缩
+    if image.format == 'PNG':
+        # 如果有透明通道，先将背景转为白色
+        if image.mode in ('RGBA', 'LA'):
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.split()[-1])
+            image = background
+        else:
+            image = image.convert('RGB')
+
+    # 保存图片并检查大小
+    image.save(output, format='JPEG', quality=quality)
+
+    # 如果大小超过限制，逐步降低质量直到满足要求
+    while output.tell() > max_size_mb * 1024 * 1024 and quality > 10:
+        output = io.BytesIO()
+        quality -= 5
+        image.save(output, format='JPEG', quality=quality)
+
+    return output.getvalue()
+
+
+def _worker_main(conn, memory_limit):
+    """工作进程的主循环：接收 (函数, 参数)，返回 (是否成功, 结果或错误信息, 解析耗时)"""
+    # 数值库的线程池会预留大量虚拟内存，在内存上限下只使用单线程
+    for name in ('OPENBLAS_NUM_THREADS', 'OMP_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ[name] = '1'
+    if memory_limit and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    while True:
+        try:
+            fn, args = conn.recv()
+        except (EOFError, OSError):
+            return
+        started = time.perf_counter()
+        try:
+            reply = (True, fn(*args))
+        except MemoryError:
+            reply = (False, "文件过大，解析时超出内存上限")
+        except Exception as e:
+            reply = (False, f"{type(e).__name__}: {str(e)}")
+        elapsed = time.perf_counter() - started
+        try:
+            conn.send(reply + (elapsed,))
+        except MemoryError:
+            conn.send((False, "解析结果过大，超出内存上限", elapsed))
+
+
+class _Worker:
+    """一个工作进程及与它通信的管道"""
+
+    def __init__(self, context, memory_limit):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main, args=(child_conn, memory_limit), name='ingest-worker', daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+
+    def call(self, fn, args, timeout):
+        """在工作进程中执行 fn(*args)，返回 (结果, 解析耗时)；超时时抛出 IngestionTimeout"""
+        try:
+            self.conn.send((fn, args))
+        except OSError:
+            raise IngestionError("解析进程异常退出")
+        if not self.conn.poll(timeout):
+            raise IngestionTimeout(f"解析超过 {timeout:.0f} 秒，已终止")
+        try:
+            ok, payload, elapsed = self.conn.recv()
+        except (EOFError, OSError):
+            raise IngestionError("解析进程异常退出（可能超出内存上限）")
+        if not ok:
+            raise IngestionError(payload)
+        return payload, elapsed
+
+    def kill(self):
+        self.process.kill()
+        self.process.join(timeout=5)
+        self.conn.close()
+
+
+class IngestionService:
+    """在工作进程池中解析上传的文件
+
+    max_workers: 工作进程数，同时最多解析这么多个任务，其余任务排队
+    timeout: 单个任务的墙钟超时（秒）
+    memory_limit_mb: 每个工作进程的内存上限，0 表示不限制
+    """
+
+    def __init__(self, max_workers=2, timeout=60, memory_limit_mb=1024):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.memory_limit = int(memory_limit_mb * 1024 * 1024)
+        # 服务进程中有多个线程，使用 spawn 启动子进程，避免 fork 复制持有锁的线程状态
+        self._context = multiprocessing.get_context('spawn')
+        # 每个调度线程独占一个工作进程，线程数即为并发的任务数
+        self._dispatcher = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ingest')
+        self._local = threading.local()
+        self._workers = set()
+        self._lock = threading.Lock()
+        self._closed = False
+        # 文件类型 -> 统计
+        self.stats = {}
+        atexit.register(self.close)
+
+    def _record(self, kind, key, value=1):
+        with self._lock:
+            stats = self.stats.setdefault(kind, {
+                'jobs': 0, 'failed': 0, 'timeouts': 0, 'queue_wait': 0.0, 'parse_time': 0.0
+            })
+            stats[key] += value
+
+    def _worker(self):
+        # 只在调度线程中调用
+        worker = getattr(self._local, 'worker', None)
+        if worker is None or not worker.process.is_alive():
+            worker = self._local.worker = _Worker(self._context, self.memory_limit)
+            with self._lock:
+                self._workers.add(worker)
+        return worker
+
+    def _discard(self, worker):
+        self._local.worker = None
+        with self._lock:
+            self._workers.discard(worker)
+        worker.kill()
+
+    def _execute(self, kind, fn, args, submitted):
+        self._record(kind, 'queue_wait', time.perf_counter() - submitted)
+        self._record(kind, 'jobs')
+        worker = self._worker()
+        try:
+            result, elapsed = worker.call(fn, args, self.timeout)
+        except IngestionTimeout:
+            self._record(kind, 'timeouts')
+            self._record(kind, 'parse_time', self.timeout)
+            self._discard(worker)
+            raise
+        except IngestionError:
+            self._record(kind, 'failed')
+            if not worker.process.is_alive():
+                self._discard(worker)
+            raise
+        self._record(kind, 'parse_time', elapsed)
+        return result
+
+    def submit(self, fn, *args, kind=None):
+        """提交解析任务，返回 Future；kind 为统计使用的文件类型，默认为函数名"""
+        if self._closed:
+            raise RuntimeError("文件解析服务已关闭")
+        return self._dispatcher.submit(self._execute, kind or fn.__name__, fn, args, time.perf_counter())
+
+    def for_kind(self, kind):
+        """返回把任务统计到 kind 下的 Executor 视图，例如交给 iter_pdf_pages() 时使用 'pdf'"""
+        return _KindExecutor(self, kind)
+
+    def run(self, kind, fn, *args):
+        """解析并等待结果"""
+        return self.submit(fn, *args, kind=kind).result()
+
+    def summary(self):
+        """返回各文件类型的任务数、平均排队时间和平均解析时间"""
+        with self._lock:
+            return {
+                kind: dict(stats,
+                           avg_queue_wait=stats['queue_wait'] / stats['jobs'] if stats['jobs'] else 0.0,
+                           avg_parse_time=stats['parse_time'] / stats['jobs'] if stats['jobs'] else 0.0)
+                for kind, stats in self.stats.items()
+            }
+
+    def close(self):
+        """停止接收任务并终止工作进程（进程退出时自动调用）"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            workers = list(self._workers)
+            self._workers.clear()
+        self._dispatcher.shutdown(wait=False, cancel_futures=True)
+        for worker in workers:
+            worker.kill()
+
+
+class _KindExecutor:
+    """把提交的任务统计到指定文件类型下的 IngestionService 视图"""
+
+    def __init__(self, service, kind):
+        self.service = service
+        self.kind = kind
+        self.max_workers = service.max_workers
+
+    def submit(self, fn, *args):
+        return self.service.submit(fn, *args, kind=self.kind)
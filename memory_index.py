@@ -0,0 +1,317 @@
+"""跨会话的记忆检索
+
+每轮问答（用户的问题和AI的回答）保存后，用特征哈希把文本转换为定长向量，追加到该用户的
+向量文件中；新的问题到来时，用向量化的余弦相似度在用户以往所有会话中找出最相关的几轮问答，
+作为参考放入上下文。不需要外部服务或GPU。
+
+每个用户两个文件：
+- <用户>.vec：float32 的行向量依次排列，读取时以 numpy.memmap 映射，不整体载入内存；
+- <用户>.meta.jsonl：每行一个 JSON，记录对应向量所属的会话和问答的摘录。内存中只保留每行的
+  会话 ID 和在文件中的位置，摘录在返回检索结果时才读取。
+
+删除会话时把该会话的行从两个文件中移除；内存中最多保留 max_users 个用户的索引（LRU）。
+"""
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from doc_index import tokenize
+
+# 向量维度，每个向量占 DIM * 4 字节；使用 float32 以便直接对映射的文件做矩阵乘法
+DIM = 512
+DTYPE = np.float32
+# 摘录保留的字符数
+EXCERPT_CHARS = 300
+# 每次参与矩阵乘法的行数，限制临时内存
+SCORE_BATCH_ROWS = 8192
+
+
+def hash_vector(text, dim=DIM):
+    """把文本转换为 L2 归一化的哈希特征向量
+
+    词项用 CRC32 哈希到 dim 个桶中，哈希的最高位决定符号以抵消冲突；词频取对数。
+    CRC32 在不同进程间结果相同，保存的向量在重启后仍然可用。
+    """
+    counts = {}
+    for term in tokenize(text):
+        counts[term] = counts.get(term, 0) + 1
+    vector = np.zeros(dim, dtype=np.float32)
+    for term, count in counts.items():
+        h = zlib.crc32(term.encode('utf-8'))
+        vector[h % dim] += (1.0 if h & 0x80000000 else -1.0) * (1.0 + np.log(count))
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    return vector
+
+
+def user_paths(directory, user_id):
+    """返回用户的 (向量文件, 元数据文件) 路径"""
+    base = os.path.join(directory, f"user_{user_id}")
+    return f"{base}.vec", f"{base}.meta.jsonl"
+
+
+def delete_user_files(directory, user_id):
+    """删除用户的向量文件和元数据（删除用户时调用）"""
+    for path in user_paths(directory, user_id):
+        for name in (path, path + '.tmp'):
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+
+
+class _UserIndex:
+    """一个用户的向量文件和元数据；调用方持有该用户的锁"""
+
+    def __init__(self, vec_path, meta_path, dim):
+        self.vec_path = vec_path
+        self.meta_path = meta_path
+        self.dim = dim
+        self.row_bytes = dim * np.dtype(DTYPE).itemsize
+        # 每行所属的会话 ID 和元数据行在文件中的起始位置
+        self.sessions = []
+        self.offsets = []
+        self._meta_end = 0
+        # 文件被压缩重写后递增，之前读到的行号随之失效
+        self.version = 0
+        self._matrix = None
+        self._matrix_rows = 0
+        self._finish_compaction()
+        self._reconcile()
+
+    def _finish_compaction(self):
+        """完成或放弃上次被中断的压缩重写
+
+        compact() 依次写好元数据和向量的临时文件，再依次替换元数据和向量文件：元数据的临时文件
+        还在说明还没有替换任何文件，丢弃即可；只剩向量的临时文件说明元数据已经替换，补上向量文件。
+        """
+        vec_tmp, meta_tmp = self.vec_path + '.tmp', self.meta_path + '.tmp'
+        if os.path.exists(meta_tmp):
+            for path in (vec_tmp, meta_tmp):
+                if os.path.exists(path):
+                    os.remove(path)
+        elif os.path.exists(vec_tmp):
+            os.replace(vec_tmp, self.vec_path)
+
+    def _reconcile(self):
+        """使两个文件逐行对应
+
+        两个文件分别追加，进程在两次写入之间（或写入一半时）退出后，多出的向量或元数据
+        会让之后追加的每一行都与错误的问答对应；加载时把两个文件都截断到完整的公共行数。
+        """
+        sessions = []
+        offsets = []
+        end = 0
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # 写入一半的最后一行
+                        break
+                    sessions.append(record.get('session_id'))
+                    offsets.append(end)
+                    end += len(line)
+        vec_size = os.path.getsize(self.vec_path) if os.path.exists(self.vec_path) else 0
+        rows = min(vec_size // self.row_bytes, len(sessions))
+        if vec_size != rows * self.row_bytes:
+            os.truncate(self.vec_path, rows * self.row_bytes)
+        if rows < len(sessions):
+            end = offsets[rows]
+        if os.path.exists(self.meta_path) and os.path.getsize(self.meta_path) != end:
+            os.truncate(self.meta_path, end)
+        self.sessions = sessions[:rows]
+        self.offsets = offsets[:rows]
+        self._meta_end = end
+
+    def rows(self):
+        return len(self.sessions)
+
+    def matrix(self):
+        """以只读 memmap 映射向量文件，文件增长后重新映射"""
+        rows = self.rows()
+        if rows == 0:
+            return None
+        if self._matrix is None or self._matrix_rows != rows:
+            self._matrix = np.memmap(self.vec_path, dtype=DTYPE, mode='r', shape=(rows, self.dim))
+            self._matrix_rows = rows
+        return self._matrix
+
+    def records(self, rows):
+        """读取指定行的元数据"""
+        records = []
+        with open(self.meta_path, 'rb') as f:
+            for row in rows:
+                f.seek(self.offsets[row])
+                records.append(json.loads(f.readline()))
+        return records
+
+    def append(self, vector, record):
+        line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+        with open(self.vec_path, 'ab') as f:
+            f.write(vector.astype(DTYPE).tobytes())
+        try:
+            with open(self.meta_path, 'ab') as f:
+                f.write(line)
+        except BaseException:
+            # 元数据写入失败时撤销刚追加的向量
+            os.truncate(self.vec_path, self.rows() * self.row_bytes)
+            raise
+        self.sessions.append(record['session_id'])
+        self.offsets.append(self._meta_end)
+        self._meta_end += len(line)
+
+    def compact(self, session_id):
+        """从两个文件中移除会话的全部行，返回移除的行数"""
+        keep = [row for row, sid in enumerate(self.sessions) if sid != session_id]
+        if len(keep) == self.rows():
+            return 0
+        vec_tmp, meta_tmp = self.vec_path + '.tmp', self.meta_path + '.tmp'
+        # 先写元数据的临时文件，向量的临时文件写到一半时两个都存在，重新加载时会被丢弃
+        sessions = []
+        offsets = []
+        end = 0
+        with open(self.meta_path, 'rb') as src, open(meta_tmp, 'wb') as dst:
+            for row in keep:
+                src.seek(self.offsets[row])
+                line = src.readline()
+                dst.write(line)
+                sessions.append(self.sessions[row])
+                offsets.append(end)
+                end += len(line)
+        matrix = self.matrix()
+        with open(vec_tmp, 'wb') as f:
+            for start in range(0, len(keep), SCORE_BATCH_ROWS):
+                f.write(np.ascontiguousarray(matrix[keep[start:start + SCORE_BATCH_ROWS]]).tobytes())
+        self._matrix = None
+        os.replace(meta_tmp, self.meta_path)
+        os.replace(vec_tmp, self.vec_path)
+        removed = self.rows() - len(keep)
+        # 检索可能还在使用旧的列表，替换而不是原地修改
+        self.sessions = sessions
+        self.offsets = offsets
+        self._meta_end = end
+        self.version += 1
+        return removed
+
+
+class MemoryIndex:
+    """按用户保存问答向量并检索
+
+    directory: 保存向量文件的目录
+    min_score: 余弦相似度低于该值的问答不返回
+    max_users: 内存中最多保留多少个用户的索引，超出时释放最久未使用的
+    """
+
+    # 用户锁的数量；同一用户的读写（包括索引被释放后重新加载）总是使用同一把锁
+    LOCK_STRIPES = 64
+
+    def __init__(self, directory='memory_index', dim=DIM, min_score=0.3, max_users=256):
+        self.directory = directory
+        self.dim = dim
+        self.min_score = min_score
+        self.max_users = max_users
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._user_locks = [threading.Lock() for _ in range(self.LOCK_STRIPES)]
+        self._users = OrderedDict()
+        self.stats = {'added': 0, 'searches': 0, 'recalled': 0, 'pruned': 0}
+
+    def _user_lock(self, user_id):
+        return self._user_locks[hash(user_id) % self.LOCK_STRIPES]
+
+    def _user(self, user_id):
+        """返回用户的索引，调用方持有该用户的锁"""
+        with self._lock:
+            index = self._users.get(user_id)
+            if index is not None:
+                self._users.move_to_end(user_id)
+                return index
+        index = _UserIndex(*user_paths(self.directory, user_id), self.dim)
+        with self._lock:
+            self._users[user_id] = index
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        return index
+
+    def delete_user(self, user_id):
+        """删除用户的全部记忆"""
+        with self._user_lock(user_id):
+            with self._lock:
+                self._users.pop(user_id, None)
+            delete_user_files(self.directory, user_id)
+
+    def delete_session(self, user_id, session_id):
+        """删除会话的全部记忆（删除会话时调用），返回移除的问答数"""
+        with self._user_lock(user_id):
+            removed = self._user(user_id).compact(session_id)
+        if removed:
+            with self._lock:
+                self.stats['pruned'] += removed
+        return removed
+
+    def add(self, user_id, session_id, question, answer):
+        """保存一轮问答；问题为空时不保存"""
+        if not question or not question.strip():
+            return False
+        vector = hash_vector(f"{question}\n{answer}", self.dim)
+        record = {
+            'session_id': session_id,
+            'question': question[:EXCERPT_CHARS],
+            'answer': answer[:EXCERPT_CHARS]
+        }
+        with self._user_lock(user_id):
+            self._user(user_id).append(vector, record)
+        with self._lock:
+            self.stats['added'] += 1
+        return True
+
+    def search(self, user_id, text, k=3, exclude_session=None, sessions=None):
+        """返回与 text 最相关的至多 k 轮问答 [(相似度, 记录), ...]，按相似度从高到低排列
+
+        exclude_session 的问答已经在当前上下文中，不返回；sessions 不为 None 时只返回其中会话的问答
+        （已删除的会话不再被回忆）。
+        """
+        query = hash_vector(text, self.dim)
+        if not query.any():
+            return []
+        with self._user_lock(user_id):
+            index = self._user(user_id)
+            matrix = index.matrix()
+            row_sessions = index.sessions
+            version = index.version
+        with self._lock:
+            self.stats['searches'] += 1
+        if matrix is None:
+            return []
+
+        rows = matrix.shape[0]
+        scores = np.empty(rows, dtype=np.float32)
+        for start in range(0, rows, SCORE_BATCH_ROWS):
+            block = matrix[start:start + SCORE_BATCH_ROWS]
+            scores[start:start + len(block)] = block @ query
+
+        allowed = np.fromiter(
+            (sid != exclude_session and (sessions is None or sid in sessions) for sid in row_sessions[:rows]),
+            dtype=bool, count=rows
+        )
+        scores[~allowed] = -1.0
+        candidates = np.flatnonzero(scores >= self.min_score)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(scores[candidates], -k)[-k:]]
+        candidates = sorted(candidates, key=lambda i: scores[i], reverse=True)
+        with self._user_lock(user_id):
+            if index.version != version:
+                # 计算期间文件被压缩重写，行号已经失效
+                return []
+            records = index.records(candidates)
+        results = [(float(scores[i]), record) for i, record in zip(candidates, records)]
+        with self._lock:
+            self.stats['recalled'] += len(results)
+        return results
@@ -0,0 +1,98 @@
+"""上传文件的解析结果缓存
+
+以 (文件内容的 SHA-256, 解析器版本, 文件类型, 解析选项) 为键保存解析结果：提取的文本、
+表格概要和压缩后的图片。同一个文件（例如课件 PDF）在不同会话中再次上传时直接使用缓存，
+不再解析。文本和表格概要用 zlib 压缩后保存，图片本身已经压缩，原样保存；缓存总大小超过
+max_bytes 时淘汰最久未使用的结果。
+"""
+import hashlib
+import json
+import threading
+import time
+import zlib
+
+
+def file_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def make_parse_key(digest, parser_version, kind, options=None):
+    """返回解析结果的缓存键；options 为影响解析结果的选项（例如 PDF 的页码范围）"""
+    canonical = json.dumps([digest, parser_version, kind, options], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def _encode(result):
+    """返回 (encoding, data)；不支持的结果类型返回 None"""
+    if isinstance(result, bytes):
+        return 'bytes', result
+    if isinstance(result, str):
+        return 'text+zlib', zlib.compress(result.encode('utf-8'))
+    if isinstance(result, dict):
+        return 'json+zlib', zlib.compress(json.dumps(result, ensure_ascii=False).encode('utf-8'))
+    return None
+
+
+def _decode(encoding, data):
+    if encoding == 'bytes':
+        return data
+    if encoding == 'text+zlib':
+        return zlib.decompress(data).decode('utf-8')
+    if encoding == 'json+zlib':
+        return json.loads(zlib.decompress(data).decode('utf-8'))
+    raise ValueError(f"未知的缓存编码: {encoding}")
+
+
+class ParseCache:
+    """保存在数据库中的解析结果缓存
+
+    max_bytes: 缓存结果（压缩后）的总大小上限
+    """
+
+    def __init__(self, db, max_bytes=256 * 1024 * 1024, clock=time.time):
+        self.db = db
+        self.max_bytes = max_bytes
+        self._clock = clock
+        self._lock = threading.Lock()
+        # bytes_saved 为命中时免于解析的文件字节数
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'errors': 0, 'bytes_saved': 0}
+
+    @property
+    def hit_rate(self):
+        total = self.stats['hits'] + self.stats['misses']
+        return self.stats['hits'] / total if total else 0.0
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self.stats[key] += value
+
+    def get(self, cache_key):
+        """返回缓存的解析结果，未命中时返回 None"""
+        try:
+            entry = self.db.get_parsed_file(cache_key)
+            if entry is None:
+                self._count('misses')
+                return None
+            encoding, data, source_size = entry
+            result = _decode(encoding, data)
+        except Exception as e:
+            print(f"读取解析缓存时出错: {str(e)}")
+            self._count('errors')
+            return None
+        self._count('hits')
+        self._count('bytes_saved', source_size)
+        return result
+
+    def put(self, cache_key, result, source_size):
+        """保存解析结果；结果为空或类型不支持时不保存"""
+        encoded = _encode(result) if result else None
+        if encoded is None:
+            return False
+        try:
+            self.db.put_parsed_file(cache_key, encoded[0], encoded[1], source_size, self._clock(), self.max_bytes)
+        except Exception as e:
+            print(f"保存解析缓存时出错: {str(e)}")
+            self._count('errors')
+            return False
+        self._count('stores')
+        return True
@@ -0,0 +1,121 @@
+"""PDF 文本的分页并行提取
+
+iter_pdf_pages() 以生成器的形式按页码顺序产出每一页的文本。页数较多时把页码分成若干段，
+交给进程池中的多个进程同时提取，提取过程不占用 Streamlit 的脚本线程，也不受 GIL 限制；
+只提交有限个数的分段，达到字符数或 token 数上限后停止并取消尚未开始的分段。
+并行提取时 PDF 先写入临时文件，子进程按路径读取，避免每个分段都复制一份文件内容。
+"""
+import io
+import os
+import tempfile
+from collections import deque, namedtuple
+
+from context_builder import estimate_text_tokens
+
+# 每个分段包含的页数；页数不超过一段时直接在当前线程中提取
+BATCH_PAGES = 16
+
+PdfPage = namedtuple('PdfPage', ['index', 'text'])
+
+
+def parse_page_range(spec, page_count):
+    """解析页码范围，例如 "1-5,8,10-"，返回从 0 开始的页码列表
+
+    页码从 1 开始，超出文档的部分被忽略，重复的页码只保留一次；spec 为空时返回全部页码。
+    格式错误时抛出 ValueError。
+    """
+    if not spec or not spec.strip():
+        return list(range(page_count))
+    pages = []
+    seen = set()
+    for part in spec.replace('，', ',').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, _, last = part.partition('-')
+            first = int(first) if first.strip() else 1
+            last = int(last) if last.strip() else page_count
+        else:
+            first = last = int(part)
+        if first < 1 or last < first:
+            raise ValueError(f"无效的页码范围: {part}")
+        for number in range(first, min(last, page_count) + 1):
+            if number not in seen:
+                seen.add(number)
+                pages.append(number - 1)
+    return pages
+
+
+def pdf_page_count(data):
+    import PyPDF2
+    return len(PyPDF2.PdfReader(io.BytesIO(data)).pages)
+
+
+def extract_pages(source, indexes):
+    """提取指定页的文本，返回 [(页码, 文本), ...]；source 为文件内容或文件路径，在进程池的子进程中执行"""
+    import PyPDF2
+    reader = PyPDF2.PdfReader(io.BytesIO(source) if isinstance(source, bytes) else source)
+    results = []
+    for index in indexes:
+        try:
+            text = reader.pages[index].extract_text() or ''
+        except Exception as e:
+            # 单页解析失败不影响其他页
+            text = f"[第{index + 1}页解析失败: {str(e)}]"
+        results.append((index, text))
+    return results
+
+
+def iter_pdf_pages(data, pages=None, executor=None, max_chars=None, max_tokens=None,
+                   batch_pages=BATCH_PAGES):
+    """按页码顺序产出 PdfPage
+
+    pages: 要提取的页码（从 0 开始），None 表示全部
+    executor: 进程池（concurrent.futures 的 Executor 或 ingest.IngestionService），None 时在当前线程中逐页提取
+    max_chars/max_tokens: 累计的字符数或估算 token 数达到上限后停止，最后一页仍完整产出
+    """
+    if pages is None:
+        pages = list(range(pdf_page_count(data)))
+    batches = [pages[i:i + batch_pages] for i in range(0, len(pages), batch_pages)]
+    chars = 0
+    tokens = 0
+
+    def over_budget(text):
+        nonlocal chars, tokens
+        chars += len(text)
+        if max_tokens is not None:
+            tokens += estimate_text_tokens(text)
+        return (max_chars is not None and chars >= max_chars) or (max_tokens is not None and tokens >= max_tokens)
+
+    if executor is None or len(batches) <= 1:
+        for batch in batches:
+            for index, text in extract_pages(data, batch):
+                yield PdfPage(index, text)
+                if over_budget(text):
+                    return
+        return
+
+    # 同时提交的分段数为进程数的两倍，提前停止时浪费的工作有限
+    window = 2 * (getattr(executor, 'max_workers', None) or getattr(executor, '_max_workers', 2))
+    pending = deque()
+    next_batch = 0
+    with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp:
+        tmp.write(data)
+    try:
+        while pending or next_batch < len(batches):
+            while next_batch < len(batches) and len(pending) < window:
+                pending.append(executor.submit(extract_pages, tmp.name, batches[next_batch]))
+                next_batch += 1
+            for index, text in pending.popleft().result():
+                yield PdfPage(index, text)
+                if over_budget(text):
+                    return
+    finally:
+        for future in pending:
+            future.cancel()
+        # 已经打开文件的分段不受删除影响，其余被放弃的分段即使失败结果也不会再被使用
+        try:
+            os.unlink(tmp.name)
+        except OSError:
+            pass
@@ -0,0 +1,153 @@
+"""上游响应缓存
+
+以 (模型, api_base, 上下文, max_tokens) 的规范化哈希为键缓存完整的回答。内存中保留最近
+使用的 max_entries 条（LRU），所有缓存同时写入数据库，进程重启或内存淘汰后仍可命中；
+超过 ttl 秒的缓存视为过期。命中时用 replay() 把缓存的回答切成小段快速回放。
+"""
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+# 可以缓存的结束原因；None 表示上游没有返回结束原因
+CACHEABLE_FINISH_REASONS = (None, 'stop')
+
+
+def make_cache_key(model, api_base, context, max_tokens):
+    """返回请求参数的规范化 SHA-256，字典键的顺序和 JSON 空白不影响结果"""
+    canonical = json.dumps(
+        [model, api_base.rstrip('/'), context, max_tokens],
+        sort_keys=True, ensure_ascii=False, separators=(',', ':')
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def key_fingerprint(api_base, api_key):
+    """API 密钥的指纹，内存中只保存指纹而不保存密钥本身"""
+    return hashlib.sha256(f"{api_base.rstrip('/')}\n{api_key}".encode('utf-8')).hexdigest()
+
+
+def replay(text, chunk_chars=32, duration=0.5, sleep=time.sleep):
+    """把缓存的回答按 chunk_chars 个字符一段产出，总耗时约 duration 秒"""
+    pieces = [text[i:i + chunk_chars] for i in range(0, len(text), chunk_chars)]
+    delay = duration / len(pieces) if pieces else 0
+    for piece in pieces:
+        yield piece
+        if delay:
+            sleep(delay)
+
+
+class ResponseCache:
+    """内存 LRU + 数据库两级的响应缓存
+
+    models: 只缓存这些模型的回答，为空时缓存所有未被排除的模型
+    excluded_models: 不缓存的模型（例如联网搜索、图像生成等每次结果应当不同的模型）
+    max_bytes: 数据库中缓存的总大小上限，超出时淘汰最久未使用的缓存
+    """
+
+    def __init__(self, db, ttl=86400, max_entries=256, max_bytes=64 * 1024 * 1024,
+                 models=(), excluded_models=(), prune_every=100, clock=time.time):
+        self.db = db
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.models = set(models)
+        self.excluded_models = set(excluded_models)
+        self.prune_every = prune_every
+        self._clock = clock
+        self._lock = threading.Lock()
+        # cache_key -> (response, finish_reason, created_at, owner)
+        self._memory = OrderedDict()
+        # 成功调用过上游的用户密钥的指纹；用户自己的密钥验证有效之前不返回缓存，
+        # 否则无效的密钥也能通过缓存得到回答
+        self._verified_keys = set()
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0, 'errors': 0}
+
+    def enabled_for(self, model):
+        if model in self.excluded_models:
+            return False
+        return not self.models or model in self.models
+
+    def verify_key(self, api_base, api_key):
+        """记录上游接受了该密钥"""
+        with self._lock:
+            self._verified_keys.add(key_fingerprint(api_base, api_key))
+
+    def key_verified(self, api_base, api_key):
+        with self._lock:
+            return key_fingerprint(api_base, api_key) in self._verified_keys
+
+    @property
+    def hit_rate(self):
+        hits = self.stats['memory_hits'] + self.stats['disk_hits']
+        total = hits + self.stats['misses']
+        return hits / total if total else 0.0
+
+    def _remember(self, cache_key, entry):
+        # 调用方持有 self._lock
+        self._memory[cache_key] = entry
+        self._memory.move_to_end(cache_key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def forget_owner(self, owner):
+        """从内存中移除只属于某个用户的缓存，数据库中的缓存由 Database.delete_user() 删除"""
+        with self._lock:
+            for cache_key in [key for key, entry in self._memory.items() if entry[3] == owner]:
+                del self._memory[cache_key]
+
+    def get(self, cache_key, user_id=None):
+        """返回 (response, finish_reason)，未命中、已过期或属于其他用户时返回 None"""
+        min_created_at = self._clock() - self.ttl
+        with self._lock:
+            entry = self._memory.get(cache_key)
+            if entry is not None:
+                if entry[3] is not None and entry[3] != user_id:
+                    self.stats['misses'] += 1
+                    return None
+                if entry[2] >= min_created_at:
+                    self._memory.move_to_end(cache_key)
+                    self.stats['memory_hits'] += 1
+                    return entry[0], entry[1]
+                del self._memory[cache_key]
+
+        try:
+            entry = self.db.get_cached_response(cache_key, min_created_at)
+        except Exception as e:
+            print(f"读取响应缓存时出错: {str(e)}")
+            entry = None
+            with self._lock:
+                self.stats['errors'] += 1
+
+        with self._lock:
+            if entry is None or entry[3] is not None and entry[3] != user_id:
+                self.stats['misses'] += 1
+                return None
+            self.stats['disk_hits'] += 1
+            self._remember(cache_key, tuple(entry))
+        return entry[0], entry[1]
+
+    def put(self, cache_key, model, response, finish_reason=None, owner=None):
+        """缓存一次完整的回答；被截断或为空的回答不缓存
+
+        上下文中包含某个用户私有的内容（例如从其他会话回忆的问答）时，owner 为该用户的 ID，
+        缓存只返回给该用户。
+        """
+        if not response or finish_reason not in CACHEABLE_FINISH_REASONS:
+            return False
+        created_at = self._clock()
+        with self._lock:
+            self._remember(cache_key, (response, finish_reason, created_at, owner))
+            self.stats['stores'] += 1
+            prune = self.prune_every and self.stats['stores'] % self.prune_every == 0
+        try:
+            self.db.put_cached_response(cache_key, model, response, finish_reason, created_at, self.max_bytes, owner)
+            if prune:
+                self.db.prune_response_cache(created_at - self.ttl)
+        except Exception as e:
+            print(f"保存响应缓存时出错: {str(e)}")
+            with self._lock:
+                self.stats['errors'] += 1
+            return False
+        return True
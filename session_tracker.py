@@ -0,0 +1,338 @@
+"""会话变更跟踪
+
+包装 st.session_state.sessions，记录哪些会话、哪些消息被新增、修改或删除，
+保存时只把变化的部分写入数据库。登录时只加载会话元数据，消息内容在会话被打开时
+才按需加载，并只在内存中保留最近打开的几个会话的消息。
+"""
+from collections import OrderedDict
+
+# 会话元数据字段
+SESSION_META_KEYS = ('title', 'timestamp', 'is_favorite')
+# (数据库中的消息类型, 会话中的字段名)
+MESSAGE_KINDS = (('history', 'chat_history'), ('context', 'chat_context'))
+
+
+class TrackedList(list):
+    """记录修改位置的消息列表
+
+    append/extend 追加到末尾的消息只需新增行；原地修改的消息记录下标；
+    插入、删除、排序等会改变已保存消息位置的操作，则从最小受影响下标开始重写。
+
+    offset 为列表之前尚未加载的已保存消息数量，列表中第 i 条消息在数据库中的序号为 offset + i。
+    """
+
+    def __init__(self, iterable=(), persisted=True, offset=0):
+        super().__init__(iterable)
+        self.offset = offset
+        # 已加载且已保存到数据库的消息数量
+        self.stored_len = len(self) if persisted else 0
+        # 已保存但被原地修改的消息下标
+        self.edited = set()
+        # 从该下标开始的消息位置发生变化，需要整体重写
+        self.rewrite_from = None
+
+    def _index(self, index):
+        """将负数下标转换为正数下标"""
+        return index + len(self) if index < 0 else index
+
+    def _shift(self, index):
+        """记录从 index 开始的消息位置发生了变化"""
+        index = max(index, 0)
+        if index < self.stored_len:
+            self.rewrite_from = index if self.rewrite_from is None else min(self.rewrite_from, index)
+
+    def prepend_loaded(self, messages):
+        """在列表开头补充从数据库加载的更早的消息，不产生需要保存的变化"""
+        count = len(messages)
+        super().__setitem__(slice(0, 0), messages)
+        self.offset -= count
+        self.stored_len += count
+        self.edited = {i + count for i in self.edited}
+        if self.rewrite_from is not None:
+            self.rewrite_from += count
+
+    def touch(self, index):
+        """标记某条消息被原地修改（例如直接修改了消息字典的内容）"""
+        index = self._index(index)
+        if index < self.stored_len:
+            self.edited.add(index)
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            start = index.indices(len(self))[0]
+            super().__setitem__(index, value)
+            self._shift(start)
+        else:
+            super().__setitem__(index, value)
+            self.touch(index)
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            start = index.indices(len(self))[0]
+        else:
+            start = self._index(index)
+        super().__delitem__(index)
+        self._shift(start)
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def __imul__(self, n):
+        result = super().__imul__(n)
+        self._shift(0)
+        return result
+
+    def insert(self, index, value):
+        start = min(self._index(index), len(self))
+        super().insert(index, value)
+        self._shift(start)
+
+    def pop(self, index=-1):
+        start = self._index(index)
+        value = super().pop(index)
+        self._shift(start)
+        return value
+
+    def remove(self, value):
+        del self[self.index(value)]
+
+    def clear(self):
+        del self[:]
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self._shift(0)
+
+    def reverse(self):
+        super().reverse()
+        self._shift(0)
+
+    @property
+    def dirty(self):
+        return bool(self.edited) or self.rewrite_from is not None or len(self) != self.stored_len
+
+    def collect_changes(self):
+        """返回 (truncate_from, [(seq, message), ...])，没有变化时返回 None
+
+        truncate_from 不为 None 时，数据库中 seq >= truncate_from 的消息需要先删除。
+        """
+        if not self.dirty:
+            return None
+        start = self.stored_len if self.rewrite_from is None else self.rewrite_from
+        indexes = sorted(i for i in self.edited if i < start) + list(range(start, len(self)))
+        truncate_from = None if self.rewrite_from is None else self.offset + self.rewrite_from
+        return truncate_from, [(self.offset + i, self[i]) for i in indexes]
+
+    def mark_clean(self):
+        self.stored_len = len(self)
+        self.edited = set()
+        self.rewrite_from = None
+
+
+class TrackedSession(dict):
+    """记录元数据和消息变化的单个会话
+
+    loaded 为 False 时会话只有元数据（标题、时间、收藏），没有 chat_history/chat_context。
+    """
+
+    def __init__(self, data=(), persisted=True, loaded=True):
+        super().__init__(data)
+        self.meta_dirty = not persisted
+        self.loaded = loaded
+        if loaded:
+            for _, key in MESSAGE_KINDS:
+                super().__setitem__(key, TrackedList(self.get(key, []), persisted))
+
+    def __setitem__(self, key, value):
+        if any(key == list_key for _, list_key in MESSAGE_KINDS):
+            # 整体替换消息列表时，数据库中原有的消息全部重写
+            old = self.get(key)
+            if value is old:
+                return
+            value = TrackedList(value, persisted=False)
+            value.rewrite_from = 0
+            if not self.loaded:
+                # 未加载的会话被整体赋值，另一个列表也视为空列表重写
+                self.loaded = True
+                for _, other_key in MESSAGE_KINDS:
+                    if other_key != key:
+                        other = TrackedList()
+                        other.rewrite_from = 0
+                        super().__setitem__(other_key, other)
+        elif key in SESSION_META_KEYS:
+            self.meta_dirty = True
+        super().__setitem__(key, value)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def load_body(self, body):
+        """填入从数据库加载的消息内容
+
+        body 中的 history_offset 表示聊天历史只加载了最近的部分，之前还有多少条未加载。
+        """
+        super().__setitem__('chat_history', TrackedList(
+            body.get('chat_history', []), persisted=True, offset=body.get('history_offset', 0)))
+        super().__setitem__('chat_context', TrackedList(body.get('chat_context', []), persisted=True))
+        if 'summary' in body:
+            super().__setitem__('summary', body['summary'])
+        self.loaded = True
+
+    def set_summary(self, summary):
+        """设置后台生成的滚动摘要；摘要由生成方直接写入数据库，不产生需要保存的变化"""
+        super().__setitem__('summary', summary)
+
+    def unload_body(self):
+        """释放消息内容，只保留元数据；有未保存的修改时不释放"""
+        if not self.loaded or self.dirty:
+            return False
+        for _, key in MESSAGE_KINDS:
+            super().pop(key, None)
+        self.loaded = False
+        return True
+
+    @property
+    def dirty(self):
+        if self.meta_dirty:
+            return True
+        return self.loaded and any(self[key].dirty for _, key in MESSAGE_KINDS)
+
+    def meta(self):
+        """返回需要写入 sessions 表的元数据"""
+        return (
+            self.get('title', '新会话'),
+            self.get('timestamp'),
+            bool(self.get('is_favorite', False))
+        )
+
+    def collect_changes(self):
+        """返回会话的变化，没有变化时返回 None"""
+        if not self.dirty:
+            return None
+        changes = {'meta': self.meta() if self.meta_dirty else None}
+        for kind, key in MESSAGE_KINDS:
+            changes[kind] = self[key].collect_changes() if self.loaded else None
+        return changes
+
+    def mark_clean(self):
+        self.meta_dirty = False
+        if self.loaded:
+            for _, key in MESSAGE_KINDS:
+                self[key].mark_clean()
+
+
+class SessionStore(dict):
+    """用户全部会话的容器，记录新增、修改和删除的会话
+
+    max_loaded 限制内存中保留消息内容的会话数量（按最近打开排序的 LRU），
+    超出时最久未打开且没有未保存修改的会话会被释放为只有元数据。
+    """
+
+    def __init__(self, sessions=None, max_loaded=5):
+        super().__init__()
+        # 已删除、需要从数据库中移除的会话
+        self.deleted = set()
+        self.max_loaded = max_loaded
+        # 已加载消息内容的会话，按最近打开的顺序排列
+        self._recent = OrderedDict()
+        for session_id, session_data in (sessions or {}).items():
+            super().__setitem__(session_id, TrackedSession(session_data, persisted=True))
+            self._recent[session_id] = None
+
+    @classmethod
+    def from_index(cls, index, max_loaded=5):
+        """根据 Database.load_session_index() 返回的元数据创建，消息内容稍后按需加载"""
+        store = cls(max_loaded=max_loaded)
+        for session_id, meta in index.items():
+            dict.__setitem__(store, session_id, TrackedSession(meta, persisted=True, loaded=False))
+        return store
+
+    def __setitem__(self, session_id, session_data):
+        if not isinstance(session_data, TrackedSession):
+            session_data = TrackedSession(session_data, persisted=False)
+        super().__setitem__(session_id, session_data)
+        if session_data.loaded:
+            self._touch(session_id)
+
+    def __delitem__(self, session_id):
+        super().__delitem__(session_id)
+        self._recent.pop(session_id, None)
+        self.deleted.add(session_id)
+
+    def pop(self, session_id, *default):
+        if session_id in self:
+            self._recent.pop(session_id, None)
+            self.deleted.add(session_id)
+        return super().pop(session_id, *default)
+
+    def clear(self):
+        self.deleted.update(self.keys())
+        self._recent.clear()
+        super().clear()
+
+    def update(self, *args, **kwargs):
+        for session_id, session_data in dict(*args, **kwargs).items():
+            self[session_id] = session_data
+
+    def setdefault(self, session_id, default=None):
+        if session_id not in self:
+            self[session_id] = default
+        return self[session_id]
+
+    def _touch(self, session_id):
+        """将会话标记为最近打开，并释放超出 max_loaded 的旧会话"""
+        self._recent[session_id] = None
+        self._recent.move_to_end(session_id)
+        for old_id in list(self._recent):
+            if len(self._recent) <= self.max_loaded:
+                break
+            if old_id != session_id and self[old_id].unload_body():
+                del self._recent[old_id]
+
+    def ensure_loaded(self, session_id, loader):
+        """确保会话的消息内容已加载
+
+        loader(session_id) 返回 {'chat_history': [...], 'chat_context': [...]}，
+        只在会话尚未加载时调用；返回 None 表示加载失败，此时抛出 RuntimeError。
+        """
+        session = self[session_id]
+        if not session.loaded:
+            body = loader(session_id)
+            if body is None:
+                raise RuntimeError("加载会话消息失败")
+            session.load_body(body)
+        self._touch(session_id)
+        return session
+
+    @property
+    def dirty(self):
+        return bool(self.deleted) or any(session.dirty for session in self.values())
+
+    def collect_changes(self):
+        """收集自上次保存以来的全部变化
+
+        返回 {'deleted': [session_id, ...], 'sessions': {session_id: changes}}，
+        删除的会话会先于新增/修改的会话写入，因此同一 ID 先删后建也能正确处理。
+        """
+        sessions = {}
+        for session_id, session in self.items():
+            changes = session.collect_changes()
+            if changes:
+                sessions[session_id] = changes
+        return {'deleted': sorted(self.deleted), 'sessions': sessions}
+
+    def mark_clean(self):
+        self.deleted = set()
+        for session in self.values():
+            session.mark_clean()
+        # 保存后之前因有未保存修改而无法释放的会话现在可以释放了
+        for session_id in list(self._recent)[:-self.max_loaded or None]:
+            if self[session_id].unload_body():
+                del self._recent[session_id]
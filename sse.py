@@ -0,0 +1,232 @@
+"""Server-Sent Events 解码
+
+SSEDecoder 按 HTML 标准的 event-stream 规则解析从套接字读到的原始字节块：
+支持 \\n、\\r\\n、\\r 三种换行，注释行（以 ":" 开头的心跳），多行 data 字段，
+以及被拆分在多次读取中的事件。未处理完的字节保存在一个复用的 bytearray 中。
+
+ChatCompletionStream 在其上解析 OpenAI 兼容接口的流式返回，逐个产出文本增量，
+并记录 finish_reason 和 usage。
+"""
+import json
+import re
+from collections import namedtuple
+
+# 一个完整的事件；data 为多行 data 字段用 "\n" 连接后的文本
+SSEEvent = namedtuple('SSEEvent', ['event', 'data', 'id', 'retry'])
+
+# OpenAI 兼容接口表示流结束的 data
+DONE_MARKER = '[DONE]'
+
+# 完整的行中的三种换行符
+_LINE_BREAK = re.compile(r'\r\n|\r|\n')
+_new_event = tuple.__new__
+_raw_decode_json = json.JSONDecoder().raw_decode
+
+
+class SSEDecoder:
+    """增量解析 text/event-stream 字节流"""
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._data = []
+        self._event = ''
+        self._retry = None
+        # 上一个事件的 id，按标准在之后的事件中保持不变直到被重新设置
+        self.last_event_id = ''
+        self._first_line = True
+        # 上一个块以 \r 结尾时，下一个块开头的 \n 属于同一个换行
+        self._skip_lf = False
+
+    def feed(self, chunk):
+        """解析一块字节，返回其中所有已完整接收的事件列表"""
+        lines = self._split(chunk)
+        return self._feed_lines(lines, False) if lines else []
+
+    def feed_data(self, chunk):
+        """与 feed() 相同，但只返回每个事件的 data，不构造 SSEEvent"""
+        lines = self._split(chunk)
+        return self._feed_lines(lines, True) if lines else []
+
+    def _split(self, chunk):
+        """把一块字节追加到缓冲区，返回其中完整的行，没有完整的行时返回 None"""
+        if not chunk:
+            return None
+        buf = self._buf
+        if self._skip_lf:
+            self._skip_lf = False
+            if chunk[:1] == b'\n':
+                chunk = chunk[1:]
+        buf += chunk
+
+        # 只处理到最后一个换行符为止的完整行；换行符都是 ASCII 字符，
+        # 因此这部分字节可以一次性解码，不会截断多字节字符
+        end = buf.rfind(b'\n')
+        has_cr = b'\r' in buf
+        text_end = end
+        if has_cr:
+            cr = buf.rfind(b'\r')
+            if cr > end:
+                end = text_end = cr
+                self._skip_lf = cr == len(buf) - 1
+            elif end > 0 and buf[end - 1] == 0x0d:
+                # 以 \r\n 结尾，\r 不能再被当作单独的换行
+                text_end = end - 1
+        if end < 0:
+            return None
+        text = buf[:text_end].decode('utf-8', errors='replace')
+        del buf[:end + 1]
+        return _LINE_BREAK.split(text) if has_cr else text.split('\n')
+
+    def _feed_lines(self, lines, data_only):
+        if self._first_line:
+            self._first_line = False
+            if lines[0].startswith('\ufeff'):
+                lines[0] = lines[0][1:]
+        events = []
+        data = self._data
+        for line in lines:
+            if not line:
+                if data:
+                    value = data[0] if len(data) == 1 else '\n'.join(data)
+                    events.append(value if data_only else _new_event(SSEEvent, (
+                        self._event or 'message', value, self.last_event_id, self._retry
+                    )))
+                    data = self._data = []
+                    self._retry = None
+                self._event = ''
+            elif line.startswith('data: '):
+                data.append(line[6:])
+            elif line[0] != ':':
+                # 以 ":" 开头的是注释（心跳），其余为普通字段
+                self._process_field(line)
+        return events
+
+    def _process_field(self, line):
+        field, colon, value = line.partition(':')
+        if colon and value.startswith(' '):
+            value = value[1:]
+
+        if field == 'data':
+            self._data.append(value)
+        elif field == 'event':
+            self._event = value
+        elif field == 'id':
+            if '\x00' not in value:
+                self.last_event_id = value
+        elif field == 'retry':
+            if value.isdigit():
+                self._retry = int(value)
+
+    def close(self):
+        """流结束时调用；按标准，最后一个没有以空行结束的事件会被丢弃"""
+        self._buf.clear()
+        self._data = []
+        self._event = ''
+        self._skip_lf = False
+        return []
+
+
+def iter_sse(chunks, decoder=None):
+    """从字节块迭代器中逐个产出 SSEEvent"""
+    decoder = decoder or SSEDecoder()
+    for chunk in chunks:
+        yield from decoder.feed(chunk)
+    decoder.close()
+
+
+class UpstreamStreamError(Exception):
+    """上游在流中返回了错误信息"""
+
+
+class ChatCompletionStream:
+    """解析 OpenAI 兼容的 chat/completions 流式响应
+
+    迭代时产出第一个选项的每个文本增量；结束后 finish_reason 为其结束原因，
+    usage 为上游返回的用量统计（未返回时为 None），done 表示是否收到了 [DONE]。
+    也可以不传入 chunks，自行调用 feed() 逐块解析。
+    """
+
+    def __init__(self, chunks=()):
+        self._chunks = chunks
+        self._decoder = SSEDecoder()
+        self.finish_reason = None
+        self.usage = None
+        self.done = False
+        self.events = 0
+
+    def __iter__(self):
+        decoder = self._decoder
+        handle = self._handle
+        for chunk in self._chunks:
+            for data in decoder.feed_data(chunk):
+                content = handle(data)
+                if content:
+                    yield content
+                elif self.done:
+                    return
+        decoder.close()
+
+    def feed(self, chunk):
+        """解析一块字节，返回其中的文本增量列表；收到 [DONE] 后忽略之后的数据"""
+        contents = []
+        if self.done:
+            return contents
+        handle = self._handle
+        for data in self._decoder.feed_data(chunk):
+            content = handle(data)
+            if content:
+                contents.append(content)
+            elif self.done:
+                break
+        return contents
+
+    @staticmethod
+    def _decode_choices(data):
+        """只解析 choices 数组，省去 id、model 等无人读取的字段；不能确定结果正确时返回 None
+
+        JSON 字符串中的引号都被转义，因此 '"键":' 只会出现在键的位置。帧中出现 error 或 usage
+        时需要读取它们，交给完整解析处理。
+        """
+        start = data.find('"choices":')
+        if start < 0 or '"error"' in data or '"usage"' in data:
+            return None
+        start += 10
+        if data[start:start + 1] == ' ':
+            start += 1
+        try:
+            return _raw_decode_json(data, start)[0]
+        except json.JSONDecodeError:
+            return None
+
+    def _handle(self, data):
+        """处理一个事件，返回其中第一个选项的文本增量"""
+        self.events += 1
+        if data == DONE_MARKER:
+            self.done = True
+            return None
+        choices = self._decode_choices(data)
+        if choices is None:
+            try:
+                # 上游的 data 都是单个 JSON 对象，直接解析省去 json.loads 对首尾空白的检查
+                payload = _raw_decode_json(data)[0]
+            except json.JSONDecodeError:
+                try:
+                    payload = json.loads(data)
+                except json.JSONDecodeError:
+                    return None
+            if type(payload) is not dict:
+                return None
+            if payload.get('error'):
+                error = payload['error']
+                message = error.get('message') if isinstance(error, dict) else error
+                raise UpstreamStreamError(str(message))
+            if payload.get('usage'):
+                self.usage = payload['usage']
+            choices = payload.get('choices')
+        if not choices or type(choices) is not list:
+            return None
+        choice = choices[0]
+        if choice.get('finish_reason'):
+            self.finish_reason = choice['finish_reason']
+        delta = choice.get('delta')
+        return delta.get('content') if delta else None
@@ -0,0 +1,101 @@
+"""流式输出的增量渲染
+
+post_process_latex 的替换规则都不会跨越换行符，因此已经完整接收的行只需处理一次，
+之后每次刷新只需重新处理最后一行未完成的部分；刷新界面的频率按时间和字符数节流。
+"""
+import re
+import time
+
+
+def post_process_latex(text):
+    """
+    后处理 AI 输出，确保数学公式被正确包裹在 $$ 符号内
+    """
+    # 移除多余的 $ 符号
+    text = re.sub(r'\${2,}', '$$', text)
+    
+    # 查找可能的公式开始和结束
+    pattern = r'(\\begin\{.*?\}|\\end\{.*?\}|\\\[|\\\]|\\(|\\))'
+    
+    def replace_func(match):
+        formula = match.group(1)
+        if formula in ['\\(', '\\)']:
+            return '$$'
+        if formula in ['\\[', '\\]']:
+            return '$$'
+        return formula
+    
+    # 使用正则表达式查找可能的公式边界并替换
+    processed_text = re.sub(pattern, replace_func, text)
+    
+    return processed_text
+
+
+class StreamRenderer:
+    """增量处理并节流渲染流式返回的文本
+
+    container 为 st.empty() 返回的占位元素（或任何带 markdown 方法的对象）。
+    min_interval: 两次刷新界面之间的最短间隔（秒）
+    flush_chars: 距上次刷新累计收到这么多字符时，不等间隔到达也立即刷新
+    """
+
+    def __init__(self, container, min_interval=0.15, flush_chars=400, clock=time.monotonic):
+        self.container = container
+        self.min_interval = min_interval
+        self.flush_chars = flush_chars
+        self._clock = clock
+        # 原始文本的全部片段
+        self._raw_parts = []
+        # 已完成的行经过 LaTeX 处理后的片段
+        self._done_parts = []
+        self._done_text = ""
+        self._done_dirty = False
+        # 最后一行尚未完成的原始片段
+        self._tail_parts = []
+        self._unflushed_chars = 0
+        self._last_flush = clock()
+        self.flush_count = 0
+
+    def feed(self, text):
+        """追加收到的文本，必要时刷新界面"""
+        if not text:
+            return
+        self._raw_parts.append(text)
+        self._unflushed_chars += len(text)
+        if "\n" in text:
+            head, _, rest = text.rpartition("\n")
+            self._tail_parts.append(head + "\n")
+            self._done_parts.append(post_process_latex("".join(self._tail_parts)))
+            self._done_dirty = True
+            self._tail_parts = [rest] if rest else []
+        else:
+            self._tail_parts.append(text)
+
+        if self._unflushed_chars >= self.flush_chars or self._clock() - self._last_flush >= self.min_interval:
+            self.flush()
+
+    def text(self):
+        """返回当前全部文本经过 LaTeX 处理后的结果，与 post_process_latex(raw_text()) 相同"""
+        if self._done_dirty:
+            self._done_text = "".join(self._done_parts)
+            self._done_parts = [self._done_text]
+            self._done_dirty = False
+        return self._done_text + post_process_latex("".join(self._tail_parts))
+
+    def raw_text(self):
+        """返回收到的原始文本"""
+        return "".join(self._raw_parts)
+
+    def flush(self):
+        """将当前内容渲染到界面"""
+        if not self._unflushed_chars:
+            return
+        self.container.markdown(self.text())
+        self._unflushed_chars = 0
+        self._last_flush = self._clock()
+        self.flush_count += 1
+
+    def finish(self):
+        """渲染剩余内容并返回处理后的完整文本"""
+        self.flush()
+        return self.text()
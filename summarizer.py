@@ -0,0 +1,144 @@
+"""会话的滚动摘要
+
+对话超出上下文预算后，较早的消息不再发送给模型。ConversationSummarizer 在后台线程中
+用便宜的模型把这些消息增量合并到会话的摘要中：每次只总结上次摘要之后新被移出的消息，
+连同旧摘要一起生成新摘要。摘要保存在 sessions 表中，组装上下文时作为系统消息放入。
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+SUMMARY_SYSTEM_PROMPT = (
+    "你负责维护一段对话的摘要。请把新的对话内容合并到已有摘要中，输出更新后的完整摘要："
+    "保留用户的身份和偏好、讨论过的关键事实、得出的结论以及尚未解决的问题，"
+    "省略寒暄和重复内容，使用简洁的中文，不超过400字。只输出摘要本身。"
+)
+# 每条消息参与摘要的最大字符数
+MAX_MESSAGE_CHARS = 2000
+# 一次摘要最多处理的字符数，更多的消息留给之后的摘要
+MAX_BATCH_CHARS = 12000
+
+
+def summary_source_text(message):
+    """把一条上下文消息转换为参与摘要的文本"""
+    content = message.get('content')
+    if isinstance(content, list):
+        texts = []
+        for part in content:
+            if part.get('type') == 'image_url':
+                texts.append("[图片]")
+            else:
+                texts.append(part.get('text', ''))
+        content = ' '.join(texts)
+    content = content or ''
+    if len(content) > MAX_MESSAGE_CHARS:
+        content = content[:MAX_MESSAGE_CHARS] + "……"
+    role = "用户" if message.get('role') == 'user' else "助手"
+    return f"{role}: {content}"
+
+
+def valid_summary(session, context):
+    """返回会话中仍然有效的摘要；上下文被截短到摘要覆盖的范围以内时摘要失效"""
+    summary = session.get('summary') if session is not None else None
+    if not summary or summary.get('upto', 0) > len(context):
+        return None
+    return summary
+
+
+class ConversationSummarizer:
+    """在后台线程中增量更新会话摘要
+
+    flush(user_id) 在写入摘要前调用，确保会话已经写入数据库（例如写入队列的 flush）。
+    """
+
+    def __init__(self, db, http_pool, model='gpt-4o-mini', max_tokens=600, max_workers=2,
+                 timeout=60, flush=None):
+        self.db = db
+        self.http_pool = http_pool
+        self.model = model
+        self.max_tokens = max_tokens
+        self.timeout = timeout
+        self.flush = flush
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='summarizer')
+        self._lock = threading.Lock()
+        # 正在生成摘要的 (user_id, session_id)
+        self._running = set()
+        self.stats = {'scheduled': 0, 'completed': 0, 'failed': 0}
+
+    def schedule(self, user_id, session_id, session, evicted_until, api_base, api_key):
+        """上下文中 evicted_until 之前的消息已不再发送时，在后台把尚未摘要的部分合并到摘要中
+
+        同一会话同一时刻只有一个摘要任务，返回是否提交了新任务。
+        """
+        context = session.get('chat_context') or []
+        summary = valid_summary(session, context) or {'text': '', 'upto': 0}
+        start = summary['upto']
+        if evicted_until <= start:
+            return False
+
+        key = (user_id, session_id)
+        with self._lock:
+            if key in self._running:
+                return False
+            self._running.add(key)
+            self.stats['scheduled'] += 1
+
+        # 在提交前复制需要的消息，后台线程不访问会话中的列表
+        lines = []
+        size = 0
+        upto = start
+        for message in context[start:evicted_until]:
+            upto += 1
+            if message.get('role') == 'system' or message.get('pinned'):
+                # 系统消息和固定的消息总是在上下文中，不需要摘要
+                continue
+            line = summary_source_text(message)
+            if lines and size + len(line) > MAX_BATCH_CHARS:
+                upto -= 1
+                break
+            lines.append(line)
+            size += len(line)
+
+        self._executor.submit(self._run, key, session, summary['text'], lines, upto, api_base, api_key)
+        return True
+
+    def _run(self, key, session, previous, lines, upto, api_base, api_key):
+        user_id, session_id = key
+        try:
+            text = self._summarize(previous, lines, api_base, api_key) if lines else previous
+            summary = {'text': text, 'upto': upto}
+            if self.flush:
+                self.flush(user_id)
+            self.db.save_session_summary(user_id, session_id, summary)
+            session.set_summary(summary)
+            with self._lock:
+                self.stats['completed'] += 1
+        except Exception as e:
+            print(f"生成会话摘要时出错: {str(e)}")
+            with self._lock:
+                self.stats['failed'] += 1
+        finally:
+            with self._lock:
+                self._running.discard(key)
+
+    def _summarize(self, previous, lines, api_base, api_key):
+        conversation = "\n".join(lines)
+        prompt = f"已有摘要：\n{previous or '（无）'}\n\n新的对话内容：\n{conversation}"
+        response = self.http_pool.post(
+            api_base,
+            "/v1/chat/completions",
+            headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
+            json={
+                "model": self.model,
+                "messages": [
+                    {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+                    {"role": "user", "content": prompt}
+                ],
+                "max_tokens": self.max_tokens,
+                "stream": False
+            },
+            timeout=(self.http_pool.connect_timeout, self.timeout)
+        )
+        with response:
+            response.raise_for_status()
+            text = response.json()['choices'][0]['message']['content']
+        return (text or '').strip() or previous
@@ -0,0 +1,250 @@
+"""会话数据的后台写入队列
+
+保存请求只在调用线程中序列化变化的数据，然后交给后台线程写入数据库。同一用户
+尚未写入的多次保存会被合并，后台线程每隔 flush_interval 秒把所有用户的变化放在
+同一个事务中提交。
+"""
+import atexit
+import threading
+import time
+
+
+def merge_session_changes(older, newer):
+    """将较新的变化快照合并到较旧的快照上，返回合并后的快照（会修改 older）"""
+    for session_id in newer['deleted']:
+        older['sessions'].pop(session_id, None)
+        older['deleted'].add(session_id)
+
+    for session_id, changes in newer['sessions'].items():
+        entry = older['sessions'].setdefault(session_id, {'meta': None, 'history': None, 'context': None})
+        if changes['meta']:
+            entry['meta'] = changes['meta']
+        for kind in ('history', 'context'):
+            kind_changes = changes[kind]
+            if not kind_changes:
+                continue
+            if entry[kind] is None:
+                entry[kind] = {'truncate_from': None, 'rows': {}}
+            merged = entry[kind]
+            truncate_from = kind_changes['truncate_from']
+            if truncate_from is not None:
+                # 较新的截断会删除较旧快照中该位置之后的消息
+                merged['rows'] = {seq: row for seq, row in merged['rows'].items() if seq < truncate_from}
+                if merged['truncate_from'] is None or truncate_from < merged['truncate_from']:
+                    merged['truncate_from'] = truncate_from
+            merged['rows'].update(kind_changes['rows'])
+
+    older['bytes'] += newer['bytes']
+    return older
+
+
+class WriteBehindQueue:
+    """合并每个用户的保存请求并在后台批量提交
+
+    flush_interval: 两次提交之间的最长间隔（秒），越小数据越快落盘
+    max_pending: 尚未提交的保存请求达到该数量时立即提交，并让新的保存请求等待
+    save_timeout: 积压时保存请求最多等待的秒数，超时后本次保存返回 False，变化留在会话中下次再保存
+    max_retries: 同一用户连续写入失败的次数上限，超出后放弃该用户尚未写入的变化
+    """
+
+    def __init__(self, db, flush_interval=0.5, max_pending=200, retry_delay=1.0,
+                 save_timeout=10.0, max_retries=5):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.retry_delay = retry_delay
+        self.save_timeout = save_timeout
+        self.max_retries = max_retries
+        self._cond = threading.Condition()
+        # user_id -> 尚未提交的变化快照
+        self._pending = {}
+        # user_id -> 合并进快照的保存请求数
+        self._pending_counts = {}
+        self._pending_saves = 0
+        # user_id -> 连续写入失败的次数
+        self._failures = {}
+        # 正在提交中的用户
+        self._in_flight = set()
+        self._flush_requested = False
+        self._closed = False
+        self.stats = {
+            'enqueued': 0,
+            'commits': 0,
+            'failures': 0,
+            'dropped': 0,
+            'save_timeouts': 0,
+            'last_commit_ms': 0.0,
+            'max_commit_ms': 0.0,
+            'total_commit_ms': 0.0,
+            'last_batch_users': 0
+        }
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    @property
+    def queue_depth(self):
+        """尚未提交的保存请求数量"""
+        with self._cond:
+            return self._pending_saves
+
+    def save(self, user_id, sessions):
+        """记录 SessionStore 的变化并放入写入队列
+
+        积压过多时最多等待 save_timeout 秒，仍未缓解则返回 False；此时变化没有被取出，
+        仍然留在 sessions 中，下一次保存时一并写入。
+        """
+        deadline = time.monotonic() + self.save_timeout
+        with self._cond:
+            # 积压过多时让调用方等待后台提交，避免内存无限增长
+            while self._pending_saves >= self.max_pending and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.stats['save_timeouts'] += 1
+                    print(f"会话写入队列积压 {self._pending_saves} 个保存请求，用户 {user_id} 的本次保存已推迟")
+                    return False
+                self._flush_requested = True
+                self._cond.notify_all()
+                self._cond.wait(timeout=min(remaining, 1.0))
+
+        prepared = self.db.prepare_session_changes(sessions.collect_changes())
+        sessions.mark_clean()
+        if not prepared['deleted'] and not prepared['sessions']:
+            return True
+
+        with self._cond:
+            self._enqueue(user_id, prepared, 1)
+            self.stats['enqueued'] += 1
+            if self._pending_saves >= self.max_pending:
+                self._flush_requested = True
+            self._cond.notify_all()
+        return True
+
+    def _enqueue(self, user_id, prepared, saves, requeue=False):
+        # 调用方持有 self._cond；requeue 为 True 时 prepared 是写入失败放回的旧快照，早于队列中的变化
+        if user_id in self._pending:
+            if requeue:
+                prepared = merge_session_changes(prepared, self._pending[user_id])
+            else:
+                prepared = merge_session_changes(self._pending[user_id], prepared)
+        self._pending[user_id] = prepared
+        self._pending_counts[user_id] = self._pending_counts.get(user_id, 0) + saves
+        self._pending_saves += saves
+
+    def discard(self, user_id, timeout=10.0):
+        """丢弃用户尚未提交的变化并等待正在进行的提交结束（删除用户前调用）"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            if self._pending.pop(user_id, None) is not None:
+                self._pending_saves -= self._pending_counts.pop(user_id, 0)
+            self._failures.pop(user_id, None)
+            while user_id in self._in_flight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(timeout=min(remaining, 0.5))
+            # 正在提交的变化写入失败时会被放回队列
+            if self._pending.pop(user_id, None) is not None:
+                self._pending_saves -= self._pending_counts.pop(user_id, 0)
+            self._cond.notify_all()
+        return True
+
+    def flush(self, user_id=None, timeout=10.0):
+        """立即提交并等待完成；指定 user_id 时只等待该用户的数据写入"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                if user_id is None:
+                    done = not self._pending and not self._in_flight
+                else:
+                    done = user_id not in self._pending and user_id not in self._in_flight
+                if done:
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._closed and not self._thread.is_alive():
+                    return False
+                self._flush_requested = True
+                self._cond.notify_all()
+                self._cond.wait(timeout=min(remaining, 0.5))
+
+    def close(self):
+        """提交所有未写入的数据并停止后台线程（进程退出时自动调用）"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout=30)
+
+    def _write_each(self, batch):
+        """批量提交失败后逐个用户单独提交，返回仍然失败的用户集合，使一个用户的坏数据不影响其他用户"""
+        failed = set()
+        for user_id, prepared in batch.items():
+            try:
+                self.db.write_session_batch({user_id: prepared})
+            except Exception as e:
+                print(f"后台保存用户 {user_id} 的会话数据时出错: {str(e)}")
+                failed.add(user_id)
+                continue
+            self.db.record_write(prepared['bytes'])
+            with self._cond:
+                self.stats['commits'] += 1
+        return failed
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed and not self._flush_requested:
+                    self._cond.wait(timeout=self.flush_interval)
+                if not self._pending:
+                    self._flush_requested = False
+                    if self._closed:
+                        return
+                    continue
+                batch, self._pending = self._pending, {}
+                counts, self._pending_counts = self._pending_counts, {}
+                self._pending_saves = 0
+                self._in_flight = set(batch)
+                self._flush_requested = False
+
+            start = time.perf_counter()
+            try:
+                self.db.write_session_batch(batch)
+                failed = set()
+            except Exception as e:
+                print(f"后台保存会话数据时出错: {str(e)}")
+                with self._cond:
+                    self.stats['failures'] += 1
+                failed = self._write_each(batch) if len(batch) > 1 else set(batch)
+                elapsed_ms = None
+            else:
+                elapsed_ms = (time.perf_counter() - start) * 1000
+                for prepared in batch.values():
+                    self.db.record_write(prepared['bytes'])
+
+            with self._cond:
+                if elapsed_ms is not None:
+                    self.stats['commits'] += 1
+                    self.stats['last_commit_ms'] = elapsed_ms
+                    self.stats['max_commit_ms'] = max(self.stats['max_commit_ms'], elapsed_ms)
+                    self.stats['total_commit_ms'] += elapsed_ms
+                    self.stats['last_batch_users'] = len(batch)
+                retry = False
+                for user_id in batch:
+                    if user_id not in failed:
+                        self._failures.pop(user_id, None)
+                        continue
+                    attempts = self._failures.get(user_id, 0) + 1
+                    if attempts >= self.max_retries:
+                        # 放弃该用户的变化，避免无限重试占满队列并阻塞其他用户的保存
+                        self._failures.pop(user_id, None)
+                        self.stats['dropped'] += 1
+                        print(f"用户 {user_id} 的会话数据连续 {attempts} 次写入失败，已放弃尚未保存的修改")
+                        continue
+                    self._failures[user_id] = attempts
+                    self._enqueue(user_id, batch[user_id], counts.get(user_id, 0), requeue=True)
+                    retry = True
+                self._in_flight = set()
+                self._cond.notify_all()
+            if retry:
+                time.sleep(self.retry_delay)